@@ -0,0 +1,240 @@
+"""
+Admission control of bundle builds.
+
+Every build has a cost: the rows it generates, the CPUs its workers pin
+and an estimate of its memory. Builds only run while the costs of the
+running ones fit the budget, the others wait in FIFO order for a bounded
+time and are rejected when too many wait already. Builds of at most
+BUNDLE_SMALL_ROWS rows have a few slots of their own, so they never wait
+behind big ones.
+
+The budget is the instance's: each of its WEB_CONCURRENCY gunicorn workers
+admits builds within an even share of it. A build bigger than that share
+is rejected right away, the workers together would exceed the budget if
+each of them ran one.
+"""
+import math
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+from . import metrics
+
+# gunicorn worker processes sharing the budget
+WEB_CONCURRENCY = max(int(os.environ.get('WEB_CONCURRENCY', 1)), 1)
+# rows generated by the running builds at once
+BUNDLE_BUDGET_ROWS = int(os.environ.get('BUNDLE_BUDGET_ROWS', 50000000))
+# worker processes of the running builds
+BUNDLE_BUDGET_CPUS = int(
+    os.environ.get('BUNDLE_BUDGET_CPUS', 0)) or os.cpu_count() or 1
+# estimated memory of the running builds
+BUNDLE_BUDGET_MEMORY_MB = int(
+    os.environ.get('BUNDLE_BUDGET_MEMORY_MB', 2048))
+# builds up to this many rows run in their own slots
+BUNDLE_SMALL_ROWS = int(os.environ.get('BUNDLE_SMALL_ROWS', 100000))
+BUNDLE_SMALL_SLOTS = int(os.environ.get('BUNDLE_SMALL_SLOTS', 4))
+# builds waiting for the budget before new ones get 503
+BUNDLE_ADMISSION_QUEUE = int(os.environ.get('BUNDLE_ADMISSION_QUEUE', 16))
+# seconds a build waits for the budget before it gets 429
+BUNDLE_ADMISSION_WAIT = float(os.environ.get('BUNDLE_ADMISSION_WAIT', 30))
+
+# rows per second before any build finished, to estimate Retry-After
+DEFAULT_ROWS_PER_SECOND = 1000000
+MAX_RETRY_AFTER = 300
+
+
+class Rejected(Exception):
+    """Waited too long for the budget, retry in `retry_after` seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Overloaded(Rejected):
+    """Too many builds are waiting already."""
+
+
+class TooLarge(Rejected):
+    """The build exceeds the whole budget, it could never run."""
+
+
+class Budget:
+    """Admits costs (a dict per resource) in FIFO order within `capacity`."""
+
+    def __init__(self, name, capacity, max_waiting=BUNDLE_ADMISSION_QUEUE,
+                 timeout=BUNDLE_ADMISSION_WAIT):
+        self.name = name
+        self.capacity = capacity
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.used = dict.fromkeys(capacity, 0)
+        self.running = 0
+        # (ticket, rows) of the waiting builds
+        self.waiting = deque()
+        self.rejected = Counter()
+        self.admitted = 0
+        self.rows_per_second = DEFAULT_ROWS_PER_SECOND
+        self.condition = threading.Condition()
+
+    def fits(self, cost):
+        return all(
+            self.used[resource] + cost.get(resource, 0) <= capacity
+            for resource, capacity in self.capacity.items())
+
+    def check(self, cost):
+        """Raise TooLarge if `cost` exceeds the whole budget."""
+        exceeded = [resource for resource, capacity in self.capacity.items()
+                    if cost.get(resource, 0) > capacity]
+        if exceeded:
+            with self.condition:
+                self._reject(TooLarge, 'too_large',
+                             'The bundle exceeds the {} budget'.format(
+                                 ', '.join(exceeded)))
+
+    def retry_after(self):
+        """Seconds until the running and waiting builds should be done."""
+        rows = self.used.get('rows', 0) + sum(
+            rows for _, rows in self.waiting)
+        return max(1, min(MAX_RETRY_AFTER,
+                          math.ceil(rows / self.rows_per_second)))
+
+    def _reject(self, error, reason, message):
+        self.rejected[reason] += 1
+        metrics.ADMISSION_REJECTED.inc(lane=self.name, reason=reason)
+        raise error(message, self.retry_after())
+
+    def acquire(self, cost, rows, block=False):
+        """
+        Wait until `cost` fits the budget and take it.
+
+        With `block` the wait isn't bounded and the build is queued even
+        if many are waiting, otherwise Overloaded or Rejected is raised.
+        A `cost` over the whole budget is always TooLarge.
+        """
+        self.check(cost)
+        with self.condition:
+            if not self.waiting and self.fits(cost):
+                self._take(cost)
+                return
+            if not block and len(self.waiting) >= self.max_waiting:
+                self._reject(Overloaded, 'queue_full',
+                             'Too many bundles waiting: {}'.format(
+                                 len(self.waiting)))
+            ticket = (object(), rows)
+            self.waiting.append(ticket)
+            metrics.ADMISSION_WAITING.set(len(self.waiting), lane=self.name)
+            deadline = None if block else time.time() + self.timeout
+            try:
+                while self.waiting[0] is not ticket or not self.fits(cost):
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self._reject(
+                                Rejected, 'timeout',
+                                'No capacity for the bundle within {}s'
+                                .format(self.timeout))
+                    self.condition.wait(remaining)
+                self._take(cost)
+            finally:
+                self.waiting.remove(ticket)
+                metrics.ADMISSION_WAITING.set(
+                    len(self.waiting), lane=self.name)
+                self.condition.notify_all()
+
+    def _take(self, cost):
+        for resource in self.used:
+            self.used[resource] += cost.get(resource, 0)
+        self.running += 1
+        self.admitted += 1
+        metrics.ADMISSION_RUNNING.set(self.running, lane=self.name)
+
+    def release(self, cost, rows, seconds):
+        with self.condition:
+            for resource in self.used:
+                self.used[resource] -= cost.get(resource, 0)
+            self.running -= 1
+            if rows and seconds > 0:
+                # moving average, recent builds count the most
+                self.rows_per_second = (
+                    0.8 * self.rows_per_second + 0.2 * rows / seconds)
+            metrics.ADMISSION_RUNNING.set(self.running, lane=self.name)
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                'capacity': dict(self.capacity),
+                'used': dict(self.used),
+                'running': self.running,
+                'waiting': len(self.waiting),
+                'admitted': self.admitted,
+                'rejected': dict(self.rejected),
+                'retry_after': self.retry_after(),
+            }
+
+
+class Admission:
+    """Routes builds to the small or the large budget by their cost."""
+
+    def __init__(self, rows=BUNDLE_BUDGET_ROWS, cpus=BUNDLE_BUDGET_CPUS,
+                 memory_mb=BUNDLE_BUDGET_MEMORY_MB,
+                 small_rows=BUNDLE_SMALL_ROWS, small_slots=BUNDLE_SMALL_SLOTS,
+                 max_waiting=BUNDLE_ADMISSION_QUEUE,
+                 timeout=BUNDLE_ADMISSION_WAIT, workers=WEB_CONCURRENCY):
+        self.small_rows = small_rows
+        # the share of one of the `workers` processes
+        self.small = Budget('small', {
+            'builds': max(small_slots // workers, 1),
+        }, max_waiting, timeout)
+        self.large = Budget('large', {
+            'rows': max(rows // workers, 1),
+            'cpus': max(cpus // workers, 1),
+            'memory': (memory_mb << 20) // workers,
+        }, max_waiting, timeout)
+
+    def _lane(self, cost):
+        """The budget of a build of `cost` and what it takes of it."""
+        if cost['rows'] <= self.small_rows and cost['cpus'] <= 1:
+            return self.small, {'builds': 1}
+        return self.large, cost
+
+    def check(self, cost):
+        """Raise TooLarge if a build of `cost` could never be admitted."""
+        budget, lane_cost = self._lane(cost)
+        budget.check(lane_cost)
+
+    def acquire(self, cost, block=False):
+        """Admit a build of `cost` and return its ticket for `release`."""
+        budget, lane_cost = self._lane(cost)
+        budget.acquire(lane_cost, cost['rows'], block)
+        return budget, lane_cost, cost['rows'], time.time()
+
+    def release(self, ticket):
+        budget, lane_cost, rows, start = ticket
+        budget.release(lane_cost, rows, time.time() - start)
+
+    @contextmanager
+    def admit(self, cost, block=False):
+        ticket = self.acquire(cost, block)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+    def retry_after(self):
+        """Seconds until the builds of both lanes should be done."""
+        seconds = []
+        for budget in (self.small, self.large):
+            with budget.condition:
+                seconds.append(budget.retry_after())
+        return max(seconds)
+
+    def stats(self):
+        return {'small': self.small.stats(), 'large': self.large.stats()}
+
+
+ADMISSION = Admission()
@@ -0,0 +1,255 @@
+"""
+Random access to the members of bundles.
+
+Reading a few rows of a table shouldn't mean decompressing a whole bundle.
+The first access indexes it: the tar members and the offsets where its
+gzip members start, the points where decompression can start over without
+the data before (zran style checkpoints, minus the saved windows). The
+index is kept next to the bundle as `<bundle>.index`; reads decompress from
+the last checkpoint before what they read.
+
+TarGzWriter starts a gzip member at least every BUNDLE_INDEX_SPAN bytes,
+other .tar.gz files can be read as well but only have as many checkpoints
+as gzip members.
+"""
+import functools
+import json
+import os
+import tarfile
+import threading
+import zlib
+from bisect import bisect_left, bisect_right
+
+INDEX_SUFFIX = '.index'
+INDEX_VERSION = 1
+GZIP_MAGIC = b'\x1f\x8b'
+# compressed bytes read and uncompressed bytes produced at once
+READ_SIZE = 1 << 20
+
+
+class Inflater:
+    """
+    A file object of the data of concatenated gzip members.
+
+    Remembers the `(compressed, uncompressed, lines)` offsets of every
+    member it starts, `lines` being the newlines before it.
+    """
+
+    def __init__(self, fileobj, checkpoint=(0, 0, 0)):
+        self.fileobj = fileobj
+        self.compressed, self.uncompressed, self.lines = checkpoint
+        fileobj.seek(self.compressed)
+        self.pending = b''
+        self.decompressor = None
+        self.buffer = bytearray()
+        self.checkpoints = []
+        self.eof = False
+
+    def chunk(self):
+        """The next decompressed chunk, b'' at the end."""
+        while not self.eof:
+            if not self.pending:
+                self.pending = self.fileobj.read(READ_SIZE)
+                if not self.pending:
+                    break
+            if self.decompressor is None:
+                # trailing garbage, e.g. zero padding, ends the data
+                if len(self.pending) < 2 and not self.eof:
+                    self.pending += self.fileobj.read(READ_SIZE)
+                if not self.pending.startswith(GZIP_MAGIC):
+                    break
+                self.checkpoints.append(
+                    (self.compressed, self.uncompressed, self.lines))
+                self.decompressor = zlib.decompressobj(31)
+            data = self.decompressor.decompress(self.pending, READ_SIZE)
+            if self.decompressor.eof:
+                rest = self.decompressor.unused_data
+                self.decompressor = None
+            else:
+                rest = self.decompressor.unconsumed_tail
+            self.compressed += len(self.pending) - len(rest)
+            self.pending = rest
+            if data:
+                self.uncompressed += len(data)
+                self.lines += data.count(b'\n')
+                return data
+        self.eof = True
+        return b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            data = self.chunk()
+            if not data:
+                break
+            self.buffer += data
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def build_index(path):
+    """Index the tar members and gzip members of the bundle at `path`."""
+    stat = os.stat(path)
+    with open(path, 'rb') as f:
+        inflater = Inflater(f)
+        with tarfile.open(fileobj=inflater, mode='r|') as tar:
+            members = [{'name': info.name, 'size': info.size,
+                        'offset': info.offset_data}
+                       for info in tar if info.isfile()]
+    return {
+        'version': INDEX_VERSION,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'checkpoints': inflater.checkpoints,
+        'members': members,
+    }
+
+
+_building = {}
+_building_lock = threading.Lock()
+
+
+def load_index(path):
+    """
+    The `BundleIndex` of the bundle at `path`, built on first use.
+
+    An index that doesn't match the bundle any more is rebuilt.
+    """
+    stat = os.stat(path)
+    index = _load(path, stat.st_size, stat.st_mtime_ns)
+    if index is not None:
+        return index
+    # one build per bundle, concurrent readers wait for it
+    with _building_lock:
+        lock = _building.setdefault(path, threading.Lock())
+    with lock:
+        index = _load(path, stat.st_size, stat.st_mtime_ns)
+        if index is None:
+            data = build_index(path)
+            tmp = index_path(path) + '.part'
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, index_path(path))
+            _load.cache_clear()
+            index = BundleIndex(path, data)
+    with _building_lock:
+        _building.pop(path, None)
+    return index
+
+
+@functools.lru_cache(maxsize=32)
+def _load(path, size, mtime_ns):
+    try:
+        with open(index_path(path)) as f:
+            data = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if (data.get('version'), data.get('size'), data.get('mtime_ns')) != \
+            (INDEX_VERSION, size, mtime_ns):
+        return None
+    return BundleIndex(path, data)
+
+
+class BundleIndex:
+    def __init__(self, path, data):
+        self.path = path
+        self.checkpoints = [tuple(point) for point in data['checkpoints']]
+        self.offsets = [point[1] for point in self.checkpoints]
+        self.lines = [point[2] for point in self.checkpoints]
+        self.members = {member['name']: member for member in data['members']}
+
+    def chunks(self, checkpoint):
+        """`(offset, data)` chunks of the tar stream from `checkpoint`."""
+        with open(self.path, 'rb') as f:
+            inflater = Inflater(f, checkpoint)
+            while True:
+                offset = inflater.uncompressed
+                data = inflater.chunk()
+                if not data:
+                    return
+                yield offset, data
+
+    def _before(self, offset):
+        """The last checkpoint at or before `offset`."""
+        index = bisect_right(self.offsets, offset) - 1
+        return self.checkpoints[max(index, 0)]
+
+    def read(self, start, stop):
+        """Bytes `start` to `stop` of the tar stream."""
+        parts = []
+        for offset, data in self.chunks(self._before(start)):
+            if offset >= stop:
+                break
+            parts.append(data[max(start - offset, 0):stop - offset])
+        return b''.join(parts)
+
+    def lines_before(self, position):
+        """The newlines in the tar stream before `position`."""
+        checkpoint = self._before(position)
+        lines = checkpoint[2]
+        for offset, data in self.chunks(checkpoint):
+            if offset >= position:
+                break
+            lines += data.count(b'\n', 0, position - offset)
+        return lines
+
+    def read_bytes(self, name, offset=0, limit=None):
+        """Up to `limit` bytes of member `name` from `offset` on."""
+        member = self.members[name]
+        start = member['offset'] + min(offset, member['size'])
+        stop = member['offset'] + member['size']
+        if limit is not None:
+            stop = min(stop, start + limit)
+        return self.read(start, stop)
+
+    def read_lines(self, name, offset=0, limit=None):
+        """Up to `limit` lines of member `name`, skipping `offset` lines."""
+        member = self.members[name]
+        start, stop = member['offset'], member['offset'] + member['size']
+        if offset:
+            start = self._line_start(
+                self.lines_before(start) + offset, stop)
+        if limit is None:
+            return self.read(start, stop)
+        parts = []
+        found = 0
+        for position, data in self.chunks(self._before(start)):
+            if position >= stop:
+                break
+            data = data[max(start - position, 0):stop - position]
+            count = data.count(b'\n')
+            if found + count >= limit:
+                parts.append(data[:_nth_newline(data, limit - found) + 1])
+                break
+            found += count
+            parts.append(data)
+        return b''.join(parts)
+
+    def _line_start(self, line, stop):
+        """Where the line after the `line`th newline starts, or `stop`."""
+        checkpoint = self.checkpoints[
+            max(bisect_left(self.lines, line) - 1, 0)]
+        lines = checkpoint[2]
+        for position, data in self.chunks(checkpoint):
+            if position >= stop:
+                break
+            count = data.count(b'\n')
+            if lines + count >= line:
+                return min(
+                    position + _nth_newline(data, line - lines) + 1, stop)
+            lines += count
+        return stop
+
+
+def _nth_newline(data, n):
+    """The index of the `n`th newline in `data`, -1 for none."""
+    end = -1
+    for _ in range(n):
+        end = data.index(b'\n', end + 1)
+    return end
@@ -0,0 +1,179 @@
+"""
+Content addressed cache of generated bundles.
+
+Bundles are keyed by a hash of every `BundleConfig` field that changes the
+tarball plus the day they are generated on (timestamps are relative to
+it, or to `reference_time` when that is set). A hit hardlinks the cached
+tarball under the new bundle uuid instead of generating it again.
+"""
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from fastapi.logger import logger
+
+BUNDLE_DIR = os.environ.get('BUNDLE_DIR', '/BUNDLE_DIR')
+BUNDLE_CACHE_DIR = os.environ.get(
+    'BUNDLE_CACHE_DIR', os.path.join(BUNDLE_DIR, '.cache'))
+# total size of cached bundles, 0 disables the cache
+BUNDLE_CACHE_MAX_BYTES = int(os.environ.get('BUNDLE_CACHE_MAX_BYTES', 0))
+# BundleConfig fields that never change the generated tarball
+IGNORED_FIELDS = {'bundle_uuid', 'workers', 'compression_threads',
+                  'tenant_id', 'account_id', 'series'}
+
+
+def config_hash(bundle_config, **extra):
+    """Hash of the BundleConfig fields that change the generated tarball."""
+    fields = {name: value for name, value in bundle_config.dict().items()
+              if name not in IGNORED_FIELDS}
+    fields.update(extra)
+    return hashlib.sha256(json.dumps(
+        fields, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def link_or_copy(src, dst):
+    """
+    Hardlink `src` as `dst`, or copy it where that's not possible
+
+    An existing `dst` is left alone: another worker cached the same bundle
+    and it may be linked under bundles being downloaded. Copies are made
+    next to `dst` and moved into place, never written through it.
+    """
+    try:
+        os.link(src, dst)
+        return
+    except FileExistsError:
+        return
+    except OSError:
+        pass
+    fd, tmp = tempfile.mkstemp(
+        '.part', '.' + os.path.basename(dst), os.path.dirname(dst))
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class BundleCache:
+    """
+    Size bounded LRU of bundles in `cache_dir`.
+
+    Entries are hardlinks, so the disk space of an evicted entry is only
+    released once the bundles linked to it are deleted as well. The LRU
+    index and its bound are per process: every gunicorn worker evicts the
+    entries it knows of, so the cache can hold up to WEB_CONCURRENCY times
+    `max_bytes`.
+    """
+
+    def __init__(self, cache_dir=BUNDLE_CACHE_DIR,
+                 max_bytes=BUNDLE_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entries = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def key(self, bundle_config, day=None):
+        if day is None and bundle_config.reference_time:
+            # timestamps only depend on the reference time then
+            day = bundle_config.reference_time.date()
+        return config_hash(
+            bundle_config, day=(day or datetime.date.today()).isoformat())
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, '{}.tar.gz'.format(key))
+
+    def _load(self):
+        """Index the entries already on disk, oldest first."""
+        if self.entries is not None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.tar.gz'):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, name[:-7], stat.st_size))
+        self.entries = OrderedDict(
+            (key, size) for _, key, size in sorted(entries))
+
+    def fetch(self, bundle_config, data_bundle, day=None):
+        """
+        Link the cached copy of a bundle to `data_bundle` if any
+
+        `day` is the one the bundle is generated on, today by default; it
+        has to be the same for `store`.
+        """
+        if not self.enabled:
+            return False
+        key = self.key(bundle_config, day)
+        with self.lock:
+            self._load()
+            if key not in self.entries:
+                self.misses += 1
+                return False
+            try:
+                link_or_copy(self.path(key), data_bundle)
+            except FileNotFoundError:
+                # removed behind our back
+                del self.entries[key]
+                self.misses += 1
+                return False
+            self.entries.move_to_end(key)
+            self.hits += 1
+        logger.info('bundle cache hit: key=%s, bundle=%s', key, data_bundle)
+        return True
+
+    def store(self, bundle_config, data_bundle, day=None):
+        """Add a freshly generated bundle of `day` to the cache."""
+        if not self.enabled:
+            return
+        key = self.key(bundle_config, day)
+        with self.lock:
+            self._load()
+            if key in self.entries:
+                return
+            link_or_copy(data_bundle, self.path(key))
+            self.entries[key] = os.stat(data_bundle).st_size
+            self._evict()
+
+    def _evict(self):
+        total = sum(self.entries.values())
+        while total > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            total -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            logger.info('bundle cache evicted: key=%s', key)
+
+    def stats(self):
+        with self.lock:
+            entries = self.entries or {}
+            return {
+                'enabled': self.enabled,
+                'entries': len(entries),
+                'bytes': sum(entries.values()),
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+BUNDLE_CACHE = BundleCache()
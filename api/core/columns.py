@@ -0,0 +1,252 @@
+"""
+Columnar copies of the generated tables.
+
+Next to or instead of a CSV table a bundle can hold every column of it as
+a NumPy `.npy` file, `events_table/<column>.npy` for `events_table.csv`.
+They are plain typed arrays: little endian 64 bit integers and floats,
+booleans and NUL padded fixed width strings, which readers load or
+memory-map without parsing (`numpy.load`), and which are written here
+without NumPy as whole column blocks instead of formatted rows.
+
+A column's size is only known once all its rows are generated, so the
+columns of a table are compressed into spooled temporary files while the
+rows are generated and then copied into the tar one after the other.
+"""
+import json
+import sys
+import tempfile
+from array import array
+
+from .tarstream import SpanCompressor, gzip_stored
+
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+# header and data of .npy files are aligned to this
+NPY_ALIGN = 64
+# file extension of the columns and the version of the format
+COLUMN_SUFFIX = '.npy'
+COLUMN_VERSION = '1.0'
+# rows generated before the blocks of every column are compressed
+COLUMN_BLOCK_ROWS = 1 << 16
+# bytes of a compressed column kept in memory before it spills to disk
+SPOOL_SIZE = 1 << 20
+
+INT = '<i8'
+FLOAT = '<f8'
+BOOL = '|b1'
+# the columns of the TABLES and their dtypes, strings are NUL padded
+# `|S<width>` with a width depending on the BundleConfig
+COLUMNS = {
+    'events_table.csv': [
+        ('id', INT), ('created', 'S'), ('uuid', 'S'), ('parent_uuid', 'S'),
+        ('event', 'S'), ('task_action', 'S'), ('failed', BOOL),
+        ('changed', BOOL), ('playbook', 'S'), ('play', 'S'), ('task', 'S'),
+        ('role', 'S'), ('job_id', INT), ('host_id', INT),
+        ('host_name', 'S'),
+    ],
+    'unified_jobs_table.csv': [
+        ('id', INT), ('polymorphic_ctype_id', INT), ('model', 'S'),
+        ('organization_id', INT), ('organization_name', 'S'),
+        ('created', 'S'), ('name', 'S'), ('unified_job_template_id', INT),
+        ('launch_type', 'S'), ('schedule_id', INT), ('execution_node', 'S'),
+        ('controller_node', 'S'), ('cancel_flag', BOOL), ('status', 'S'),
+        ('failed', BOOL), ('started', 'S'), ('finished', 'S'),
+        ('elapsed', FLOAT), ('job_explanation', 'S'),
+        ('instance_group_id', INT),
+    ],
+}
+
+
+def column_path(filename, column):
+    """The tar member of `column` of the table `filename`."""
+    return '{}/{}{}'.format(
+        filename.rsplit('.', 1)[0], column, COLUMN_SUFFIX)
+
+
+def manifest(data, tables, csv=True):
+    """
+    manifest.json of a bundle with the columns of `tables`
+
+    Without `csv` the CSV files of the `tables` are left out.
+    """
+    versions = json.loads(data)
+    for filename in tables:
+        if not csv:
+            versions.pop(filename, None)
+        for column, _ in COLUMNS[filename]:
+            versions[column_path(filename, column)] = COLUMN_VERSION
+    return json.dumps(versions, indent=4).encode()
+
+
+def npy_header(dtype, rows):
+    """The header of a one dimensional .npy file."""
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': ({},), }}" \
+        .format(dtype, rows)
+    length = len(NPY_MAGIC) + 2 + len(header) + 1
+    header += ' ' * (-length % NPY_ALIGN) + '\n'
+    return NPY_MAGIC + len(header).to_bytes(2, 'little') + header.encode()
+
+
+def _little_endian(values):
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def ints(values):
+    return _little_endian(array('q', values))
+
+
+def floats(values):
+    return _little_endian(array('d', values))
+
+
+def itemsize(dtype):
+    if dtype in (INT, FLOAT):
+        return 8
+    return 1 if dtype == BOOL else int(dtype[2:])
+
+
+def scalar(value, dtype):
+    """`value` as one element of a column of `dtype`."""
+    if dtype == INT:
+        return ints([value])
+    if dtype == FLOAT:
+        return floats([value])
+    if dtype == BOOL:
+        return b'\1' if value else b'\0'
+    return text(value, itemsize(dtype))
+
+
+def text(value, width):
+    """`value` as a fixed width string."""
+    return str(value).encode().ljust(width, b'\0')
+
+
+def width(*values):
+    """The width of the longest of `values`, at least 1."""
+    return max([len(str(value).encode()) for value in values] + [1])
+
+
+class Labels(dict):
+    """`prefix` and a number up to `count` as fixed width strings."""
+
+    def __init__(self, prefix, count):
+        super().__init__()
+        self.prefix = prefix
+        self.width = width(prefix + str(max(count - 1, 0)))
+
+    def __missing__(self, value):
+        label = self[value] = text(self.prefix + str(value), self.width)
+        return label
+
+
+def join_blocks(blocks, rows=COLUMN_BLOCK_ROWS):
+    """
+    Merge `(rows, {column: bytes})` blocks up to about `rows` each
+
+    Tiny blocks (a job with a single event) would make compressing the
+    columns block by block slow.
+    """
+    pending = {}
+    buffered = 0
+    for block_rows, block in blocks:
+        for column, data in block.items():
+            pending.setdefault(column, []).append(data)
+        buffered += block_rows
+        if buffered >= rows:
+            yield buffered, {column: b''.join(parts)
+                             for column, parts in pending.items()}
+            pending = {}
+            buffered = 0
+    if buffered:
+        yield buffered, {column: b''.join(parts)
+                         for column, parts in pending.items()}
+
+
+def compress_blocks(blocks, compresslevel=9):
+    """
+    Compress `(rows, {column: bytes})` blocks into a gzip member per column
+
+    Returns `{column: (member, size)}` for `ColumnSpool.add_segment`.
+    """
+    compressors = {}
+    members = {}
+    for _, block in join_blocks(blocks):
+        for column, data in block.items():
+            if column not in compressors:
+                compressors[column] = SpanCompressor(compresslevel)
+                members[column] = [[], 0]
+            members[column][0].append(compressors[column].compress(data))
+            members[column][1] += len(data)
+    for column, compressor in compressors.items():
+        members[column][0].append(compressor.flush())
+    return {column: (b''.join(parts), size)
+            for column, (parts, size) in members.items()}
+
+
+class ColumnSpool:
+    """
+    The compressed columns of one table in temporary files.
+
+    Blocks generated in this process are compressed into one gzip member
+    per column, members compressed by workers are appended as they are.
+    """
+
+    def __init__(self, dtypes, compresslevel=9, dir=None):
+        self.dtypes = dtypes
+        self.compresslevel = compresslevel
+        self.files = {
+            column: tempfile.SpooledTemporaryFile(SPOOL_SIZE, dir=dir)
+            for column in dtypes}
+        self.sizes = dict.fromkeys(dtypes, 0)
+        self.compressors = {}
+
+    def write(self, blocks):
+        """Compress `(rows, {column: bytes})` blocks."""
+        for _, block in join_blocks(blocks):
+            for column, data in block.items():
+                compressor = self.compressors.get(column)
+                if compressor is None:
+                    compressor = self.compressors[column] = \
+                        SpanCompressor(self.compresslevel)
+                self.files[column].write(compressor.compress(data))
+                self.sizes[column] += len(data)
+
+    def add_segment(self, members):
+        """Append the `{column: (member, size)}` of `compress_blocks`."""
+        self._flush()
+        for column, (member, size) in members.items():
+            self.files[column].write(member)
+            self.sizes[column] += size
+
+    def _flush(self):
+        for column, compressor in self.compressors.items():
+            self.files[column].write(compressor.flush())
+        self.compressors = {}
+
+    def segments(self, column, chunk_size=SPOOL_SIZE):
+        """
+        `column` as `(gzip_member, size)` for `TarGzWriter.add_segments`
+
+        The header comes first with the size of the whole column, the
+        spooled members follow in chunks.
+        """
+        self._flush()
+        dtype = self.dtypes[column]
+        size = self.sizes[column]
+        header = npy_header(dtype, size // itemsize(dtype))
+        yield gzip_stored(header), len(header) + size
+        spool = self.files[column]
+        spool.seek(0)
+        for chunk in iter(lambda: spool.read(chunk_size), b''):
+            yield chunk, 0
+
+    def close(self):
+        for spool in self.files.values():
+            spool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,108 @@
+"""
+Skewed value distributions for the generated tables.
+
+A `BundleConfig` can replace the modulo patterns of some columns with a
+Zipf or weighted distribution. Every distribution is sampled once into a
+sequence of SAMPLES values (cumulative weights and bisection, seeded by
+`BundleConfig.seed`) and a row takes the value at its id modulo the
+sequence, which is as cheap as the modulo patterns and doesn't depend on
+how the jobs are split between workers.
+"""
+import bisect
+import functools
+import json
+import random
+from itertools import accumulate
+
+# values sampled per distribution, at most this many distinct values show
+SAMPLES = 1 << 16
+# values a Zipf distribution spans at most, the tail beyond is dropped
+MAX_ZIPF_VALUES = 1 << 20
+
+STATUSES = ('successful', 'failed', 'error', 'pending', 'canceled')
+FLAGS = ('t', 'f')
+# columns taking one of a set of values, and their values
+CATEGORICAL = {
+    'status': STATUSES,
+    'failed': FLAGS,
+    'changed': FLAGS,
+}
+# columns taking a value from 0 up to a count of the BundleConfig
+NUMERIC = {
+    'org': 'orgs_count',
+    'template': 'templates_count',
+    'day': 'spread_days_back',
+    'host': 'hosts_count',
+    'task': 'tasks_count',
+}
+
+
+def check_distribution(column, distribution, count=None):
+    """
+    Raise ValueError if `distribution` doesn't fit `column`
+
+    `count` is the number of values of a numeric column.
+    """
+    zipf, weights = distribution.zipf, distribution.weights
+    if (zipf is None) == (weights is None):
+        raise ValueError(
+            '{}: set either zipf or weights'.format(column))
+    if zipf is not None and zipf <= 0:
+        raise ValueError('{}: zipf has to be positive'.format(column))
+    if column in CATEGORICAL:
+        if not isinstance(weights, dict):
+            raise ValueError('{}: needs weights of {}'.format(
+                column, ', '.join(CATEGORICAL[column])))
+        unknown = set(weights) - set(CATEGORICAL[column])
+        if unknown:
+            raise ValueError('{}: unknown values {}'.format(
+                column, ', '.join(sorted(unknown))))
+        weights = list(weights.values())
+    elif isinstance(weights, dict):
+        raise ValueError('{}: weights have to be a list'.format(column))
+    elif weights is not None:
+        weights = weights[:count]
+    if weights is not None and (
+            not weights or min(weights) < 0 or not sum(weights) > 0):
+        raise ValueError(
+            '{}: weights have to be positive'.format(column))
+
+
+@functools.lru_cache(maxsize=64)
+def sample(values, weights, seed):
+    """`SAMPLES` values drawn from `values` with relative `weights`."""
+    cumulative = list(accumulate(weights))
+    total = cumulative[-1]
+    rng = random.Random(seed)
+    last = len(cumulative) - 1
+    return [values[bisect.bisect(cumulative, rng.random() * total, hi=last)]
+            for _ in range(SAMPLES)]
+
+
+def samplers(bundle_config):
+    """
+    The sample sequences of the columns with a distribution
+
+    Columns without one are missing, they keep their modulo pattern.
+    """
+    sequences = {}
+    seed = bundle_config.seed or 0
+    for column, distribution in (bundle_config.distributions or {}).items():
+        column = getattr(column, 'value', column)
+        if column in CATEGORICAL:
+            values = tuple(distribution.weights)
+            weights = tuple(distribution.weights.values())
+        else:
+            count = getattr(bundle_config, NUMERIC[column]) or 1
+            if distribution.zipf is not None:
+                count = min(count, MAX_ZIPF_VALUES)
+                weights = tuple(
+                    1 / rank ** distribution.zipf
+                    for rank in range(1, count + 1))
+            else:
+                weights = tuple(distribution.weights[:count])
+            values = tuple(range(len(weights)))
+        # a different sequence per column, but the same for every bundle
+        column_seed = json.dumps([seed, column])
+        sequences[column] = sample(values, weights, column_seed)
+    return sequences
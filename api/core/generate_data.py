@@ -1,22 +1,45 @@
 import datetime
-import io
+import functools
 import json
 import os
 import pkgutil
-import shutil
-import tarfile
-import tempfile
+import random
+import threading
 import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate, repeat
 
 from fastapi.logger import logger
 from kafka import KafkaProducer
-from kafka.errors import KafkaError
+
+from . import metrics
+from .cache import BUNDLE_CACHE, config_hash
+from .columns import (COLUMN_BLOCK_ROWS, COLUMNS, SPOOL_SIZE, ColumnSpool,
+                      Labels, compress_blocks, column_path, ints, itemsize,
+                      manifest, scalar, text, width)
+from .distributions import SAMPLES, STATUSES, samplers
+from .notify import KafkaConnection, NotificationQueue
+from .registry import BUNDLE_REGISTRY
+from .rollup import FAILED_STATUSES, ROLLUP_FILES, Rollup
+from .tarstream import (ChunkPipe, SpanCompressor, TarGzWriter,
+                        compress_member, gzip_stored)
 
 BUNDLE_DIR = os.environ.get('BUNDLE_DIR', '/BUNDLE_DIR')
 KAFKA_HOST = os.environ.get('KAFKA_HOST', 'kafka')
 KAFKA_PORT = os.environ.get('KAFKA_PORT', '9092')
 KAFKA_TOPIC = 'platform.upload.tower'
-KAFKA_PRODUCER = None
+KAFKA_LINGER_MS = int(os.environ.get('KAFKA_LINGER_MS', 50))
+KAFKA_BATCH_SIZE = int(os.environ.get('KAFKA_BATCH_SIZE', 16384))
+# notifications sent but not yet acknowledged by the broker
+KAFKA_MAX_IN_FLIGHT = int(os.environ.get('KAFKA_MAX_IN_FLIGHT', 100))
+KAFKA_RETRIES = int(os.environ.get('KAFKA_RETRIES', 3))
+KAFKA_RETRY_BACKOFF = float(os.environ.get('KAFKA_RETRY_BACKOFF', 0.5))
+# seconds between attempts to connect, and the seconds a notification
+# waits for the connection before it counts as a failed attempt
+KAFKA_CONNECT_RETRY = float(os.environ.get('KAFKA_CONNECT_RETRY', 5))
+KAFKA_CONNECT_WAIT = float(os.environ.get('KAFKA_CONNECT_WAIT', 30))
 FILES = ['config.json',
          'counts.json',
          'cred_type_counts.json',
@@ -31,54 +54,216 @@ FILES = ['config.json',
          'query_info.json',
          'unified_job_template_table.csv',
          'unified_jobs_table.csv']
+# tables generated per bundle, every other file comes from sample_data
+TABLES = ['events_table.csv', 'unified_jobs_table.csv']
+# files that are the same in every bundle
+STATIC_FILES = [filename for filename in FILES
+                if filename not in TABLES + ROLLUP_FILES + ['config.json']]
 
 
 JOB_LINE = (
-    '{job_id},37,job,1,organization_{org_id},{created},'
-    'template_name_{template_id},471,'
-    'scheduled,19,localhost,"",f,{status},f,{started},{finished},5.873,"",1\n'
+    '{job_id},37,job,{org_id},organization_{org_id},{created},'
+    'template_name_{template_id},{template_id},'
+    'scheduled,19,localhost,"",f,{status},{failed},{started},{finished},'
+    '5.873,"",1\n'
 )
-EVENT_LINE = (
-    '{id},{created},'
+# event columns that only depend on `event_id`
+EVENT_COLUMNS = (
     '374c9e9c-561c-4222-acd4-91189dd95b1d,"",verbose_{module_id},'
     'verbose_module_{module_id},{failed},'
     '{changed},"","","super_task_{module_id}",'
-    '"",{job_id},{host_id},"host_name_{host_id}"\n'
+    '"",'
 )
+EVENT_LINE = ''.join((
+    '{id},{created},', EVENT_COLUMNS,
+    '{job_id},{host_id},"host_name_{host_id}"\n'))
+# the constant columns of JOB_LINE and EVENT_COLUMNS, for the columnar tables
+JOB_CONSTANTS = {
+    'polymorphic_ctype_id': 37,
+    'model': 'job',
+    'launch_type': 'scheduled',
+    'schedule_id': 19,
+    'execution_node': 'localhost',
+    'controller_node': '',
+    'cancel_flag': False,
+    'elapsed': 5.873,
+    'job_explanation': '',
+    'instance_group_id': 1,
+}
+EVENT_CONSTANTS = {
+    'uuid': '374c9e9c-561c-4222-acd4-91189dd95b1d',
+    'parent_uuid': '',
+    'playbook': '',
+    'play': '',
+    'role': '',
+}
+# EVENT_LINE with `created` and EVENT_COLUMNS pre-rendered into one prefix
+EVENT_ROW = '%d,%s%d,%d,"host_name_%d"\n'
+# the batched events engine formats at most this many rows at once
+EVENT_BLOCK_SIZE = 10000
+# max number of row prefixes the events engine keeps across jobs
+EVENT_PREFIX_CACHE_SIZE = 1 << 20
+
+# size of the encoded chunks generated tables are streamed in
+CHUNK_SIZE = 1 << 20
+# rough bytes per cached event prefix, and per host, template and org
+# rolled up
+PREFIX_BYTES = 200
+HOST_BYTES = 70
+TEMPLATE_BYTES = 250
+ORG_BYTES = 150
+# max rows per segment when tables are generated by a process pool
+SEGMENT_ROWS = 1 << 20
+# the time of day of the timestamps unless a BundleConfig sets one
+DEFAULT_TIME_OF_DAY = datetime.time(1, 21)
+DAY = 24 * 3600
+# chunks of a streamed bundle generated ahead of the client
+STREAM_CHUNKS = int(os.environ.get('BUNDLE_STREAM_CHUNKS', 4))
+# seconds without the client reading before a stream is given up
+STREAM_TIMEOUT = float(os.environ.get('BUNDLE_STREAM_TIMEOUT', 60))
+# ids of the bundles this process is writing
+BUILDING = set()
+
 
-try:
-    KAFKA_PRODUCER = KafkaProducer(
+def kafka_producer():
+    return KafkaProducer(
         bootstrap_servers=['{0}:{1}'.format(KAFKA_HOST, KAFKA_PORT)],
+        linger_ms=KAFKA_LINGER_MS,
+        batch_size=KAFKA_BATCH_SIZE,
         value_serializer=lambda m: json.dumps(m).encode('ascii')
     )
-except Exception:
-    logger.exception('Failed to connect to: %s:%s', KAFKA_HOST, KAFKA_PORT)
+
+
+# connected in the background, see `KafkaConnection`
+KAFKA = KafkaConnection(kafka_producer, KAFKA_CONNECT_RETRY)
+NOTIFICATIONS = NotificationQueue(
+    functools.partial(KAFKA.get, timeout=KAFKA_CONNECT_WAIT), KAFKA_TOPIC,
+    max_in_flight=KAFKA_MAX_IN_FLIGHT,
+    retries=KAFKA_RETRIES,
+    backoff=KAFKA_RETRY_BACKOFF,
+    registry=BUNDLE_REGISTRY)
+
+
+@functools.lru_cache()
+def sample_data():
+    return {filename: pkgutil.get_data('api.core.sample_data', filename)
+            for filename in FILES}
+
+
+@functools.lru_cache(maxsize=8)
+def static_members(mtime=None):
+    """
+    STATIC_FILES as tar members compressed once per process
+
+    Without an `mtime` the members are dated when they are first needed.
+    """
+    if mtime is None:
+        mtime = time.time()
+    return {filename: compress_member(filename, sample_data()[filename], mtime)
+            for filename in STATIC_FILES}
+
+
+def encode_chunks(lines, header=b'', chunk_size=CHUNK_SIZE):
+    """Join and encode text lines into byte chunks of about `chunk_size`."""
+    buf = [header.decode()]
+    buffered = len(header)
+    for line in lines:
+        buf.append(line)
+        buffered += len(line)
+        if buffered >= chunk_size:
+            yield ''.join(buf).encode()
+            buf = []
+            buffered = 0
+    if buf:
+        yield ''.join(buf).encode()
+
+
+def digits_below(x):
+    """The number of digits of all the numbers from 0 up to `x`."""
+    total = max(x, 0)
+    power = 10
+    while power < x:
+        total += x - power
+        power *= 10
+    return total
+
+
+def digits_between(start, stop):
+    """The number of characters of the numbers from `start` up to `stop`."""
+    if start >= stop:
+        return 0
+    if start >= 0:
+        return digits_below(stop) - digits_below(start)
+    negative = min(stop, 0)
+    # a minus sign and the digits of -negative + 1 up to -start
+    digits = digits_below(1 - start) - digits_below(1 - negative)
+    return negative - start + digits + digits_between(0, stop)
+
+
+def day_of(reference_time, days_ago, time_of_day=None):
+    """
+    The minute of the timestamps of the jobs `days_ago` `reference_time`
+
+    `time_of_day` on that day, 01:21 by default, with the microseconds of
+    every timestamp. An aware reference time keeps its zone, a naive one
+    is local.
+    """
+    time_of_day = time_of_day or DEFAULT_TIME_OF_DAY
+    date = reference_time - datetime.timedelta(days=days_ago)
+    date = date.replace(hour=time_of_day.hour, minute=time_of_day.minute,
+                        second=0, microsecond=840210)
+    return date if date.tzinfo else date.astimezone()
 
 
 class TestDataGenerator:
+    def __init__(self):
+        self._date_time_cache = {}
+        # the clock every timestamp is relative to, set by `configure`
+        self.reference_time = None
+        self.time_of_day = None
+        # sample sequences of the columns with a distribution
+        self.samplers = {}
+        # counts of the rows generated so far, for the ROLLUP_FILES
+        self.rollup = Rollup()
+        # rows of the generated tables written so far by `generate_bundle`
+        self.rows_written = 0
+
+    def _day(self, days_ago):
+        """The time of day of the timestamps `days_ago` the reference time."""
+        return day_of(self.reference_time or datetime.datetime.now(),
+                      days_ago, self.time_of_day)
+
     def _default_date_time(self, days_ago=0, seconds=0):
-        date = datetime.datetime.now() - datetime.timedelta(days=days_ago)
-        date = date.replace(
-            hour=1, minute=21, second=seconds, microsecond=840210)
-        return date.astimezone().isoformat()
+        return self._day(days_ago).replace(second=seconds).isoformat()
+
+    def _date_times(self, days_ago):
+        """`_default_date_time` for `days_ago` and every second, cached."""
+        date_times = self._date_time_cache.get(days_ago)
+        if date_times is None:
+            day = self._day(days_ago)
+            date_times = [day.replace(second=seconds).isoformat()
+                          for seconds in range(60)]
+            self._date_time_cache[days_ago] = date_times
+        return date_times
 
     def read_sample_data(self):
-        return {filename: pkgutil.get_data('api.core.sample_data', filename)
-                for filename in FILES}
-
-    def write_data(self, temp_dir, data):
-        for filename in FILES:
-            with open(os.path.join(temp_dir, filename), 'wb') as f:
-                f.write(data[filename])
-
-    def build_tarfile(self, temp_dir, data_bundle):
-        os.chdir(temp_dir)
-        with tarfile.open(data_bundle, 'w:gz') as tar:
-            for filename in FILES:
-                tar.add(filename)
-        return data_bundle
+        return dict(sample_data())
+
+    def _sampled(self, column, i, default):
+        """The value of `column` for row `i`, or `default` if not skewed."""
+        sequence = self.samplers.get(column)
+        if sequence is None:
+            return default
+        return sequence[i % len(sequence)]
+
+    def _days_ago(self, job_id, spread_days_back, starting_day):
+        return self._sampled(
+            'day', job_id, job_id % spread_days_back) + starting_day
 
     def _job_status(self, i):
+        status = self.samplers.get('status')
+        if status:
+            return status[i % len(status)]
         if self.failed_job_threshold >= 0 and (
             i % 200 >= self.failed_job_threshold
         ):
@@ -94,32 +279,34 @@ class TestDataGenerator:
         else:
             return 'successful'
 
-    def generate_unified_jobs(
-            self, data, jobs_count, orgs_count,
+    def iter_unified_jobs(
+            self, job_ids, orgs_count,
             templates_count, spread_days_back, starting_day):
         """
-        Appends to the unified jobs table with a CSV data
+        Yields the rows of the unified jobs table as CSV lines
 
         - respecting scheme described in `sample_data/unified_jobs_table.csv`
         - repeating an sample entry `n` times
         """
-        output = io.StringIO()
-        output.write(data['unified_jobs_table.csv'].decode())
-        for job_id in range(jobs_count):
-            output.write(JOB_LINE.format(
-                created=self._default_date_time(
-                    (job_id % spread_days_back) + starting_day),
-                status=self._job_status(job_id),
-                started=self._default_date_time(
-                    (job_id % spread_days_back) + starting_day, 1),
-                finished=self._default_date_time(
-                    (job_id % spread_days_back) + starting_day, 5),
+        for job_id in job_ids:
+            date_times = self._date_times(
+                self._days_ago(job_id, spread_days_back, starting_day))
+            status = self._job_status(job_id)
+            template_id = self._sampled(
+                'template', job_id, job_id % templates_count)
+            org_id = self._sampled('org', job_id, job_id % orgs_count)
+            self.rollup.add_job(job_id, org_id, template_id, status,
+                                date_times[0], date_times[5])
+            yield JOB_LINE.format(
+                created=date_times[0],
+                status=status,
+                failed='t' if status in FAILED_STATUSES else 'f',
+                started=date_times[1],
+                finished=date_times[5],
                 job_id=job_id,
-                org_id=job_id % orgs_count,
-                template_id=job_id % templates_count
-            ))
-
-        data['unified_jobs_table.csv'] = output.getvalue().encode()
+                org_id=org_id,
+                template_id=template_id
+            )
 
     def _failed_event(self, i):
         # half of events will be failed
@@ -135,38 +322,213 @@ class TestDataGenerator:
         else:
             return 't'
 
-    def generate_job_events(
-            self, data, jobs_count, events_count, tasks_count,
+    def _event_columns(self, events_count, tasks_count):
+        """EVENT_COLUMNS of every position of an event in its job."""
+        return [
+            EVENT_COLUMNS.format(
+                failed=self._sampled(
+                    'failed', event_id, self._failed_event(event_id)),
+                changed=self._sampled(
+                    'changed', event_id, self._changed_event(event_id)),
+                module_id=self._sampled(
+                    'task', event_id, event_id % tasks_count)
+            )
+            for event_id in range(events_count)
+        ]
+
+    def iter_job_events(
+            self, job_ids, events_count, tasks_count,
             spread_days_back, starting_day, hosts_count):
         """
-        Appends to the events table with a CSV data
+        Yields the rows of the events table as blocks of CSV lines
 
         - respecting scheme described in `sample_data/events_table.csv`
         - repeating an sample entry `n` times
+
+        Everything from `created` up to `job_id` only depends on the day
+        and `event_id`, so these prefixes are rendered once per day and
+        each block is formatted with a single EVENT_ROW per line.
         """
-        output = io.StringIO()
-        output.write(data['events_table.csv'].decode())
-        for job_id in range(jobs_count):
-            for event_id in range(events_count):
-                id = (
-                    self.starting_event_id + ((events_count + 1) * job_id)
-                    + event_id
-                )
-
-                output.write(EVENT_LINE.format(
-                    created=self._default_date_time(
-                        job_id % spread_days_back + starting_day,
-                        event_id % 60
-                    ),
-                    failed=self._failed_event(event_id),
-                    changed=self._changed_event(event_id),
-                    job_id=job_id,
-                    id=id,
-                    module_id=event_id % tasks_count,
-                    host_id=id % hosts_count
-                ))
-
-        data['events_table.csv'] = output.getvalue().encode()
+        columns = self._event_columns(events_count, tasks_count)
+        hosts = self.samplers.get('host')
+        cache_prefixes = (
+            spread_days_back * events_count <= EVENT_PREFIX_CACHE_SIZE)
+        prefixes_by_day = {}
+        for job_id in job_ids:
+            days_ago = self._days_ago(job_id, spread_days_back, starting_day)
+            prefixes = prefixes_by_day.get(days_ago)
+            if prefixes is None:
+                date_times = self._date_times(days_ago)
+                prefixes = [
+                    '{},{}'.format(date_times[event_id % 60], column)
+                    for event_id, column in enumerate(columns)
+                ]
+                if cache_prefixes:
+                    prefixes_by_day[days_ago] = prefixes
+
+            first_id = self.starting_event_id + (events_count + 1) * job_id
+            for start in range(0, events_count, EVENT_BLOCK_SIZE):
+                stop = min(start + EVENT_BLOCK_SIZE, events_count)
+                ids = range(first_id + start, first_id + stop)
+                if hosts:
+                    host_ids = [hosts[id % SAMPLES] for id in ids]
+                else:
+                    host_ids = [id % hosts_count for id in ids]
+                self.rollup.add_hosts(host_ids, hosts_count)
+                yield ''.join(map(EVENT_ROW.__mod__, zip(
+                    ids, prefixes[start:stop], repeat(job_id),
+                    host_ids, host_ids)))
+
+    def _date_texts(self, days_ago):
+        """`_date_times` as fixed width strings, cached."""
+        date_texts = self._date_text_cache.get(days_ago)
+        if date_texts is None:
+            date_texts = [text(date_time, self.date_width)
+                          for date_time in self._date_times(days_ago)]
+            self._date_text_cache[days_ago] = date_texts
+        return date_texts
+
+    def column_dtypes(self, filename):
+        """The dtypes of the columns of one of the TABLES."""
+        widths = {column: width(value) for column, value in
+                  list(JOB_CONSTANTS.items()) + list(EVENT_CONSTANTS.items())}
+        widths.update({
+            'created': self.date_width,
+            'started': self.date_width,
+            'finished': self.date_width,
+            'status': width(*STATUSES),
+        })
+        widths.update(
+            (column, labels.width) for column, labels in self.labels.items())
+        return {column: '|S{}'.format(widths[column]) if dtype == 'S'
+                else dtype for column, dtype in COLUMNS[filename]}
+
+    def iter_job_columns(self, job_ids):
+        """
+        Yields the unified jobs table as `(rows, {column: bytes})` blocks
+
+        The rows of `iter_unified_jobs`, a block of every column at once.
+        """
+        dtypes = self.column_dtypes('unified_jobs_table.csv')
+        constants = {column: scalar(value, dtypes[column])
+                     for column, value in JOB_CONSTANTS.items()}
+        statuses = {status: scalar(status, dtypes['status'])
+                    for status in STATUSES}
+        orgs = self.labels['organization_name']
+        templates = self.labels['name']
+        for start in range(0, len(job_ids), COLUMN_BLOCK_ROWS):
+            ids = job_ids[start:start + COLUMN_BLOCK_ROWS]
+            org_ids, template_ids, job_statuses = [], [], []
+            created, started, finished = [], [], []
+            for job_id in ids:
+                days_ago = self._days_ago(
+                    job_id, self.spread_days_back, self.starting_day)
+                date_times = self._date_times(days_ago)
+                date_texts = self._date_texts(days_ago)
+                status = self._job_status(job_id)
+                template_id = self._sampled(
+                    'template', job_id, job_id % self.templates_count)
+                org_id = self._sampled(
+                    'org', job_id, job_id % self.orgs_count)
+                self.rollup.add_job(
+                    job_id, org_id, template_id, status,
+                    date_times[0], date_times[5])
+                org_ids.append(org_id)
+                template_ids.append(template_id)
+                job_statuses.append(status)
+                created.append(date_texts[0])
+                started.append(date_texts[1])
+                finished.append(date_texts[5])
+            block = {column: value * len(ids)
+                     for column, value in constants.items()}
+            block.update({
+                'id': ints(ids),
+                'organization_id': ints(org_ids),
+                'organization_name': b''.join(map(orgs.__getitem__, org_ids)),
+                'created': b''.join(created),
+                'name': b''.join(map(templates.__getitem__, template_ids)),
+                'unified_job_template_id': ints(template_ids),
+                'status': b''.join(map(statuses.__getitem__, job_statuses)),
+                'failed': bytes(status in FAILED_STATUSES
+                                for status in job_statuses),
+                'started': b''.join(started),
+                'finished': b''.join(finished),
+            })
+            yield len(ids), block
+
+    def iter_event_columns(self, job_ids):
+        """
+        Yields the events table as `(rows, {column: bytes})` blocks
+
+        The rows of `iter_job_events`. The columns that only depend on the
+        position of an event in its job are rendered once, `created` once
+        per day, the others a block of every column at once.
+        """
+        events_count = self.job_events
+        dtypes = self.column_dtypes('events_table.csv')
+        positions = range(events_count)
+        modules = [self._sampled('task', event_id,
+                                 event_id % self.tasks_count)
+                   for event_id in positions]
+        fixed = {column: scalar(value, dtypes[column]) * events_count
+                 for column, value in EVENT_CONSTANTS.items()}
+        fixed.update({
+            column: b''.join(map(self.labels[column].__getitem__, modules))
+            for column in ('event', 'task_action', 'task')})
+        fixed['failed'] = bytes(
+            self._sampled('failed', event_id,
+                          self._failed_event(event_id)) == 't'
+            for event_id in positions)
+        fixed['changed'] = bytes(
+            self._sampled('changed', event_id,
+                          self._changed_event(event_id)) == 't'
+            for event_id in positions)
+        sizes = {column: itemsize(dtypes[column])
+                 for column in list(fixed) + ['created']}
+        hosts = self.samplers.get('host')
+        host_names = self.labels['host_name']
+        cache_created = (
+            self.spread_days_back * events_count <= EVENT_PREFIX_CACHE_SIZE)
+        created_by_day = {}
+        for job_id in job_ids:
+            days_ago = self._days_ago(
+                job_id, self.spread_days_back, self.starting_day)
+            created = created_by_day.get(days_ago)
+            if created is None:
+                date_texts = self._date_texts(days_ago)
+                created = b''.join(date_texts[event_id % 60]
+                                   for event_id in positions)
+                if cache_created:
+                    created_by_day[days_ago] = created
+            job = ints([job_id])
+            first_id = self.starting_event_id + (events_count + 1) * job_id
+            for start in range(0, events_count, EVENT_BLOCK_SIZE):
+                stop = min(start + EVENT_BLOCK_SIZE, events_count)
+                ids = range(first_id + start, first_id + stop)
+                if hosts:
+                    host_ids = [hosts[id % SAMPLES] for id in ids]
+                else:
+                    host_ids = [id % self.hosts_count for id in ids]
+                self.rollup.add_hosts(host_ids, self.hosts_count)
+                block = {
+                    column: data[start * sizes[column]:stop * sizes[column]]
+                    for column, data in fixed.items()}
+                block.update({
+                    'id': ints(ids),
+                    'created': created[start * sizes['created']:
+                                       stop * sizes['created']],
+                    'job_id': job * (stop - start),
+                    'host_id': ints(host_ids),
+                    'host_name': b''.join(
+                        map(host_names.__getitem__, host_ids)),
+                })
+                yield stop - start, block
+
+    def iter_columns(self, filename, job_ids):
+        """The column blocks of one of the TABLES for the jobs `job_ids`."""
+        if filename == 'events_table.csv':
+            return self.iter_event_columns(job_ids)
+        return self.iter_job_columns(job_ids)
 
     def patch_config_json(self, bundle_config, data):
         config_json = json.loads(data['config.json'].decode())
@@ -178,61 +540,710 @@ class TestDataGenerator:
             config_json['tower_url_base'] = bundle_config.tower_url_base
         data['config.json'] = json.dumps(config_json).encode()
 
-    def generate_bundle(self, bundle_config):
-        start = time.time()
-        tasks_count = bundle_config.tasks_count or 100
-        orgs_count = bundle_config.orgs_count or 1
-        templates_count = bundle_config.templates_count or 1
-        spread_days_back = bundle_config.spread_days_back or 100
-        starting_day = bundle_config.starting_day or 1
-        hosts_count = bundle_config.hosts_count or 1
+    def configure(self, bundle_config):
+        self._date_time_cache = {}
+        self.rollup = Rollup()
+        # read the clock once, so a bundle never mixes reference days
+        self.reference_time = (
+            bundle_config.reference_time or datetime.datetime.now())
+        self.time_of_day = bundle_config.time_of_day
+        self.rows_written = 0
+        self.unified_jobs = bundle_config.unified_jobs
+        self.job_events = bundle_config.job_events
+        self.tasks_count = bundle_config.tasks_count or 100
+        self.orgs_count = bundle_config.orgs_count or 1
+        self.templates_count = bundle_config.templates_count or 1
+        self.spread_days_back = bundle_config.spread_days_back or 100
+        self.starting_day = bundle_config.starting_day or 1
+        if bundle_config.series and bundle_config.time_of_day:
+            # the windows of a series start today, see `next_in_series`
+            self.starting_day = bundle_config.starting_day
+        self.hosts_count = bundle_config.hosts_count or 1
         self.failed_job_threshold = bundle_config.failed_job_threshold or 100
         self.pending_job_threshold = bundle_config.pending_job_threshold or -1
         self.error_job_threshold = bundle_config.error_job_threshold or -1
         self.starting_event_id = bundle_config.starting_event_id or 0
+        self.starting_job_id = bundle_config.starting_job_id or 0
         self.failed_job_modulo = bundle_config.failed_job_modulo or 200
+        self.samplers = samplers(bundle_config)
+        # fixed width strings of the columnar tables
+        self._date_text_cache = {}
+        self.date_width = width(self._date_times(self.starting_day)[0])
+        self.labels = {
+            'event': Labels('verbose_', self.tasks_count),
+            'task_action': Labels('verbose_module_', self.tasks_count),
+            'task': Labels('super_task_', self.tasks_count),
+            'host_name': Labels('host_name_', self.hosts_count),
+            'organization_name': Labels('organization_', self.orgs_count),
+            'name': Labels('template_name_', self.templates_count),
+        }
 
-        temp_dir = tempfile.mkdtemp()
-        data = self.read_sample_data()
-        self.patch_config_json(bundle_config, data)
-        self.generate_unified_jobs(data, bundle_config.unified_jobs,
-                                   orgs_count, templates_count,
-                                   spread_days_back, starting_day)
-        self.generate_job_events(data, bundle_config.unified_jobs,
-                                 bundle_config.job_events, tasks_count,
-                                 spread_days_back, starting_day, hosts_count)
-
-        self.write_data(temp_dir, data)
-        data_bundle = os.path.join(
-            BUNDLE_DIR,
-            '{}_data_bundle.tar.gz'.format(bundle_config.bundle_uuid))
-        self.build_tarfile(temp_dir, data_bundle)
-        logger.info("bundle created: tempdir={}, bundle={}, size={}".format(
-                    temp_dir, data_bundle, os.stat(data_bundle).st_size))
+    def job_ids(self):
+        return range(self.starting_job_id,
+                     self.starting_job_id + self.unified_jobs)
+
+    def next_in_series(self, bundle_config, now=None):
+        """
+        The next bundle of the series of `bundle_config.install_uuid`
+
+        The first bundle of an install covers the history as configured,
+        every later one only the jobs and events after the previous bundle.
+        Their timestamps are at the minute `now` on the days since the
+        newest timestamp of the previous bundle, so time moves forward even
+        for bundles collected minutes apart. The window is reserved in the
+        registry right away so concurrent bundles never overlap.
+        """
+        if not bundle_config.install_uuid:
+            raise ValueError('Series bundles need an install_uuid')
+        if not now and bundle_config.reference_time:
+            now = bundle_config.reference_time.timestamp()
+        now = now or time.time()
+        event_span = bundle_config.job_events + 1
+
+        def next_window(cursor):
+            # the clock of the timestamps of the bundle and of the cursor
+            reference_time = bundle_config.reference_time or \
+                datetime.datetime.fromtimestamp(now).astimezone()
+            update = {'reference_time': reference_time, 'series': True}
+            if cursor:
+                # the end of the minute of the newest timestamps before, the
+                # collection time of cursors that didn't keep it
+                last = cursor['last_timestamp'] or cursor['last_collected']
+                minute = max(now // 60 * 60, last)
+                anchor = datetime.datetime.fromtimestamp(minute)
+                starting_job_id = cursor['last_job_id'] + 1
+                first_event_id = cursor['last_event_id'] + 1
+                update.update({
+                    'starting_job_id': starting_job_id,
+                    'starting_event_id': (
+                        first_event_id - event_span * starting_job_id),
+                    'reference_time': anchor.astimezone(),
+                    'time_of_day': anchor.time(),
+                    # today and the days back that are all after `last`
+                    'starting_day': 0,
+                    'spread_days_back': int((minute - last) // DAY) + 1,
+                })
+            config = bundle_config.copy(update=update)
+            first_event_id = config.starting_event_id + \
+                event_span * config.starting_job_id
+            newest = day_of(config.reference_time, config.starting_day,
+                            config.time_of_day)
+            return config, {
+                'last_job_id': (
+                    config.starting_job_id + config.unified_jobs - 1),
+                'last_event_id': (
+                    first_event_id + event_span * config.unified_jobs - 1),
+                'last_collected': now,
+                'last_timestamp': newest.timestamp() // 60 * 60 + 60,
+            }
+
+        return BUNDLE_REGISTRY.advance_series(
+            bundle_config.install_uuid, next_window)
+
+    def iter_table(self, filename, job_ids):
+        """Yields the rows of one of the TABLES for the jobs in `job_ids`."""
+        if filename == 'events_table.csv':
+            return self.iter_job_events(
+                job_ids, self.job_events, self.tasks_count,
+                self.spread_days_back, self.starting_day, self.hosts_count)
+        return self.iter_unified_jobs(
+            job_ids, self.orgs_count, self.templates_count,
+            self.spread_days_back, self.starting_day)
+
+    def table_size(self, filename, header=b''):
+        """
+        The size of one of the TABLES as CSV, without generating it
+
+        Rows only differ in the digits of their ids and in the values of
+        a few columns, which are summed up job by job.
+        """
+        if filename == 'events_table.csv':
+            return len(header) + self._events_size()
+        return len(header) + self._jobs_size()
+
+    def _jobs_size(self):
+        fixed = len(JOB_LINE.format(
+            job_id='', org_id='', created='', template_id='', status='',
+            failed='', started='', finished=''))
+        size = 0
+        for job_id in self.job_ids():
+            date_times = self._date_times(self._days_ago(
+                job_id, self.spread_days_back, self.starting_day))
+            org_id = self._sampled('org', job_id, job_id % self.orgs_count)
+            template_id = self._sampled(
+                'template', job_id, job_id % self.templates_count)
+            size += fixed + len(str(job_id)) + len(self._job_status(job_id))
+            size += 2 * len(str(org_id)) + 2 * len(str(template_id))
+            size += 1 + len(date_times[0]) + len(date_times[1])
+            size += len(date_times[5])
+        return size
+
+    def _events_size(self):
+        events_count = self.job_events
+        columns = sum(map(len, self._event_columns(
+            events_count, self.tasks_count)))
+        # an EVENT_ROW without the prefix and the digits of its values
+        fixed = len(EVENT_ROW % (0, '', 0, 0, 0)) - 4
+        hosts = self.samplers.get('host')
+        if hosts:
+            host_digits = [0] + list(accumulate(
+                len(str(host)) for host in hosts))
+        else:
+            host_digits = None
+
+        def hosts_below(event_id):
+            """The digits of the hosts of the events up to `event_id`."""
+            if host_digits:
+                cycles, rest = divmod(event_id, SAMPLES)
+                return cycles * host_digits[-1] + host_digits[rest]
+            cycles, rest = divmod(event_id, self.hosts_count)
+            return cycles * digits_below(self.hosts_count) + \
+                digits_below(rest)
+
+        size = 0
+        for job_id in self.job_ids():
+            date_times = self._date_times(self._days_ago(
+                job_id, self.spread_days_back, self.starting_day))
+            first_id = self.starting_event_id + (events_count + 1) * job_id
+            last_id = first_id + events_count
+            size += events_count * (
+                fixed + len(date_times[0]) + 1 + len(str(job_id)))
+            size += columns + digits_between(first_id, last_id)
+            size += 2 * (hosts_below(last_id) - hosts_below(first_id))
+        return size
+
+    def _count_rows(self, blocks):
+        for block in blocks:
+            yield block
+            self.rows_written += block.count('\n')
+
+    def _count_blocks(self, blocks):
+        for rows, block in blocks:
+            self.rows_written += rows
+            yield rows, block
+
+    def iter_segments(self, executor, workers, bundle_config, filename,
+                      header, compresslevel=9):
+        """
+        Yields `filename` as gzip compressed `(segment, size)` pairs
+
+        The rows are generated and compressed by `executor`, see
+        `iter_results`.
+        """
+        yield gzip_stored(header), len(header)
+        for segment, size in self.iter_results(
+                executor, workers, compress_segment, bundle_config,
+                filename, compresslevel):
+            yield segment, size
+
+    def iter_results(self, executor, workers, task, bundle_config, filename,
+                     compresslevel=9):
+        """
+        Yields the results of `task` for ranges of the jobs, in order
+
+        The jobs are split into ranges that are generated and compressed
+        by `executor`; at most two segments per worker are in flight. The
+        rows and rollup `task` returns last are tallied.
+        """
+        rows_per_job = 1
+        if filename == 'events_table.csv':
+            rows_per_job = max(self.job_events, 1)
+        step = max(1, min(
+            -(-self.unified_jobs // (workers * 4)),
+            SEGMENT_ROWS // rows_per_job))
+        job_ids = self.job_ids()
+        pending = deque()
+        for start in range(job_ids.start, job_ids.stop, step):
+            if len(pending) >= workers * 2:
+                yield self._segment_written(pending.popleft().result())
+            pending.append(executor.submit(
+                task, bundle_config, filename,
+                start, min(start + step, job_ids.stop), compresslevel))
+        while pending:
+            yield self._segment_written(pending.popleft().result())
+
+    def _segment_written(self, result):
+        rows, rollup = result[-2:]
+        self.rows_written += rows
+        self.rollup.merge(rollup)
+        return result[:-2]
+
+    def add_table(self, tar, stages, executor, workers, bundle_config,
+                  filename, header, compresslevel=9, sized=False):
+        """
+        Add one of the TABLES to `tar` as CSV
+
+        If `sized` its `table_size` is computed first, for streams.
+        """
+        size = self.table_size(filename, header) if sized else None
+        if executor:
+            # rows are generated and compressed by the workers
+            tar.add_segments(filename, stages.iter(
+                'segments', self.iter_segments(
+                    executor, workers, bundle_config, filename, header,
+                    compresslevel)), size)
+        else:
+            tar.add_stream(filename, stages.iter(
+                'rows', encode_chunks(
+                    self._count_rows(self.iter_table(
+                        filename, self.job_ids())),
+                    header=header)), size)
+
+    def add_columns(self, tar, stages, executor, workers, bundle_config,
+                    filename, compresslevel=9, dir=None):
+        """Add the columns of one of the TABLES to `tar`, see `columns`."""
+        with ColumnSpool(self.column_dtypes(filename), compresslevel,
+                         dir) as spool:
+            if executor:
+                for members, in stages.iter('segments', self.iter_results(
+                        executor, workers, compress_columns, bundle_config,
+                        filename, compresslevel)):
+                    spool.add_segment(members)
+            else:
+                spool.write(stages.iter('rows', self._count_blocks(
+                    self.iter_columns(filename, self.job_ids()))))
+            for column in spool.dtypes:
+                tar.add_segments(column_path(filename, column),
+                                 spool.segments(column))
+
+    def generate_bundle(self, bundle_config, executor=None):
+        """
+        Generate the bundle into BUNDLE_DIR and register it
+
+        The tables are generated by up to `workers` local processes, or
+        by an `executor` like `shards.ShardExecutor`.
+        """
+        start = time.time()
+        self.configure(bundle_config)
+        data_bundle = get_bundle_path(bundle_config.bundle_uuid)
+        workers = min(bundle_config.workers or 1, os.cpu_count() or 1)
+        if executor:
+            workers = executor.workers
+        # the day of the timestamps, even if the build ends on the next one
+        day = self.reference_time.date()
+        with metrics.IN_PROGRESS.track():
+            with metrics.timed('cache'):
+                cached = BUNDLE_CACHE.fetch(bundle_config, data_bundle, day)
+            if cached:
+                self.rows_written = self.unified_jobs * (self.job_events + 1)
+            else:
+                self.write_bundle(
+                    bundle_config, data_bundle, workers, executor)
+                with metrics.timed('cache'):
+                    BUNDLE_CACHE.store(bundle_config, data_bundle, day)
+            with metrics.timed('register'):
+                size = self.register_bundle(bundle_config)
+        logger.info(
+            "bundle created: bundle={}, size={}, workers={}, "
+            "compression={}, cached={}".format(
+                data_bundle, size, workers, bundle_config.compression,
+                cached))
         end = time.time()
         logger.info('handle_analytics_bundle time:%f', end - start)
-        shutil.rmtree(temp_dir)
+        record_bundle(end - start, self.rows_written, size, cached)
         return data_bundle
 
+    def register_bundle(self, bundle_config):
+        """Add a written bundle to the registry and return its size."""
+        size = os.stat(get_bundle_path(bundle_config.bundle_uuid)).st_size
+        BUNDLE_REGISTRY.add(
+            bundle_config.bundle_uuid, size, config_hash(bundle_config))
+        return size
+
+    def fan_out(self, template, tenants, installs_per_tenant=1):
+        """
+        Copies of the `template` BundleConfig for every tenant install
+
+        - `tenants` have a `tenant_id` and an optional `account_id`
+        - every copy gets its own uuids and a `starting_event_id` range
+          that doesn't overlap with the others
+        - with a `seed` the install and instance uuids are derived from it
+        """
+        event_span = template.unified_jobs * (template.job_events + 1)
+        rng = random.Random(template.seed) if template.seed is not None \
+            else None
+        configs = []
+        starting_event_id = template.starting_event_id
+        for tenant in tenants:
+            for _ in range(installs_per_tenant):
+                configs.append(template.copy(update={
+                    'bundle_uuid': uuid.uuid4().hex,
+                    'tenant_id': tenant.tenant_id,
+                    'account_id': (
+                        tenant.account_id or str(tenant.tenant_id)),
+                    'install_uuid': str(random_uuid(rng)),
+                    'instance_uuid': str(random_uuid(rng)),
+                    'starting_event_id': starting_event_id,
+                }))
+                starting_event_id += event_span
+        return configs
+
+    def generate_fleet(self, bundle_configs, workers=1):
+        """
+        Generate many bundles on one shared process pool
+
+        The static members are compressed before the pool forks, so all
+        workers reuse them. Bundles without a reference time are all
+        relative to the start of the fleet. Returns the aggregate
+        throughput.
+        """
+        start = time.time()
+        now = datetime.datetime.now()
+        static_members()
+        rows = size = 0
+        with ProcessPoolExecutor(max(workers, 1)) as executor:
+            pending = []
+            for bundle_config in bundle_configs:
+                day = (bundle_config.reference_time or now).date()
+                if BUNDLE_CACHE.fetch(
+                        bundle_config,
+                        get_bundle_path(bundle_config.bundle_uuid), day):
+                    pending.append((bundle_config, day, None))
+                else:
+                    pending.append((bundle_config, day, executor.submit(
+                        write_fleet_bundle, bundle_config.copy(update={
+                            'reference_time':
+                                bundle_config.reference_time or now}))))
+            for bundle_config, day, future in pending:
+                if future:
+                    rows += future.result()
+                    BUNDLE_CACHE.store(
+                        bundle_config,
+                        get_bundle_path(bundle_config.bundle_uuid), day)
+                bundle_size = self.register_bundle(bundle_config)
+                metrics.BUNDLES.inc(cached=str(future is None).lower())
+                metrics.BYTES.inc(bundle_size)
+                size += bundle_size
+        self.rows_written = rows
+        metrics.ROWS.inc(rows)
+        elapsed = time.time() - start
+        logger.info('fleet of %d bundles time:%f',
+                    len(bundle_configs), elapsed)
+        return {
+            'bundles': len(bundle_configs),
+            'rows': rows,
+            'bytes': size,
+            'seconds': elapsed,
+            'rows_per_second': rows / elapsed if elapsed else 0,
+            'bytes_per_second': size / elapsed if elapsed else 0,
+        }
+
+    def write_bundle(self, bundle_config, data_bundle, workers=1,
+                     executor=None):
+        # write next to the final path so listings never see a partial tar
+        partial_bundle = get_partial_bundle_path(bundle_config.bundle_uuid)
+        BUILDING.add(bundle_config.bundle_uuid)
+        try:
+            with open(partial_bundle, 'wb') as f:
+                self.write_tar(bundle_config, f, workers,
+                               spool_dir=os.path.dirname(partial_bundle),
+                               executor=executor)
+            os.replace(partial_bundle, data_bundle)
+        except BaseException:
+            if os.path.exists(partial_bundle):
+                os.remove(partial_bundle)
+            raise
+        finally:
+            BUILDING.discard(bundle_config.bundle_uuid)
+
+    def write_tar(self, bundle_config, fileobj, workers=1, stream=False,
+                  spool_dir=None, executor=None):
+        """
+        Write the bundle as a tar.gz into `fileobj`
+
+        The tables are generated by `executor` if given, which runs
+        `workers` tasks at once, or else by a pool of `workers` processes.
+
+        With `stream` the files that don't depend on the tables come first
+        and every member is sized up front, so `fileobj` doesn't have to be
+        seekable and the first bytes are written right away. Streams only
+        have CSV tables, the columns are spooled in `spool_dir`.
+        """
+        if stream and bundle_config.table_format != 'csv':
+            raise ValueError('Only CSV tables can be streamed')
+        compresslevel, threads = compression_settings(bundle_config)
+        data = self.read_sample_data()
+        self.patch_config_json(bundle_config, data)
+
+        pool = None
+        if executor is None and workers > 1:
+            executor = pool = ProcessPoolExecutor(workers)
+        # the workers generate their segments on the same clock
+        segment_config = bundle_config.copy(
+            update={'reference_time': self.reference_time})
+        mtime = None
+        if bundle_config.reference_time:
+            mtime = bundle_config.reference_time.timestamp()
+        csv = bundle_config.table_format != 'npy'
+        npy = bundle_config.table_format != 'csv'
+        # the tables before the ROLLUP_FILES, which are counted from them
+        filenames = TABLES + [filename for filename in FILES
+                              if filename not in TABLES]
+        if stream:
+            filenames = [filename for filename in FILES
+                         if filename not in TABLES + ROLLUP_FILES] \
+                + TABLES + ROLLUP_FILES
+        # the tables are generated while they are compressed and written,
+        # whatever isn't spent in generating or writing is compression
+        stages = metrics.Stages()
+        try:
+            with stages.remainder('compress'), \
+                    TarGzWriter(stages.writer(fileobj), compresslevel, mtime,
+                                threads=threads) as tar:
+                for filename in filenames:
+                    if filename == 'manifest.json' and npy:
+                        tar.add_bytes(filename, manifest(
+                            data[filename], TABLES, csv))
+                    elif filename in STATIC_FILES:
+                        tar.add_compressed(static_members(mtime)[filename])
+                    elif filename == 'unified_job_template_table.csv':
+                        size = None
+                        if stream:
+                            size = len(data[filename]) + sum(
+                                map(len, self.rollup.iter_templates()))
+                        tar.add_stream(filename, encode_chunks(
+                            self.rollup.iter_templates(),
+                            header=data[filename]), size)
+                    elif filename in ROLLUP_FILES:
+                        tar.add_bytes(filename, self.rollup.render(
+                            filename, data[filename], self))
+                    elif filename not in TABLES:
+                        tar.add_bytes(filename, data[filename])
+                    else:
+                        if csv:
+                            self.add_table(
+                                tar, stages, executor, workers,
+                                segment_config, filename, data[filename],
+                                compresslevel, stream)
+                        if npy:
+                            tally = self.rollup, self.rows_written
+                            if csv:
+                                self.rollup = Rollup()
+                            self.add_columns(
+                                tar, stages, executor, workers,
+                                segment_config, filename, compresslevel,
+                                spool_dir)
+                            if csv:
+                                # tallied from the CSV table already
+                                self.rollup, self.rows_written = tally
+        finally:
+            if pool:
+                pool.shutdown()
+            stages.record()
+
+    def stream_bundle(self, bundle_config, on_done=None):
+        """
+        The bundle as a `BundleStream` of chunks of its tar.gz
+
+        Nothing is written to BUNDLE_DIR; `on_done` gets the generator
+        once the generation ended, whether it completed or not.
+        """
+        self.configure(bundle_config)
+        workers = min(bundle_config.workers or 1, os.cpu_count() or 1)
+        return BundleStream(self, bundle_config, workers, on_done)
+
+
+class BundleStream:
+    """
+    Chunks of a bundle's tar.gz, generated by a thread while they are read.
+
+    The thread is at most STREAM_CHUNKS chunks ahead of the reader, a slow
+    reader slows the generation down and `close` stops it.
+    """
+
+    def __init__(self, generator, bundle_config, workers=1, on_done=None):
+        self.generator = generator
+        self.bundle_config = bundle_config
+        self.workers = workers
+        self.on_done = on_done
+        self.pipe = ChunkPipe(STREAM_CHUNKS, CHUNK_SIZE, STREAM_TIMEOUT)
+        self.thread = threading.Thread(
+            target=self._write, daemon=True,
+            name='stream-{}'.format(bundle_config.bundle_uuid))
+        self.thread.start()
+
+    def _write(self):
+        start = time.time()
+        try:
+            with metrics.IN_PROGRESS.track():
+                self.generator.write_tar(
+                    self.bundle_config, self.pipe, self.workers, stream=True)
+                self.pipe.close()
+            record_bundle(time.time() - start, self.generator.rows_written,
+                          self.pipe.written, False)
+        except BrokenPipeError:
+            logger.warning(
+                'Streaming bundle %s stopped, the client is gone or stalled',
+                self.bundle_config.bundle_uuid)
+        except Exception as e:
+            logger.exception('Streaming bundle %s failed',
+                             self.bundle_config.bundle_uuid)
+            try:
+                self.pipe.close(e)
+            except BrokenPipeError:
+                pass
+        finally:
+            if self.on_done:
+                self.on_done(self.generator)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.pipe)
+
+    def close(self):
+        self.pipe.cancel()
+
+
+def compress_columns(bundle_config, filename, start, stop, compresslevel=9):
+    """
+    Generate the columns of `filename` for jobs `start` to `stop`
+
+    Returns a gzip member per column with the row count and rollup.
+    """
+    generator = TestDataGenerator()
+    generator.configure(bundle_config)
+    members = compress_blocks(generator._count_blocks(generator.iter_columns(
+        filename, range(start, stop))), compresslevel)
+    return members, generator.rows_written, generator.rollup
+
+
+def random_uuid(rng=None):
+    """A version 4 uuid, drawn from `rng` if given."""
+    if rng is None:
+        return uuid.uuid4()
+    return uuid.UUID(int=rng.getrandbits(128), version=4)
+
+
+def write_fleet_bundle(bundle_config):
+    """Write a single bundle of a fleet, returns the rows generated."""
+    generator = TestDataGenerator()
+    generator.configure(bundle_config)
+    generator.write_bundle(
+        bundle_config, get_bundle_path(bundle_config.bundle_uuid))
+    return generator.rows_written
+
+
+def record_bundle(seconds, rows, size, cached):
+    cached = str(bool(cached)).lower()
+    metrics.BUNDLE_SECONDS.observe(seconds, cached=cached)
+    metrics.BUNDLES.inc(cached=cached)
+    metrics.ROWS.inc(rows)
+    metrics.BYTES.inc(size)
+
+
+def bundle_cost(bundle_config):
+    """
+    The rows, worker processes and rough peak memory of a bundle build
+
+    The rows are those of the tables and of the template table and
+    org_counts.json rolled up from them. The tables are streamed, so memory
+    only grows with the event prefixes every process caches and with the
+    hosts, templates and orgs rolled up.
+    """
+    jobs = bundle_config.unified_jobs
+    events = jobs * bundle_config.job_events
+    rollup = rollup_cost(bundle_config)
+    rows = jobs + events + rollup['rows']
+    cpus = min(bundle_config.workers or 1, os.cpu_count() or 1)
+    prefixes = bundle_config.job_events
+    days = bundle_config.spread_days_back or 100
+    if days * prefixes <= EVENT_PREFIX_CACHE_SIZE:
+        prefixes *= days
+    memory = (4 * CHUNK_SIZE + prefixes * PREFIX_BYTES) * cpus + \
+        rollup['memory']
+    if bundle_config.table_format != 'csv':
+        # a block of every column per process, spools of the whole table
+        memory += COLUMN_BLOCK_ROWS * PREFIX_BYTES * cpus + max(
+            len(columns) for columns in COLUMNS.values()) * SPOOL_SIZE
+    return {'rows': rows, 'cpus': cpus, 'memory': memory}
+
+
+def rollup_cost(bundle_config):
+    """
+    The rows and memory of the rollups of a bundle
+
+    The template table and org_counts.json have a row per template and
+    organization of the jobs, the rollup keeps those and the hosts.
+    """
+    jobs = bundle_config.unified_jobs
+    events = jobs * bundle_config.job_events
+    templates = min(bundle_config.templates_count or 1, jobs)
+    orgs = min(bundle_config.orgs_count or 1, jobs)
+    hosts = min(bundle_config.hosts_count or 1, events)
+    memory = hosts * HOST_BYTES + templates * TEMPLATE_BYTES + \
+        orgs * ORG_BYTES
+    return {'rows': templates + orgs, 'cpus': 1, 'memory': memory}
+
+
+def coordinator_cost(bundle_config):
+    """
+    `bundle_cost` of the coordinator of a sharded bundle
+
+    The nodes generate the tables, the coordinator merges their rollups
+    and writes the rollups and the shards it gets into the bundle.
+    """
+    cost = rollup_cost(bundle_config)
+    cost['memory'] += 4 * CHUNK_SIZE
+    return cost
+
+
+def fleet_cost(bundle_configs, workers):
+    """`bundle_cost` of a fleet built `workers` bundles at a time."""
+    costs = [bundle_cost(bundle_config) for bundle_config in bundle_configs]
+    cpus = max(1, min(workers, os.cpu_count() or 1, len(costs)))
+    return {
+        'rows': sum(cost['rows'] for cost in costs),
+        'cpus': cpus,
+        'memory': max([cost['memory'] for cost in costs] or [0]) * cpus,
+    }
+
+
+def compression_settings(bundle_config):
+    """The gzip level and compression threads for a bundle."""
+    if bundle_config.compression == 'store':
+        return 0, 1
+    threads = 1
+    if bundle_config.compression == 'pigz':
+        threads = bundle_config.compression_threads or os.cpu_count() or 1
+    return bundle_config.compression_level, threads
+
+
+def compress_segment(bundle_config, filename, start, stop, compresslevel=9):
+    """
+    Generate `filename` rows for jobs `start` to `stop` as a gzip member
+
+    Returns the member with the size, row count and rollup of its content.
+    """
+    generator = TestDataGenerator()
+    generator.configure(bundle_config)
+    compressor = SpanCompressor(compresslevel)
+    size = 0
+    segment = []
+    for chunk in encode_chunks(generator._count_rows(generator.iter_table(
+            filename, range(start, stop)))):
+        size += len(chunk)
+        segment.append(compressor.compress(chunk))
+    segment.append(compressor.flush())
+    return b''.join(segment), size, generator.rows_written, generator.rollup
+
 
 def get_bundle_path(bundle_id):
     return os.path.join(BUNDLE_DIR, '{}_data_bundle.tar.gz'.format(bundle_id))
 
 
+def get_partial_bundle_path(bundle_id):
+    return '{}.part'.format(get_bundle_path(bundle_id))
+
+
 def produce_upload_message(json_payload):
-    if not KAFKA_PRODUCER:
-        raise Exception("Kafka not available")
-    logger.debug("to producer.send()")
-    future = KAFKA_PRODUCER.send(KAFKA_TOPIC, json_payload)
-    try:
-        record_metadata = future.get(timeout=10)
-        logger.info("send future completed")
-        return record_metadata
-    except KafkaError:
-        logger.exception('Failed to send to kafka')
-        raise
+    """Queue the message, its delivery is tracked by NOTIFICATIONS."""
+    logger.debug("to NOTIFICATIONS.submit()")
+    return NOTIFICATIONS.submit(json_payload['request_id'], json_payload)
 
 
+@metrics.timed('notify')
 def notify_upload(url, account_id, tenant_id, bundle_id):
     logger.debug("notify_upload")
     bundle_file = get_bundle_path(bundle_id)
@@ -0,0 +1,258 @@
+"""
+Background cleanup of BUNDLE_DIR.
+
+Every BUNDLE_JANITOR_INTERVAL seconds a `Janitor` thread enforces the
+retention policy: bundles older than the max age of their state are
+removed, then the oldest ones, processed before unprocessed, until at most
+BUNDLE_MAX_COUNT bundles of BUNDLE_MAX_BYTES are left. Bundles being
+downloaded are skipped. Files are removed in batches of
+BUNDLE_JANITOR_BATCH with a pause in between, so a big purge doesn't take
+the disk away from the builds. Partial files (`.part`) of builds that died
+are removed once untouched for BUNDLE_PARTIAL_MAX_AGE_HOURS.
+
+Every gunicorn worker starts a janitor, but only the one holding the lock
+file in BUNDLE_DIR runs. The lock goes with the process holding it, the
+janitor of another worker takes over on its next run.
+"""
+import fcntl
+import os
+import threading
+import time
+
+from fastapi.logger import logger
+
+from . import generate_data, metrics
+from .archive import INDEX_SUFFIX
+from .generate_data import get_bundle_path
+from .registry import BUNDLE_REGISTRY
+
+# seconds between runs, 0 disables the janitor
+BUNDLE_JANITOR_INTERVAL = float(
+    os.environ.get('BUNDLE_JANITOR_INTERVAL', 300))
+# hours bundles are kept, 0 keeps them until one of the limits is hit
+BUNDLE_PROCESSED_MAX_AGE_HOURS = float(
+    os.environ.get('BUNDLE_PROCESSED_MAX_AGE_HOURS', 24))
+BUNDLE_UNPROCESSED_MAX_AGE_HOURS = float(
+    os.environ.get('BUNDLE_UNPROCESSED_MAX_AGE_HOURS', 0))
+# bundles and their total size kept in BUNDLE_DIR, 0 is unlimited
+BUNDLE_MAX_COUNT = int(os.environ.get('BUNDLE_MAX_COUNT', 0))
+BUNDLE_MAX_BYTES = int(os.environ.get('BUNDLE_MAX_BYTES', 0))
+# bundles removed at once, and the seconds to pause between batches
+BUNDLE_JANITOR_BATCH = int(os.environ.get('BUNDLE_JANITOR_BATCH', 100))
+BUNDLE_JANITOR_PAUSE = float(os.environ.get('BUNDLE_JANITOR_PAUSE', 0.1))
+# hours a partial file may go unmodified before it counts as abandoned,
+# builds of other processes can't be asked whether they still run
+BUNDLE_PARTIAL_MAX_AGE_HOURS = float(
+    os.environ.get('BUNDLE_PARTIAL_MAX_AGE_HOURS', 6))
+
+BUNDLE_SUFFIX = '_data_bundle.tar.gz'
+# the files kept next to a bundle
+SIDECAR_SUFFIXES = ('.done', INDEX_SUFFIX)
+PARTIAL_SUFFIX = '.part'
+LOCK_FILE = '.janitor.lock'
+
+
+def remove_bundle(bundle_id):
+    """
+    Remove a bundle, its `.done` marker and its index.
+
+    The bundle goes first: an interrupted removal leaves an orphaned
+    marker, which the janitor removes later, but never a processed bundle
+    without its marker that would look new.
+    """
+    data_bundle = get_bundle_path(bundle_id)
+    for path in [data_bundle] + [data_bundle + suffix
+                                 for suffix in SIDECAR_SUFFIXES]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def remove_bundles(bundles, reason, batch=BUNDLE_JANITOR_BATCH,
+                   pause=BUNDLE_JANITOR_PAUSE):
+    """
+    Remove `bundles` (registry entries) in batches, pausing between them.
+
+    Returns the number of bytes freed.
+    """
+    freed = 0
+    batch = batch or len(bundles) or 1
+    for start in range(0, len(bundles), batch):
+        if start and pause:
+            time.sleep(pause)
+        chunk = bundles[start:start + batch]
+        for bundle in chunk:
+            logger.info('Removing bundle %s (%s)', bundle['uuid'], reason)
+            remove_bundle(bundle['uuid'])
+        BUNDLE_REGISTRY.remove([bundle['uuid'] for bundle in chunk])
+        size = sum(bundle['size'] for bundle in chunk)
+        freed += size
+        metrics.JANITOR_REMOVED.inc(len(chunk), reason=reason)
+        metrics.JANITOR_FREED.inc(size)
+    return freed
+
+
+def orphaned_markers(bundle_dir):
+    """The `.done` markers and indexes in `bundle_dir` whose bundle is gone."""
+    markers = []
+    with os.scandir(bundle_dir) as entries:
+        for entry in entries:
+            bundle, _, suffix = entry.path.rpartition('.')
+            if bundle.endswith(BUNDLE_SUFFIX) and \
+                    '.' + suffix in SIDECAR_SUFFIXES:
+                markers.append((entry.path, bundle))
+    return [marker for marker, bundle in markers
+            if not os.path.exists(bundle)]
+
+
+def stale_partials(bundle_dir, max_age, now=None):
+    """
+    The `.part` files in `bundle_dir` unmodified for `max_age` seconds
+
+    Partial bundles this process is still writing are left out.
+    """
+    now = now or time.time()
+    partials = []
+    with os.scandir(bundle_dir) as entries:
+        for entry in entries:
+            if not entry.name.endswith(PARTIAL_SUFFIX):
+                continue
+            bundle_id = entry.name.partition(BUNDLE_SUFFIX)[0]
+            if bundle_id in generate_data.BUILDING:
+                continue
+            try:
+                if entry.is_file() and \
+                        entry.stat().st_mtime < now - max_age:
+                    partials.append(entry.path)
+            except FileNotFoundError:
+                # finished meanwhile
+                pass
+    return partials
+
+
+class Janitor:
+    def __init__(self, bundle_dir=None, interval=BUNDLE_JANITOR_INTERVAL,
+                 processed_max_age=BUNDLE_PROCESSED_MAX_AGE_HOURS * 3600,
+                 unprocessed_max_age=BUNDLE_UNPROCESSED_MAX_AGE_HOURS * 3600,
+                 max_count=BUNDLE_MAX_COUNT, max_bytes=BUNDLE_MAX_BYTES,
+                 batch=BUNDLE_JANITOR_BATCH, pause=BUNDLE_JANITOR_PAUSE,
+                 busy=None,
+                 partial_max_age=BUNDLE_PARTIAL_MAX_AGE_HOURS * 3600):
+        # BUNDLE_DIR by default
+        self.bundle_dir = bundle_dir
+        self.interval = interval
+        self.processed_max_age = processed_max_age
+        self.unprocessed_max_age = unprocessed_max_age
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.batch = batch
+        self.pause = pause
+        # bundle id -> True while it mustn't be removed
+        self.busy = busy or (lambda bundle_id: False)
+        # 0 keeps partial files
+        self.partial_max_age = partial_max_age
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        # open while this janitor holds the lock file
+        self.lock_file = None
+
+    def elect(self):
+        """Take the lock file unless the janitor of another process has it."""
+        if self.lock_file is None:
+            bundle_dir = self.bundle_dir or generate_data.BUNDLE_DIR
+            lock_file = open(os.path.join(bundle_dir, LOCK_FILE), 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return False
+            logger.info('Running the bundle janitor in process %d',
+                        os.getpid())
+            self.lock_file = lock_file
+        return True
+
+    def select(self, bundles, now=None):
+        """
+        `(expired, evicted)` bundles of the retention policy
+
+        Busy bundles are never selected but count against the limits.
+        """
+        now = now or time.time()
+        expired, kept = [], []
+        for bundle in bundles:
+            max_age = self.processed_max_age if bundle['processed'] \
+                else self.unprocessed_max_age
+            if max_age and bundle['created'] < now - max_age \
+                    and not self.busy(bundle['uuid']):
+                expired.append(bundle)
+            else:
+                kept.append(bundle)
+        count = len(kept)
+        size = sum(bundle['size'] for bundle in kept)
+        evicted = []
+        # processed ones first, oldest first
+        for bundle in sorted(kept, key=lambda bundle: (
+                not bundle['processed'], bundle['created'])):
+            if (not self.max_count or count <= self.max_count) and \
+                    (not self.max_bytes or size <= self.max_bytes):
+                break
+            if self.busy(bundle['uuid']):
+                continue
+            evicted.append(bundle)
+            count -= 1
+            size -= bundle['size']
+        return expired, evicted
+
+    def run_once(self, now=None):
+        """Enforce the retention policy, returns the bytes freed."""
+        with self.lock:
+            expired, evicted = self.select(BUNDLE_REGISTRY.list(), now)
+            freed = remove_bundles(expired, 'age', self.batch, self.pause)
+            freed += remove_bundles(evicted, 'limit', self.batch, self.pause)
+            bundle_dir = self.bundle_dir or generate_data.BUNDLE_DIR
+            markers = orphaned_markers(bundle_dir)
+            partials = []
+            if self.partial_max_age:
+                partials = stale_partials(
+                    bundle_dir, self.partial_max_age, now)
+            for path in markers + partials:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            metrics.JANITOR_REMOVED.inc(len(markers), reason='orphan')
+            metrics.JANITOR_REMOVED.inc(len(partials), reason='partial')
+            if expired or evicted or markers or partials:
+                logger.info(
+                    'Removed %d expired and %d evicted bundles (%d bytes), '
+                    '%d orphaned markers and %d partial files',
+                    len(expired), len(evicted), freed, len(markers),
+                    len(partials))
+            return freed
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                if self.elect():
+                    self.run_once()
+            except Exception:
+                logger.exception('Cleaning up bundles failed')
+
+    def start(self):
+        if not self.interval or self.thread is not None:
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self._run, name='bundle-janitor', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
@@ -0,0 +1,190 @@
+"""
+Bundle generation jobs running in a bounded background worker pool.
+
+The jobs run in the gunicorn worker that accepted them, their states are
+recorded in the registry so the other workers can report them as well.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi.logger import logger
+
+from .admission import ADMISSION, Rejected
+from .generate_data import (TestDataGenerator, bundle_cost, get_bundle_path,
+                            get_partial_bundle_path)
+from .registry import BUNDLE_REGISTRY
+
+BUNDLE_JOB_WORKERS = int(os.environ.get('BUNDLE_JOB_WORKERS', 2))
+# jobs allowed to wait for a worker before new ones are rejected
+BUNDLE_JOB_QUEUE = int(os.environ.get('BUNDLE_JOB_QUEUE', 20))
+# finished jobs whose status is kept around
+BUNDLE_JOB_HISTORY = int(os.environ.get('BUNDLE_JOB_HISTORY', 1000))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueFull(Rejected):
+    """Too many jobs pending, retry in `retry_after` seconds."""
+
+
+def bytes_written(bundle_uuid):
+    """The size of a bundle, or of the part of it written so far."""
+    for path in (get_bundle_path(bundle_uuid),
+                 get_partial_bundle_path(bundle_uuid)):
+        try:
+            return os.stat(path).st_size
+        except OSError:
+            pass
+    return 0
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class BundleJob:
+    def __init__(self, bundle_config, on_done=None):
+        self.bundle_config = bundle_config
+        self.bundle_uuid = bundle_config.bundle_uuid
+        self.on_done = on_done
+        self.generator = TestDataGenerator()
+        self.total_rows = bundle_config.unified_jobs * (
+            bundle_config.job_events + 1)
+        self.state = QUEUED
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    def set_state(self, state):
+        self.state = state
+        BUNDLE_REGISTRY.set_job(
+            self.bundle_uuid, state, self.total_rows, self.error)
+
+    def run(self):
+        try:
+            # queued until the build fits the budget of the process
+            with ADMISSION.admit(
+                    bundle_cost(self.bundle_config), block=True):
+                self.set_state(RUNNING)
+                self.started = time.time()
+                self.generator.generate_bundle(self.bundle_config)
+            if self.on_done:
+                self.on_done(self.bundle_config)
+            self.set_state(DONE)
+        except Exception as e:
+            logger.exception('Bundle %s failed', self.bundle_uuid)
+            self.error = str(e)
+            self.set_state(FAILED)
+        finally:
+            self.finished = time.time()
+
+    def eta(self):
+        """Seconds until the generation is expected to finish."""
+        if self.state == QUEUED or self.finished:
+            return None
+        rows_written = self.generator.rows_written
+        if not rows_written:
+            return None
+        elapsed = time.time() - self.started
+        return elapsed * (self.total_rows - rows_written) / rows_written
+
+    def status(self):
+        return {
+            'uuid': self.bundle_uuid,
+            'state': self.state,
+            'rows_written': self.generator.rows_written,
+            'total_rows': self.total_rows,
+            'bytes_written': bytes_written(self.bundle_uuid),
+            'eta_seconds': self.eta(),
+            'error': self.error,
+        }
+
+
+class BundleJobs:
+    """Queues `BundleJob`s on a thread pool and keeps track of them."""
+
+    def __init__(self, workers=BUNDLE_JOB_WORKERS, max_queued=BUNDLE_JOB_QUEUE,
+                 history=BUNDLE_JOB_HISTORY):
+        self.executor = ThreadPoolExecutor(workers)
+        self.max_pending = workers + max_queued
+        self.history = history
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def pending(self):
+        return sum(1 for job in self.jobs.values()
+                   if job.state in (QUEUED, RUNNING))
+
+    def submit(self, bundle_config, on_done=None, prepare=None):
+        """
+        Queue a `BundleJob` for `bundle_config`, QueueFull if there's no room
+
+        `prepare` turns `bundle_config` into the one to generate once the job
+        is accepted, so what it reserves (a window of a series) isn't lost
+        to a rejected job. A bundle over the whole budget is TooLarge.
+        """
+        ADMISSION.check(bundle_cost(bundle_config))
+        with self.lock:
+            if self.pending() >= self.max_pending:
+                raise QueueFull(
+                    'Too many bundles queued: {}'.format(self.max_pending),
+                    ADMISSION.retry_after())
+            if prepare:
+                bundle_config = prepare(bundle_config)
+            job = BundleJob(bundle_config, on_done)
+            job.set_state(QUEUED)
+            self.jobs[job.bundle_uuid] = job
+            self._forget_finished()
+        self.executor.submit(job.run)
+        return job
+
+    def _forget_finished(self):
+        finished = [uuid for uuid, job in self.jobs.items()
+                    if job.state in (DONE, FAILED)]
+        forgotten = finished[:max(len(finished) - self.history, 0)]
+        for uuid in forgotten:
+            del self.jobs[uuid]
+        if forgotten:
+            BUNDLE_REGISTRY.forget_jobs(forgotten)
+
+    def get(self, bundle_uuid):
+        return self.jobs.get(bundle_uuid)
+
+    def status(self, bundle_uuid):
+        """
+        The status of a job of this process or, without the progress of its
+        rows, of another one
+        """
+        job = self.get(bundle_uuid)
+        if job:
+            return job.status()
+        job = BUNDLE_REGISTRY.job(bundle_uuid)
+        if not job:
+            return None
+        state, error = job['state'], job['error']
+        if state in (QUEUED, RUNNING) and not process_alive(job['pid']):
+            state, error = FAILED, 'The worker process of the job is gone'
+        return {
+            'uuid': bundle_uuid,
+            'state': state,
+            'rows_written': job['total_rows'] if state == DONE else 0,
+            'total_rows': job['total_rows'],
+            'bytes_written': bytes_written(bundle_uuid),
+            'eta_seconds': None,
+            'error': error,
+        }
+
+
+BUNDLE_JOBS = BundleJobs()
@@ -0,0 +1,507 @@
+"""
+Prometheus metrics of bundle generation and the API.
+
+Metrics are kept in-process and rendered in the Prometheus text format by
+`/metrics`. The stages of the hot path (generating rows, compressing,
+writing, notifying) are timed with `Stages`; while a `trace()` is active
+they are also added to its per-request breakdown, which the middleware
+returns in a `Server-Timing` header for requests with `debug=true`.
+
+The gunicorn workers share their metrics through METRICS_DIR: each writes
+them there every METRICS_FLUSH_INTERVAL seconds, and the one serving
+`/metrics` adds up those of all the workers. Counters and histograms of
+workers that are gone still count, gauges only while their worker writes
+them.
+"""
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import parse_qs
+
+from fastapi.logger import logger
+
+if sys.version_info < (3, 7):
+    # the contextvars backport is thread-local, this makes it task-local
+    import aiocontextvars  # noqa: F401
+
+# seconds, from a small table up to a bundle of millions of events
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           120, 300, 600)
+
+BUNDLE_DIR = os.environ.get('BUNDLE_DIR', '/BUNDLE_DIR')
+# where the gunicorn workers share their metrics, '' keeps them per worker
+METRICS_DIR = os.environ.get(
+    'METRICS_DIR', os.path.join(BUNDLE_DIR, '.metrics')
+    if int(os.environ.get('WEB_CONCURRENCY', 1)) > 1 else '')
+# seconds between the workers writing their metrics to METRICS_DIR
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+
+TRACE = contextvars.ContextVar('trace', default=None)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\')
+                         .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels))
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{} has labels {}, got {}'.format(
+                self.name, self.labelnames, sorted(labels)))
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def state(self):
+        """The values as JSON data, for the other workers."""
+        with self.lock:
+            return [[key, list(value) if isinstance(value, list) else value]
+                    for key, value in self.values.items()]
+
+    def shared(self, live):
+        """Whether the values of another worker count."""
+        return True
+
+    def add(self, value, other):
+        return value + other
+
+    def merged(self, others=()):
+        """The values of this worker and the `(state, live)` of others."""
+        states = [self.state()] + [
+            state.get(self.name, []) for state, live in others
+            if self.shared(live)]
+        values = {}
+        for state in states:
+            for key, value in state:
+                key = tuple(tuple(label) for label in key)
+                values[key] = self.add(values[key], value) \
+                    if key in values else value
+        return values
+
+    def samples(self, values):
+        """`(suffix, labels, value)` of every sample."""
+        return [('', key, value) for key, value in values.items()]
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+    def render(self, others=()):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        for suffix, labels, value in self.samples(self.merged(others)):
+            lines.append('{}{}{} {}'.format(
+                self.name, suffix, format_labels(labels),
+                format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down.
+
+    `mode` is how the values of the workers add up: 'sum', 'min', or
+    'local' for values of the worker serving `/metrics` only.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, labelnames=(), mode='sum'):
+        super().__init__(name, help, labelnames)
+        self.mode = mode
+
+    def shared(self, live):
+        return live and self.mode != 'local'
+
+    def add(self, value, other):
+        return min(value, other) if self.mode == 'min' else value + other
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """Count the block as in progress while it runs."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # a count per bucket, then the sum
+                counts = self.values[key] = [0] * len(self.buckets) + [0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += value
+
+    def get(self, **labels):
+        """The count and sum of the observations."""
+        counts = self.values.get(self._key(labels))
+        return (counts[-2], counts[-1]) if counts else (0, 0)
+
+    def add(self, value, other):
+        return [count + other_count
+                for count, other_count in zip(value, other)]
+
+    def samples(self, values):
+        samples = []
+        for key, counts in values.items():
+            for bound, count in zip(self.buckets, counts):
+                samples.append(
+                    ('_bucket', key + (('le', format_value(bound)),), count))
+            samples.append(('_sum', key, counts[-1]))
+            samples.append(('_count', key, counts[-2]))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    The metrics of this worker, and of the others sharing `directory`.
+
+    Each worker writes its metrics to a file of its own every `interval`
+    seconds, a file older than 3 intervals belongs to a worker that is
+    gone.
+    """
+
+    def __init__(self, directory='', interval=METRICS_FLUSH_INTERVAL):
+        self.metrics = []
+        self.directory = directory
+        self.interval = interval
+        self.filename = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.add(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=(), mode='sum'):
+        return self.add(Gauge(name, help, labelnames, mode))
+
+    def histogram(self, name, help, labelnames=(), buckets=BUCKETS):
+        return self.add(Histogram(name, help, labelnames, buckets))
+
+    def flush(self):
+        """Write the metrics of this worker for the others."""
+        if not self.directory:
+            return
+        if self.filename is None:
+            # a new worker may get the pid of one that is gone
+            self.filename = '{}-{}.json'.format(
+                os.getpid(), uuid.uuid4().hex[:8])
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, self.filename)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({metric.name: metric.state()
+                       for metric in self.metrics}, f)
+        os.replace(path + '.tmp', path)
+
+    def others(self, now=None):
+        """`(state, live)` of the metrics written by the other workers."""
+        if not self.directory:
+            return []
+        stale = (now or time.time()) - 3 * self.interval
+        others = []
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if not entry.name.endswith('.json') or \
+                            entry.name == self.filename:
+                        continue
+                    try:
+                        live = entry.stat().st_mtime >= stale
+                        with open(entry.path) as f:
+                            others.append((json.load(f), live))
+                    except FileNotFoundError:
+                        pass
+        except FileNotFoundError:
+            pass
+        return others
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        self.flush()
+        others = self.others()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(others))
+        return '\n'.join(lines) + '\n'
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Writing the metrics failed')
+
+    def start(self):
+        if not self.directory or self.thread is not None:
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self._run, name='metrics-flush', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+            # the counters of this worker keep counting once it is gone
+            self.flush()
+
+
+METRICS = MetricsRegistry(METRICS_DIR)
+STAGE_SECONDS = METRICS.histogram(
+    'bundle_stage_seconds',
+    'Seconds spent per stage of generating and sending bundles',
+    ['stage'])
+BUNDLE_SECONDS = METRICS.histogram(
+    'bundle_generation_seconds', 'Seconds to generate a bundle', ['cached'])
+BUNDLES = METRICS.counter(
+    'bundles_generated_total', 'Bundles generated', ['cached'])
+ROWS = METRICS.counter(
+    'bundle_rows_total', 'Rows of the generated tables')
+BYTES = METRICS.counter(
+    'bundle_bytes_total', 'Bytes of the generated bundles')
+IN_PROGRESS = METRICS.gauge(
+    'bundle_generations_in_progress', 'Bundles being generated')
+NOTIFICATIONS = METRICS.counter(
+    'bundle_notifications_total', 'Kafka notifications by outcome',
+    ['state'])
+KAFKA_CONNECTED = METRICS.gauge(
+    'kafka_connected', 'Whether the Kafka producer is connected',
+    mode='min')
+DELIVERY_SECONDS = METRICS.histogram(
+    'bundle_notification_delivery_seconds',
+    'Seconds from queueing a Kafka notification until it is acknowledged')
+# set by the worker serving /metrics
+BUNDLE_DIR_BUNDLES = METRICS.gauge(
+    'bundle_dir_bundles', 'Bundles in BUNDLE_DIR', ['processed'],
+    mode='local')
+BUNDLE_DIR_BYTES = METRICS.gauge(
+    'bundle_dir_bundle_bytes', 'Size of the bundles in BUNDLE_DIR',
+    ['processed'], mode='local')
+BUNDLE_DIR_FREE = METRICS.gauge(
+    'bundle_dir_free_bytes', 'Free space on the BUNDLE_DIR file system',
+    mode='local')
+ADMISSION_RUNNING = METRICS.gauge(
+    'bundle_admission_running', 'Bundle builds admitted and running',
+    ['lane'])
+ADMISSION_WAITING = METRICS.gauge(
+    'bundle_admission_waiting', 'Bundle builds waiting for the budget',
+    ['lane'])
+ADMISSION_REJECTED = METRICS.counter(
+    'bundle_admission_rejected_total', 'Bundle builds rejected',
+    ['lane', 'reason'])
+JANITOR_REMOVED = METRICS.counter(
+    'bundle_janitor_removed_total',
+    'Bundles, orphaned markers and partial files removed from BUNDLE_DIR',
+    ['reason'])
+JANITOR_FREED = METRICS.counter(
+    'bundle_janitor_freed_bytes_total', 'Bytes of the removed bundles')
+REQUEST_SECONDS = METRICS.histogram(
+    'http_request_seconds', 'Seconds to handle an API request',
+    ['method', 'handler', 'status'])
+
+
+def record_stage(stage, seconds):
+    """Observe a stage and add it to the active trace, if any."""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    trace = TRACE.get()
+    if trace is not None:
+        trace[stage] += seconds
+
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def trace():
+    """Collect the seconds of the stages recorded in this context."""
+    breakdown = defaultdict(float)
+    token = TRACE.set(breakdown)
+    try:
+        yield breakdown
+    finally:
+        TRACE.reset(token)
+
+
+class Stages:
+    """
+    Seconds spent per stage of one streamed operation.
+
+    Rows, compression and writes of a bundle interleave chunk by chunk, so
+    each stage is summed over the operation and observed once by `record`.
+    """
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] += time.perf_counter() - start
+
+    def iter(self, stage, iterable):
+        """Yields from `iterable`, timing each step as `stage`."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.seconds[stage] += time.perf_counter() - start
+            yield item
+
+    @contextmanager
+    def remainder(self, stage):
+        """Time the block as `stage`, minus the other stages timed in it."""
+        others = sum(self.seconds.values())
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            nested = sum(self.seconds.values()) - others
+            self.seconds[stage] += time.perf_counter() - start - nested
+
+    def writer(self, fileobj, stage='write'):
+        return TimedWriter(fileobj, self, stage)
+
+    def record(self):
+        for stage, seconds in self.seconds.items():
+            record_stage(stage, seconds)
+
+
+class TimedWriter:
+    """A file object whose writes are timed as a stage."""
+
+    def __init__(self, fileobj, stages, stage):
+        self.fileobj = fileobj
+        self.stages = stages
+        self.stage = stage
+
+    def write(self, data):
+        with self.stages.time(self.stage):
+            return self.fileobj.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+def server_timing(breakdown):
+    return ', '.join('{};dur={:.1f}'.format(stage, seconds * 1000)
+                     for stage, seconds in breakdown.items())
+
+
+class MetricsMiddleware:
+    """
+    Times every request by handler and status code.
+
+    With `debug=true` in the query string the stages recorded while
+    handling the request are returned in a `Server-Timing` header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        query = parse_qs(scope.get('query_string', b'').decode())
+        debug = query.get('debug', ['false'])[-1].lower() in ('1', 'true')
+        start = time.perf_counter()
+        status = 500
+
+        with trace() as breakdown:
+            async def send_timed(message):
+                nonlocal status
+                if message['type'] == 'http.response.start':
+                    status = message['status']
+                    if debug:
+                        breakdown['total'] = time.perf_counter() - start
+                        message = dict(message, headers=list(
+                            message.get('headers', [])) + [(
+                                b'server-timing',
+                                server_timing(breakdown).encode())])
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_timed)
+            finally:
+                endpoint = scope.get('endpoint')
+                REQUEST_SECONDS.observe(
+                    time.perf_counter() - start,
+                    method=scope['method'],
+                    handler=getattr(endpoint, '__name__', 'unknown'),
+                    status=status)
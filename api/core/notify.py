@@ -0,0 +1,256 @@
+"""
+Asynchronous Kafka upload notifications.
+
+Payloads are queued and sent by a background thread; delivery results
+arrive through the producer future callbacks, so no request thread waits
+for a broker round trip. Batching itself is left to the producer
+(`linger_ms`/`batch_size`). Failed sends are retried with exponential
+backoff and the delivery state of every bundle is kept for the API, in
+the registry as well so every gunicorn worker can report it.
+
+The producer itself is created by a `KafkaConnection` thread, so neither
+importing the app nor a request ever waits for the broker to come up.
+"""
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi.logger import logger
+
+from . import metrics
+
+QUEUED = 'queued'
+SENDING = 'sending'
+DELIVERED = 'delivered'
+FAILED = 'failed'
+
+IDLE = 'idle'
+CONNECTING = 'connecting'
+CONNECTED = 'connected'
+CLOSED = 'closed'
+
+
+class KafkaConnection:
+    """
+    A producer created in the background on first use.
+
+    `get` never waits longer than its `timeout` and returns None while
+    the broker is unreachable; connecting is retried every
+    `retry_interval` seconds until it succeeds.
+    """
+
+    def __init__(self, factory, retry_interval=5):
+        # creates the producer, raises when the broker is unreachable
+        self.factory = factory
+        self.retry_interval = retry_interval
+        self.producer = None
+        self.attempts = 0
+        self.error = None
+        self.since = None
+        self.connected = threading.Event()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None and not self.stopped.is_set():
+                self.since = time.time()
+                self.thread = threading.Thread(
+                    target=self._run, name='kafka-connect', daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.attempts += 1
+            try:
+                producer = self.factory()
+            except Exception as e:
+                self.error = str(e)
+                logger.warning('Connecting to Kafka failed (attempt %d): %s',
+                               self.attempts, e)
+                self.stopped.wait(self.retry_interval)
+                continue
+            with self.lock:
+                if self.stopped.is_set():
+                    producer.close()
+                    return
+                self.producer = producer
+            self.error = None
+            self.since = time.time()
+            self.connected.set()
+            metrics.KAFKA_CONNECTED.set(1)
+            logger.info('Connected to Kafka after %d attempts', self.attempts)
+            return
+
+    def get(self, timeout=0):
+        """The producer, None unless it connects within `timeout`."""
+        self.start()
+        if timeout:
+            self.connected.wait(timeout)
+        return self.producer
+
+    def state(self):
+        if self.producer is not None:
+            state = CONNECTED
+        elif self.stopped.is_set():
+            state = CLOSED
+        elif self.thread is None:
+            state = IDLE
+        else:
+            state = CONNECTING
+        return {
+            'state': state,
+            'attempts': self.attempts,
+            'error': self.error,
+            'since': self.since,
+        }
+
+    def close(self, timeout=10):
+        self.stopped.set()
+        with self.lock:
+            producer, self.producer = self.producer, None
+        self.connected.clear()
+        metrics.KAFKA_CONNECTED.set(0)
+        if producer is not None:
+            producer.close(timeout)
+
+
+class NotificationQueue:
+    def __init__(self, producer, topic, max_in_flight=100, retries=3,
+                 backoff=0.5, history=10000, registry=None):
+        # callable returning the producer, or None when Kafka is down
+        self.producer = producer
+        self.topic = topic
+        self.retries = retries
+        self.backoff = backoff
+        self.history = history
+        # shares the deliveries with the other processes if given
+        self.registry = registry
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.queue = queue.Queue()
+        self.deliveries = OrderedDict()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name='kafka-notify', daemon=True)
+                self.thread.start()
+
+    def submit(self, bundle_id, payload):
+        """Queue the notification of a bundle and return its delivery."""
+        delivery = {
+            'bundle_id': bundle_id,
+            'state': QUEUED,
+            'attempts': 0,
+            'error': None,
+            'partition': None,
+            'offset': None,
+            'queued': time.time(),
+            'delivered': None,
+        }
+        forgotten = []
+        with self.lock:
+            self.deliveries.pop(bundle_id, None)
+            self.deliveries[bundle_id] = delivery
+            while len(self.deliveries) > self.history:
+                forgotten.append(self.deliveries.popitem(last=False)[0])
+            self._store(delivery)
+        if forgotten and self.registry:
+            self.registry.forget_deliveries(forgotten)
+        self._start()
+        self.queue.put((bundle_id, payload, 0))
+        return dict(delivery)
+
+    def _store(self, delivery):
+        # under the lock, so the registry gets the updates in order
+        if self.registry:
+            self.registry.set_delivery(delivery['bundle_id'], delivery)
+
+    def status(self, bundle_id):
+        with self.lock:
+            delivery = self.deliveries.get(bundle_id)
+            if delivery:
+                return dict(delivery)
+        if self.registry:
+            # sent by another process
+            return self.registry.delivery(bundle_id)
+        return None
+
+    def pending(self):
+        with self.lock:
+            return sum(1 for delivery in self.deliveries.values()
+                       if delivery['state'] in (QUEUED, SENDING))
+
+    def flush(self, timeout=10):
+        """Wait until every queued notification is delivered or failed."""
+        deadline = time.time() + timeout
+        while self.pending() and time.time() < deadline:
+            time.sleep(0.01)
+        return not self.pending()
+
+    def _run(self):
+        while True:
+            bundle_id, payload, attempts = self.queue.get()
+            self.in_flight.acquire()
+            self._send(bundle_id, payload, attempts + 1)
+
+    def _update(self, bundle_id, **values):
+        with self.lock:
+            delivery = self.deliveries.get(bundle_id)
+            if delivery:
+                delivery.update(values)
+                self._store(delivery)
+
+    def _send(self, bundle_id, payload, attempts):
+        """
+        Send a notification, the `attempts` one
+
+        The attempts travel with the notification, its delivery may be
+        gone from the history.
+        """
+        self._update(bundle_id, state=SENDING, attempts=attempts)
+        try:
+            producer = self.producer()
+            if not producer:
+                raise Exception("Kafka not available")
+            future = producer.send(self.topic, payload)
+        except Exception as e:
+            self._failed(bundle_id, payload, attempts, e)
+            return
+        future.add_callback(self._delivered, bundle_id)
+        future.add_errback(self._failed, bundle_id, payload, attempts)
+
+    def _delivered(self, bundle_id, record_metadata):
+        self.in_flight.release()
+        delivery = self.status(bundle_id)
+        if delivery:
+            metrics.DELIVERY_SECONDS.observe(
+                time.time() - delivery['queued'])
+        metrics.NOTIFICATIONS.inc(state=DELIVERED)
+        self._update(
+            bundle_id, state=DELIVERED, error=None,
+            partition=getattr(record_metadata, 'partition', None),
+            offset=getattr(record_metadata, 'offset', None),
+            delivered=time.time())
+        logger.info("notification delivered: bundle=%s", bundle_id)
+
+    def _failed(self, bundle_id, payload, attempts, error):
+        self.in_flight.release()
+        self._update(bundle_id, error=str(error))
+        if attempts <= self.retries:
+            self._update(bundle_id, state=QUEUED)
+            retry = threading.Timer(
+                self.backoff * 2 ** (attempts - 1),
+                self.queue.put, args=[(bundle_id, payload, attempts)])
+            retry.daemon = True
+            retry.start()
+        else:
+            self._update(bundle_id, state=FAILED)
+            metrics.NOTIFICATIONS.inc(state=FAILED)
+            logger.error('Failed to send notification for %s: %s',
+                         bundle_id, error)
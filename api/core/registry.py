@@ -0,0 +1,291 @@
+"""
+Persistent index of the bundles in BUNDLE_DIR.
+
+Kept in a SQLite database next to the bundles so listings don't have to
+scan the directory. It is updated as bundles are created, downloaded
+with `done=True` and removed, and rebuilt from the directory on startup.
+It also keeps what the gunicorn workers share: the cursors of bundle
+series, the states of async bundle jobs, the deliveries of Kafka
+notifications and the downloads in flight.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+BUNDLE_DIR = os.environ.get('BUNDLE_DIR', '/BUNDLE_DIR')
+BUNDLE_REGISTRY_PATH = os.environ.get(
+    'BUNDLE_REGISTRY_PATH', os.path.join(BUNDLE_DIR, '.registry.sqlite3'))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS bundles (
+    uuid TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    config_hash TEXT,
+    created REAL NOT NULL,
+    processed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS bundles_by_state ON bundles (processed, created);
+CREATE TABLE IF NOT EXISTS series (
+    install_uuid TEXT PRIMARY KEY,
+    last_job_id INTEGER NOT NULL,
+    last_event_id INTEGER NOT NULL,
+    last_collected REAL NOT NULL,
+    bundles INTEGER NOT NULL,
+    last_timestamp REAL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    uuid TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    total_rows INTEGER NOT NULL,
+    pid INTEGER NOT NULL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS notifications (
+    bundle_id TEXT PRIMARY KEY,
+    delivery TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS downloads (
+    uuid TEXT NOT NULL,
+    pid INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS downloads_by_uuid ON downloads (uuid);
+'''
+COLUMNS = ('uuid', 'size', 'config_hash', 'created', 'processed')
+SERIES_COLUMNS = ('install_uuid', 'last_job_id', 'last_event_id',
+                  'last_collected', 'last_timestamp', 'bundles')
+JOB_COLUMNS = ('uuid', 'state', 'total_rows', 'pid', 'error')
+
+
+class BundleRegistry:
+    def __init__(self, path=BUNDLE_REGISTRY_PATH):
+        self.path = path
+        self.db = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.db is None:
+            db = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False)
+            with db:
+                # the gunicorn workers start at once, one of them creates
+                # the schema while the others wait
+                db.execute('BEGIN IMMEDIATE')
+                for statement in SCHEMA.split(';'):
+                    if statement.strip():
+                        db.execute(statement)
+                columns = [row[1] for row in db.execute(
+                    'PRAGMA table_info(series)')]
+                if 'last_timestamp' not in columns:
+                    # a registry from before series kept their timestamps
+                    db.execute(
+                        'ALTER TABLE series ADD COLUMN last_timestamp REAL')
+            self.db = db
+        return self.db
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            db = self._connect()
+            with db:
+                return db.execute(sql, params).fetchall()
+
+    def add(self, uuid, size, config_hash=None, created=None):
+        self.execute(
+            'INSERT OR REPLACE INTO bundles '
+            '(uuid, size, config_hash, created, processed) '
+            'VALUES (?, ?, ?, ?, 0)',
+            (uuid, size, config_hash, created or time.time()))
+
+    def mark_processed(self, uuid):
+        self.execute(
+            'UPDATE bundles SET processed = 1 WHERE uuid = ?', (uuid,))
+
+    def remove(self, uuids):
+        with self.lock:
+            db = self._connect()
+            with db:
+                db.executemany(
+                    'DELETE FROM bundles WHERE uuid = ?',
+                    [(uuid,) for uuid in uuids])
+                db.executemany(
+                    'DELETE FROM downloads WHERE uuid = ?',
+                    [(uuid,) for uuid in uuids])
+
+    def get(self, uuid):
+        rows = self.execute(
+            'SELECT {} FROM bundles WHERE uuid = ?'.format(
+                ', '.join(COLUMNS)), (uuid,))
+        return dict(zip(COLUMNS, rows[0])) if rows else None
+
+    def list(self, processed=None, offset=0, limit=None):
+        """Bundles oldest first, optionally only (un)processed ones."""
+        sql = 'SELECT {} FROM bundles'.format(', '.join(COLUMNS))
+        params = []
+        if processed is not None:
+            sql += ' WHERE processed = ?'
+            params.append(int(processed))
+        sql += ' ORDER BY created, uuid LIMIT ? OFFSET ?'
+        params += [-1 if limit is None else limit, offset]
+        return [dict(zip(COLUMNS, row)) for row in self.execute(sql, params)]
+
+    def usage(self):
+        """Number and total size of the bundles by `processed` state."""
+        rows = self.execute(
+            'SELECT processed, COUNT(*), COALESCE(SUM(size), 0) '
+            'FROM bundles GROUP BY processed')
+        usage = {False: (0, 0), True: (0, 0)}
+        usage.update(
+            (bool(processed), (count, size))
+            for processed, count, size in rows)
+        return usage
+
+    def series(self, install_uuid):
+        """The cursor of the bundle series of an install."""
+        rows = self.execute(
+            'SELECT {} FROM series WHERE install_uuid = ?'.format(
+                ', '.join(SERIES_COLUMNS)), (install_uuid,))
+        return dict(zip(SERIES_COLUMNS, rows[0])) if rows else None
+
+    def advance_series(self, install_uuid, next_window):
+        """
+        Move the cursor of a series to its next bundle atomically.
+
+        `next_window` gets the current cursor (None for a new series) and
+        returns its result with the `last_job_id`, `last_event_id`,
+        `last_collected` and `last_timestamp` of the new cursor. The
+        database stays locked from reading the cursor until the new one is
+        written, so other processes never read the same cursor.
+        """
+        with self.lock:
+            db = self._connect()
+            with db:
+                db.execute('BEGIN IMMEDIATE')
+                rows = db.execute(
+                    'SELECT {} FROM series WHERE install_uuid = ?'.format(
+                        ', '.join(SERIES_COLUMNS)),
+                    (install_uuid,)).fetchall()
+                cursor = dict(zip(SERIES_COLUMNS, rows[0])) if rows else None
+                result, values = next_window(cursor)
+                db.execute(
+                    'INSERT OR REPLACE INTO series ({}) '
+                    'VALUES (?, ?, ?, ?, ?, ?)'.format(
+                        ', '.join(SERIES_COLUMNS)),
+                    (install_uuid, values['last_job_id'],
+                     values['last_event_id'], values['last_collected'],
+                     values['last_timestamp'],
+                     cursor['bundles'] + 1 if cursor else 1))
+        return result
+
+    def set_job(self, uuid, state, total_rows, error=None):
+        """Record the state of an async bundle job of this process."""
+        self.execute(
+            'INSERT OR REPLACE INTO jobs ({}) VALUES (?, ?, ?, ?, ?)'.format(
+                ', '.join(JOB_COLUMNS)),
+            (uuid, state, total_rows, os.getpid(), error))
+
+    def job(self, uuid):
+        rows = self.execute(
+            'SELECT {} FROM jobs WHERE uuid = ?'.format(
+                ', '.join(JOB_COLUMNS)), (uuid,))
+        return dict(zip(JOB_COLUMNS, rows[0])) if rows else None
+
+    def forget_jobs(self, uuids):
+        with self.lock:
+            db = self._connect()
+            with db:
+                db.executemany(
+                    'DELETE FROM jobs WHERE uuid = ?',
+                    [(uuid,) for uuid in uuids])
+
+    def set_delivery(self, bundle_id, delivery):
+        """Record the delivery of the notification of a bundle."""
+        self.execute(
+            'INSERT OR REPLACE INTO notifications (bundle_id, delivery) '
+            'VALUES (?, ?)', (bundle_id, json.dumps(delivery)))
+
+    def delivery(self, bundle_id):
+        rows = self.execute(
+            'SELECT delivery FROM notifications WHERE bundle_id = ?',
+            (bundle_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def forget_deliveries(self, bundle_ids):
+        with self.lock:
+            db = self._connect()
+            with db:
+                db.executemany(
+                    'DELETE FROM notifications WHERE bundle_id = ?',
+                    [(bundle_id,) for bundle_id in bundle_ids])
+
+    def add_download(self, uuid, limit, alive):
+        """
+        Record a download of a bundle by this process.
+
+        Downloads of processes that aren't `alive` any more are dropped.
+        Returns the id of the download, or None if `limit` downloads of the
+        bundle are in flight.
+        """
+        with self.lock:
+            db = self._connect()
+            with db:
+                db.execute('BEGIN IMMEDIATE')
+                rows = db.execute(
+                    'SELECT rowid, pid FROM downloads WHERE uuid = ?',
+                    (uuid,)).fetchall()
+                gone = [(rowid,) for rowid, pid in rows if not alive(pid)]
+                db.executemany('DELETE FROM downloads WHERE rowid = ?', gone)
+                if len(rows) - len(gone) >= limit:
+                    return None
+                return db.execute(
+                    'INSERT INTO downloads (uuid, pid) VALUES (?, ?)',
+                    (uuid, os.getpid())).lastrowid
+
+    def remove_download(self, download_id):
+        self.execute('DELETE FROM downloads WHERE rowid = ?', (download_id,))
+
+    def downloads(self, uuid):
+        """The pids of the processes downloading a bundle."""
+        return [pid for pid, in self.execute(
+            'SELECT pid FROM downloads WHERE uuid = ?', (uuid,))]
+
+    def rebuild(self, bundle_dir, tars, processed):
+        """
+        Sync the registry with the bundles found in `bundle_dir`.
+
+        `tars` and `processed` are the uuids of unprocessed and processed
+        bundles. Known config hashes are kept, entries without a bundle
+        file are dropped.
+        """
+        rows = []
+        for uuid, state in [(uuid, 0) for uuid in tars] + \
+                [(uuid, 1) for uuid in processed]:
+            path = os.path.join(
+                bundle_dir, '{}_data_bundle.tar.gz'.format(uuid))
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            rows.append((uuid, stat.st_size, stat.st_mtime, state))
+        with self.lock:
+            db = self._connect()
+            with db:
+                db.execute('CREATE TEMP TABLE found ('
+                           'uuid TEXT PRIMARY KEY, size INTEGER, '
+                           'created REAL, processed INTEGER)')
+                db.executemany(
+                    'INSERT OR REPLACE INTO found VALUES (?, ?, ?, ?)', rows)
+                db.execute(
+                    'DELETE FROM bundles WHERE uuid NOT IN '
+                    '(SELECT uuid FROM found)')
+                db.execute(
+                    'INSERT OR REPLACE INTO bundles '
+                    '(uuid, size, config_hash, created, processed) '
+                    'SELECT found.uuid, found.size, bundles.config_hash, '
+                    'found.created, found.processed FROM found '
+                    'LEFT JOIN bundles ON bundles.uuid = found.uuid')
+                db.execute('DROP TABLE found')
+        return len(rows)
+
+
+BUNDLE_REGISTRY = BundleRegistry()
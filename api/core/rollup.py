@@ -0,0 +1,150 @@
+"""
+Rollups of the generated tables.
+
+The counts JSON files and the unified job template table of a bundle
+describe the generated jobs and events. They are tallied by `Rollup` as
+the rows are generated, so the tables never have to be read again, and
+the rollups of segments generated by different workers are merged. Only
+the templates and organizations of the generated jobs are listed, so the
+rollups never outgrow the tables.
+"""
+import json
+from collections import Counter
+
+ROLLUP_FILES = ['counts.json',
+                'inventory_counts.json',
+                'job_counts.json',
+                'job_instance_counts.json',
+                'org_counts.json',
+                'unified_job_template_table.csv']
+# every generated job is a scheduled run on this node
+LAUNCH_TYPE = 'scheduled'
+EXECUTION_NODE = 'localhost'
+INVENTORY_ID = '1'
+TEMPLATE_LINE = (
+    '{id},35,jobtemplate,{created},{modified},1,1,template_name_{id},"",'
+    '{last_job_id},{last_job_failed},{last_job_run},"","",{status}\n'
+)
+# statuses of jobs that are `failed`
+FAILED_STATUSES = ('failed', 'error')
+
+
+class Rollup:
+    def __init__(self):
+        self.statuses = Counter()
+        # template id: [first created, last job id, its status and finish]
+        self.templates = {}
+        self.orgs = set()
+        self.hosts = set()
+
+    def add_job(self, job_id, org_id, template_id, status, created,
+                finished):
+        self.statuses[status] += 1
+        self.orgs.add(org_id)
+        self._add_template(template_id, created, job_id, status, finished)
+
+    def _add_template(self, template_id, created, job_id, status, finished):
+        template = self.templates.get(template_id)
+        if template is None:
+            self.templates[template_id] = [created, job_id, status, finished]
+            return
+        if created < template[0]:
+            template[0] = created
+        if job_id > template[1]:
+            template[1:] = [job_id, status, finished]
+
+    def add_hosts(self, host_ids, hosts_count):
+        if len(self.hosts) < hosts_count:
+            self.hosts.update(host_ids)
+
+    def merge(self, other):
+        """Add the rollup of another part of the same bundle."""
+        self.statuses.update(other.statuses)
+        for template_id, template in other.templates.items():
+            self._add_template(template_id, *template)
+        self.orgs.update(other.orgs)
+        self.hosts.update(other.hosts)
+
+    def state(self):
+        """The rollup as JSON data, for `from_state` on another node."""
+        return {
+            'statuses': dict(self.statuses),
+            'templates': [[template_id] + template for template_id, template
+                          in self.templates.items()],
+            'orgs': sorted(self.orgs),
+            'hosts': sorted(self.hosts),
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        rollup = cls()
+        rollup.statuses.update(state['statuses'])
+        rollup.templates = {template[0]: list(template[1:])
+                            for template in state['templates']}
+        rollup.orgs = set(state['orgs'])
+        rollup.hosts = set(state['hosts'])
+        return rollup
+
+    def jobs(self):
+        return sum(self.statuses.values())
+
+    def counts(self, sample, generator):
+        counts = json.loads(sample)
+        pending = self.statuses.get('pending', 0)
+        counts.update({
+            'organization': len(self.orgs),
+            'inventory': 1,
+            'inventories': {'smart': 0, 'normal': 1},
+            'job_template': len(self.templates),
+            'host': generator.hosts_count,
+            'unified_job': self.jobs(),
+            'active_host_count': len(self.hosts),
+            'running_jobs': 0,
+            'pending_jobs': pending,
+        })
+        return counts
+
+    def job_counts(self):
+        return {
+            'total_jobs': self.jobs(),
+            'status': dict(self.statuses),
+            'launch_type': {LAUNCH_TYPE: self.jobs()},
+        }
+
+    def render(self, filename, sample, generator):
+        """The content of one of the ROLLUP_FILES, but the template table."""
+        if filename == 'counts.json':
+            content = self.counts(sample, generator)
+        elif filename == 'inventory_counts.json':
+            content = {INVENTORY_ID: {
+                'name': 'inventory_{}'.format(INVENTORY_ID),
+                'kind': '',
+                'hosts': len(self.hosts),
+                'sources': 0,
+            }}
+        elif filename == 'job_counts.json':
+            content = self.job_counts()
+        elif filename == 'job_instance_counts.json':
+            job_counts = self.job_counts()
+            del job_counts['total_jobs']
+            content = {EXECUTION_NODE: job_counts}
+        elif filename == 'org_counts.json':
+            content = {
+                str(org_id): {'name': 'organization_{}'.format(org_id),
+                              'users': 0, 'teams': 0}
+                for org_id in sorted(self.orgs)
+            }
+        else:
+            raise ValueError('Not a rollup: {}'.format(filename))
+        return json.dumps(content).encode()
+
+    def iter_templates(self):
+        """Yields the rows of the unified job template table."""
+        for template_id in sorted(self.templates):
+            first_created, job_id, status, finished = \
+                self.templates[template_id]
+            yield TEMPLATE_LINE.format(
+                id=template_id, created=first_created,
+                modified=finished, last_job_id=job_id,
+                last_job_failed='t' if status in FAILED_STATUSES else 'f',
+                last_job_run=finished, status=status)
@@ -0,0 +1,184 @@
+"""
+Bundle generation sharded over several instances of this service.
+
+A coordinator writes a bundle as it does with a process pool, but a
+`ShardExecutor` hands the ranges of jobs to other nodes over HTTP
+(`POST /shards`). Every node generates and compresses its shard with
+`compress_segment` or `compress_columns`, just like a local worker, and
+sends back the gzip members with their row count and rollup; the
+coordinator writes them into the one bundle in order.
+"""
+import json
+import os
+import struct
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi.logger import logger
+
+from .generate_data import compress_columns, compress_segment
+from .rollup import Rollup
+
+# base URLs of the nodes generating shards, comma separated
+BUNDLE_SHARD_NODES = [
+    node.strip() for node in
+    os.environ.get('BUNDLE_SHARD_NODES', '').split(',') if node.strip()]
+# shards in flight per node
+BUNDLE_SHARD_CONCURRENCY = int(os.environ.get('BUNDLE_SHARD_CONCURRENCY', 2))
+# seconds a node may take for a shard
+BUNDLE_SHARD_TIMEOUT = float(os.environ.get('BUNDLE_SHARD_TIMEOUT', 600))
+# attempts per shard, on the next node each time
+BUNDLE_SHARD_ATTEMPTS = int(os.environ.get('BUNDLE_SHARD_ATTEMPTS', 3))
+# sent by the coordinator and required by the nodes if set
+BUNDLE_SHARD_TOKEN = os.environ.get('BUNDLE_SHARD_TOKEN', '')
+
+TASKS = {'segment': compress_segment, 'columns': compress_columns}
+# nodes too busy for a shard answer 429, the shard is retried later
+BUSY = (429,)
+
+
+class ShardError(Exception):
+    pass
+
+
+def encode_result(task, result):
+    """
+    The result of a shard `task` as a response body
+
+    A length prefixed JSON header with the rows, the rollup and the sizes
+    of the gzip members, which follow it.
+    """
+    if task == 'segment':
+        segment, size, rows, rollup = result
+        parts = [('', segment, size)]
+    else:
+        members, rows, rollup = result
+        parts = [(column, member, size)
+                 for column, (member, size) in members.items()]
+    header = json.dumps({
+        'rows': rows,
+        'rollup': rollup.state(),
+        'parts': [[name, len(data), size] for name, data, size in parts],
+    }).encode()
+    body = [struct.pack('>I', len(header)), header]
+    body.extend(data for _, data, _ in parts)
+    return b''.join(body)
+
+
+def decode_result(task, body):
+    """The result of a shard `task` from `encode_result`."""
+    length, = struct.unpack_from('>I', body)
+    header = json.loads(body[4:4 + length].decode())
+    position = 4 + length
+    parts = []
+    for name, length, size in header['parts']:
+        parts.append((name, body[position:position + length], size))
+        position += length
+    if position != len(body):
+        raise ShardError('Shard of {} bytes instead of {}'.format(
+            len(body), position))
+    rollup = Rollup.from_state(header['rollup'])
+    if task == 'segment':
+        _, segment, size = parts[0]
+        return segment, size, header['rows'], rollup
+    members = {name: (data, size) for name, data, size in parts}
+    return members, header['rows'], rollup
+
+
+def post_shard(url, body, timeout):
+    """POST the JSON `body` to `url`, returns the response body."""
+    headers = {'Content-Type': 'application/json'}
+    if BUNDLE_SHARD_TOKEN:
+        headers['X-Shard-Token'] = BUNDLE_SHARD_TOKEN
+    request = urllib.request.Request(url, body, headers)
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.read()
+
+
+class ShardExecutor:
+    """
+    Runs `compress_segment` and `compress_columns` on other nodes.
+
+    Takes the place of the process pool of `TestDataGenerator.write_tar`:
+    the shards go to the `nodes` in turn. A shard that fails is retried on
+    the next node up to `attempts` times in all, after a second once every
+    node failed or was busy; a shard a node rejects as invalid fails right
+    away.
+    """
+
+    def __init__(self, nodes, concurrency=BUNDLE_SHARD_CONCURRENCY,
+                 timeout=BUNDLE_SHARD_TIMEOUT, attempts=BUNDLE_SHARD_ATTEMPTS,
+                 post=None):
+        if not nodes:
+            raise ValueError('No nodes to generate the shards on')
+        self.nodes = [node.rstrip('/') for node in nodes]
+        # shards in flight, the `workers` of `iter_results`
+        self.workers = len(self.nodes) * max(concurrency, 1)
+        self.timeout = timeout
+        self.attempts = attempts
+        # `post_shard` by default
+        self.post = post
+        self.executor = ThreadPoolExecutor(self.workers)
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.stats = {node: {'shards': 0, 'failed': 0, 'seconds': 0.0}
+                      for node in self.nodes}
+
+    def submit(self, task, bundle_config, filename, start, stop,
+               compresslevel=9):
+        name = next(name for name, fn in TASKS.items() if fn is task)
+        if bundle_config.reference_time and \
+                not bundle_config.reference_time.tzinfo:
+            # the nodes' time zones may differ
+            bundle_config = bundle_config.copy(update={
+                'reference_time': bundle_config.reference_time.astimezone()})
+        body = json.dumps({
+            'task': name,
+            'config': json.loads(bundle_config.json()),
+            'filename': filename,
+            'start': start,
+            'stop': stop,
+            'compresslevel': compresslevel,
+        }).encode()
+        with self.lock:
+            first = self.submitted
+            self.submitted += 1
+        return self.executor.submit(self._run, name, body, first)
+
+    def _run(self, task, body, first):
+        errors = []
+        for attempt in range(self.attempts):
+            node = self.nodes[(first + attempt) % len(self.nodes)]
+            if attempt and attempt % len(self.nodes) == 0:
+                # every node failed or was busy
+                time.sleep(1)
+            start = time.time()
+            try:
+                result = decode_result(task, (self.post or post_shard)(
+                    node + '/shards', body, self.timeout))
+            except Exception as e:
+                if isinstance(e, urllib.error.HTTPError) and \
+                        e.code < 500 and e.code not in BUSY:
+                    # errors without a body can't be read before 3.11
+                    detail = e.read() if e.fp else b''
+                    raise ShardError('{} rejected a shard: {}'.format(
+                        node, detail.decode(errors='replace') or e.reason))
+                logger.warning('Shard failed on %s: %s', node, e)
+                self._count(node, 'failed', 1)
+                errors.append('{}: {}'.format(node, e))
+                continue
+            self._count(node, 'shards', 1)
+            self._count(node, 'seconds', time.time() - start)
+            return result
+        raise ShardError('Shard failed on every node: {}'.format(
+            '; '.join(errors[-len(self.nodes):])))
+
+    def _count(self, node, key, value):
+        with self.lock:
+            self.stats[node][key] += value
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait)
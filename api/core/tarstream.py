@@ -0,0 +1,314 @@
+"""
+Write gzip compressed tar archives one member at a time.
+
+Every tar member is written as its own gzip member, which is still a
+regular `.tar.gz` for any gzip reader (RFC 1952 allows concatenated
+members). Members whose size is unknown up front are streamed: a fixed
+size slot is reserved for their tar header, the data is compressed chunk
+by chunk (or copied from gzip members compressed elsewhere) and the header
+is patched in once the size is known. Given their size the header is
+written first instead, so archives can be streamed into a `ChunkPipe`.
+
+Streamed data also starts a new gzip member every BUNDLE_INDEX_SPAN bytes,
+where readers can start decompressing without the data before it.
+"""
+import os
+import queue
+import struct
+import tarfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCKSIZE = tarfile.BLOCKSIZE
+# gzip header + one stored deflate block holding a tar header + trailer
+HEADER_SLOT = 10 + 5 + BLOCKSIZE + 8
+# uncompressed bytes per gzip member of streamed data, a restart point
+# costs about 0.3% of compression at 4 MiB
+INDEX_SPAN = int(os.environ.get('BUNDLE_INDEX_SPAN', 4 << 20))
+
+
+def gzip_stored(data):
+    """Wrap `data` (< 64k) in a gzip member using a stored deflate block."""
+    size = len(data)
+    return b''.join([
+        b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff',
+        struct.pack('<BHH', 1, size, size ^ 0xffff),
+        data,
+        struct.pack('<II', zlib.crc32(data) & 0xffffffff, size),
+    ])
+
+
+def gzip_compressor(compresslevel=9):
+    return zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+
+
+class SpanCompressor:
+    """
+    A gzip compressor starting a new gzip member every `span` bytes.
+
+    `span` is INDEX_SPAN by default, with 0 it's a single member like
+    `gzip_compressor`.
+    """
+
+    def __init__(self, compresslevel=9, span=None):
+        self.compresslevel = compresslevel
+        self.span = INDEX_SPAN if span is None else span
+        self.compressor = None
+        self.size = 0
+
+    def compress(self, data):
+        if not self.span:
+            if self.compressor is None:
+                self.compressor = gzip_compressor(self.compresslevel)
+            return self.compressor.compress(data)
+        parts = []
+        data = memoryview(data)
+        while data:
+            if self.compressor is None:
+                self.compressor = gzip_compressor(self.compresslevel)
+            part = data[:self.span - self.size]
+            data = data[len(part):]
+            parts.append(self.compressor.compress(part))
+            self.size += len(part)
+            if self.size == self.span:
+                parts.append(self.flush())
+        return b''.join(parts)
+
+    def flush(self):
+        """End the current member, if any."""
+        compressor, self.compressor = self.compressor, None
+        self.size = 0
+        return compressor.flush() if compressor else b''
+
+
+def padding(size):
+    return b'\0' * (-size % BLOCKSIZE)
+
+
+def tar_header(name, size, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = 0o644
+    header = info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape')
+    if len(header) != BLOCKSIZE:
+        raise ValueError('Member name too long: {}'.format(name))
+    return header
+
+
+def compress_block(data, compresslevel=9):
+    compressor = gzip_compressor(compresslevel)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_member(name, data, mtime, compresslevel=9):
+    """A complete tar member (header, data, padding) as one gzip member."""
+    compressor = gzip_compressor(compresslevel)
+    return b''.join([
+        compressor.compress(tar_header(name, len(data), mtime)),
+        compressor.compress(data),
+        compressor.compress(padding(len(data))),
+        compressor.flush(),
+    ])
+
+
+class TarGzWriter:
+    """
+    Writes members into `fileobj` as a gzip compressed tar stream.
+
+    With more than one thread streamed chunks are compressed in parallel,
+    pigz style, each as its own gzip member.
+    """
+
+    def __init__(self, fileobj, compresslevel=9, mtime=None, threads=1):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.mtime = int(time.time() if mtime is None else mtime)
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(threads) if threads > 1 else None
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.executor:
+            self.executor.shutdown()
+
+    def compressor(self):
+        return SpanCompressor(self.compresslevel)
+
+    def add_bytes(self, name, data):
+        """Add a member whose content is already in memory."""
+        self.fileobj.write(
+            compress_member(name, data, self.mtime, self.compresslevel))
+
+    def add_compressed(self, member):
+        """Add a member prepared by `compress_member`."""
+        self.fileobj.write(member)
+
+    def _begin_member(self, name, size=None):
+        """Write the header, or reserve its slot if `size` isn't known."""
+        if size is not None:
+            self.fileobj.write(gzip_stored(tar_header(name, size, self.mtime)))
+            return None
+        header_pos = self.fileobj.tell()
+        self.fileobj.write(b'\0' * HEADER_SLOT)
+        return header_pos
+
+    def _end_member(self, header_pos, name, size, expected=None):
+        if expected is not None and size != expected:
+            raise ValueError('{} has {} bytes instead of {}'.format(
+                name, size, expected))
+        if size % BLOCKSIZE:
+            self.fileobj.write(gzip_stored(padding(size)))
+        if header_pos is None:
+            return
+        end_pos = self.fileobj.tell()
+        self.fileobj.seek(header_pos)
+        self.fileobj.write(gzip_stored(tar_header(name, size, self.mtime)))
+        self.fileobj.seek(end_pos)
+
+    def add_stream(self, name, chunks, size=None):
+        """
+        Add a member from an iterable of byte chunks and return its size.
+
+        Only the current chunk is held in memory; unless the `size` is
+        given `fileobj` has to be seekable so the header can be written
+        after the data.
+        """
+        expected = size
+        header_pos = self._begin_member(name, expected)
+        if self.executor:
+            size = self._write_blocks(chunks)
+        else:
+            compressor = self.compressor()
+            size = 0
+            for chunk in chunks:
+                size += len(chunk)
+                self.fileobj.write(compressor.compress(chunk))
+            self.fileobj.write(compressor.flush())
+        self._end_member(header_pos, name, size, expected)
+        return size
+
+    def _write_blocks(self, chunks):
+        size = 0
+        pending = deque()
+        for chunk in chunks:
+            size += len(chunk)
+            if len(pending) >= self.threads * 2:
+                self.fileobj.write(pending.popleft().result())
+            pending.append(self.executor.submit(
+                compress_block, chunk, self.compresslevel))
+        while pending:
+            self.fileobj.write(pending.popleft().result())
+        return size
+
+    def add_segments(self, name, segments, size=None):
+        """
+        Add a member from `(gzip_member, size)` segments and return its size.
+
+        The segments are already compressed gzip members of consecutive
+        parts of the content and are copied into the archive in order.
+        """
+        expected = size
+        header_pos = self._begin_member(name, expected)
+        size = 0
+        for segment, segment_size in segments:
+            size += segment_size
+            self.fileobj.write(segment)
+        self._end_member(header_pos, name, size, expected)
+        return size
+
+    def close(self):
+        """Write the end-of-archive marker."""
+        if not self.closed:
+            compressor = self.compressor()
+            self.fileobj.write(compressor.compress(b'\0' * BLOCKSIZE * 2))
+            self.fileobj.write(compressor.flush())
+            self.closed = True
+        if self.executor:
+            self.executor.shutdown()
+
+
+class ChunkPipe:
+    """
+    A file object whose writes are read as chunks by another thread.
+
+    At most `max_chunks` chunks are buffered: writes block while the
+    reader is behind and fail with BrokenPipeError once it is gone, i.e.
+    after `cancel` or when it took no chunk for `timeout` seconds. In the
+    latter case the reader gets the error too once it took the buffered
+    chunks, the data it read is incomplete.
+    """
+    # marks the end of the written data
+    END = object()
+    # seconds between checks whether the other side is gone
+    POLL = 0.1
+
+    def __init__(self, max_chunks=4, chunk_size=1 << 20, timeout=60):
+        self.queue = queue.Queue(max_chunks)
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.buffer = []
+        self.buffered = 0
+        self.written = 0
+        self.cancelled = False
+        # the error of a writer that gave up on the reader
+        self.failed = None
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.written += len(data)
+        if self.buffered >= self.chunk_size:
+            self._put(b''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+        return len(data)
+
+    def _put(self, item):
+        deadline = time.time() + self.timeout
+        while not self.cancelled:
+            try:
+                self.queue.put(item, timeout=self.POLL)
+                return
+            except queue.Full:
+                if time.time() > deadline:
+                    self.failed = BrokenPipeError(
+                        'No chunk read for {}s'.format(self.timeout))
+                    raise self.failed
+        raise BrokenPipeError('The reader is gone')
+
+    def close(self, error=None):
+        """Flush the buffer and end the data, with an `error` if any."""
+        if error is None and self.buffer:
+            self._put(b''.join(self.buffer))
+        self.buffer = []
+        self._put(self.END if error is None else error)
+
+    def cancel(self):
+        """The reader stops reading, pending and later writes fail."""
+        self.cancelled = True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self.cancelled:
+            try:
+                item = self.queue.get(timeout=self.POLL)
+            except queue.Empty:
+                if self.failed:
+                    raise self.failed
+                continue
+            if item is self.END:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            return item
+        raise StopIteration
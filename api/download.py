@@ -0,0 +1,225 @@
+"""
+Serving bundle files with HEAD, conditional and Range request support,
+and bundles streamed while they are generated.
+"""
+import asyncio
+import os
+import re
+import threading
+from email.utils import formatdate
+
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+
+from .core.jobs import process_alive
+from .core.registry import BUNDLE_REGISTRY
+
+# parallel downloads of a single bundle by all the workers before 503 is
+# returned
+BUNDLE_DOWNLOAD_LIMIT = int(os.environ.get('BUNDLE_DOWNLOAD_LIMIT', 8))
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class DownloadLimiter:
+    """
+    Counts the downloads in flight per bundle.
+
+    The downloads are recorded in the registry, so the limit holds for all
+    the gunicorn workers and the janitor of any of them skips the bundles
+    the others are serving. Downloads of dead processes don't count.
+    """
+
+    def __init__(self, limit=BUNDLE_DOWNLOAD_LIMIT, registry=BUNDLE_REGISTRY):
+        self.limit = limit
+        self.registry = registry
+        # bundle id: registry ids of the downloads of this process
+        self.active = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, bundle_id):
+        download_id = self.registry.add_download(
+            bundle_id, self.limit, process_alive)
+        if download_id is None:
+            return False
+        with self.lock:
+            self.active.setdefault(bundle_id, []).append(download_id)
+        return True
+
+    def release(self, bundle_id):
+        with self.lock:
+            download_id = self.active[bundle_id].pop()
+            if not self.active[bundle_id]:
+                del self.active[bundle_id]
+        self.registry.remove_download(download_id)
+
+    def downloading(self, bundle_id):
+        return any(process_alive(pid)
+                   for pid in self.registry.downloads(bundle_id))
+
+
+DOWNLOADS = DownloadLimiter()
+
+
+def parse_range(header, size):
+    """
+    The `(start, end)` byte positions requested by a Range header.
+
+    Returns None to serve the whole file (no, malformed or multiple
+    ranges) and raises ValueError for unsatisfiable ranges.
+    """
+    match = RANGE_RE.match(header.replace(' ', '')) if header else None
+    if not match:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # suffix range, the last `end` bytes
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        raise ValueError('Range not satisfiable')
+    return start, end
+
+
+class BundleFileResponse(Response):
+    """
+    A file response honouring Range, If-Range and If-None-Match.
+
+    The body is sent with the ASGI zero-copy extension when the server
+    offers it, otherwise it is read in `chunk_size` chunks off the event
+    loop. `on_close` is called once the response is finished.
+    """
+    chunk_size = 1 << 20
+    media_type = 'application/gzip'
+
+    def __init__(self, path, request, on_close=None):
+        self.path = path
+        self.on_close = on_close
+        self.background = None
+        self.send_body = request.method != 'HEAD'
+        stat = os.stat(path)
+        size = stat.st_size
+        etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, size)
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
+        headers = {
+            'accept-ranges': 'bytes',
+            'etag': etag,
+            'last-modified': last_modified,
+            'content-type': self.media_type,
+        }
+        self.status_code = 200
+        self.start, self.length = 0, size
+
+        if etag in request.headers.get('if-none-match', ''):
+            self.status_code = 304
+            self.send_body = False
+            self.length = 0
+        else:
+            if_range = request.headers.get('if-range')
+            requested = None
+            if if_range is None or if_range in (etag, last_modified):
+                try:
+                    requested = parse_range(
+                        request.headers.get('range'), size)
+                except ValueError:
+                    self.status_code = 416
+                    self.send_body = False
+                    self.length = 0
+                    headers['content-range'] = 'bytes */{}'.format(size)
+            if requested:
+                start, end = requested
+                self.status_code = 206
+                self.start, self.length = start, end - start + 1
+                headers['content-range'] = 'bytes {}-{}/{}'.format(
+                    start, end, size)
+            headers['content-length'] = str(self.length)
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': self.status_code,
+                'headers': self.raw_headers,
+            })
+            if not self.send_body or not self.length:
+                await send({'type': 'http.response.body', 'body': b''})
+            elif 'http.response.zerocopysend' in scope.get('extensions', {}):
+                with open(self.path, 'rb') as f:
+                    await send({
+                        'type': 'http.response.zerocopysend',
+                        'file': f.fileno(),
+                        'offset': self.start,
+                        'count': self.length,
+                    })
+            else:
+                await self.send_chunks(send)
+        finally:
+            if self.on_close:
+                self.on_close()
+
+    async def send_chunks(self, send):
+        with open(self.path, 'rb') as f:
+            await run_in_threadpool(f.seek, self.start)
+            remaining = self.length
+            while remaining:
+                chunk = await run_in_threadpool(
+                    f.read, min(self.chunk_size, remaining))
+                if not chunk:
+                    raise IOError('{} was truncated'.format(self.path))
+                remaining -= len(chunk)
+                await send({
+                    'type': 'http.response.body',
+                    'body': chunk,
+                    'more_body': remaining > 0,
+                })
+
+
+class BundleStreamResponse(Response):
+    """
+    A response sending the chunks of a `BundleStream` as they come.
+
+    There is no Content-Length, the server sends the body chunked. The
+    stream is closed once the response is finished or the client is gone.
+    """
+    media_type = 'application/gzip'
+
+    def __init__(self, chunks, filename):
+        self.chunks = chunks
+        self.background = None
+        self.status_code = 200
+        self.init_headers({
+            'content-type': self.media_type,
+            'content-disposition': 'attachment; filename="{}"'.format(
+                filename),
+        })
+
+    async def __call__(self, scope, receive, send):
+        watcher = asyncio.ensure_future(self.watch_disconnect(receive))
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': self.status_code,
+                'headers': self.raw_headers,
+            })
+            while True:
+                chunk = await run_in_threadpool(next, self.chunks, None)
+                if chunk is None:
+                    break
+                await send({
+                    'type': 'http.response.body',
+                    'body': chunk,
+                    'more_body': True,
+                })
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            watcher.cancel()
+            self.chunks.close()
+
+    async def watch_disconnect(self, receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        self.chunks.close()
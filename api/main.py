@@ -1,18 +1,39 @@
+import datetime
 import logging
 import os
+import shutil
+import time
 import uuid
+from contextlib import contextmanager
+from enum import Enum
 from os import listdir
 from pathlib import Path
+from typing import Dict, List, Optional, Union
 
 from datasette_auth_github import GitHubAuth
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import (FastAPI, HTTPException, BackgroundTasks, Query, Request,
+                     Response)
+from fastapi.exceptions import RequestValidationError
 from fastapi.logger import logger
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError, conint, validator
 from starlette.middleware.cors import CORSMiddleware
-from starlette.responses import FileResponse
 
-from .core.generate_data import (TestDataGenerator, get_bundle_path,
-                                 notify_upload)
+from .core import metrics
+from .core.admission import ADMISSION, Overloaded, Rejected, TooLarge
+from .core.archive import load_index
+from .core.cache import BUNDLE_CACHE
+from .core.distributions import NUMERIC, check_distribution
+from .core.registry import BUNDLE_REGISTRY
+from .core.generate_data import (KAFKA, NOTIFICATIONS, TABLES,
+                                 TestDataGenerator, bundle_cost,
+                                 coordinator_cost, fleet_cost,
+                                 get_bundle_path, notify_upload,
+                                 static_members)
+from .core.janitor import Janitor, remove_bundles
+from .core.shards import (BUNDLE_SHARD_NODES, BUNDLE_SHARD_TOKEN, TASKS,
+                          ShardError, ShardExecutor, encode_result)
+from .core.jobs import BUNDLE_JOBS, DONE, QueueFull
+from .download import DOWNLOADS, BundleFileResponse, BundleStreamResponse
 logger.handlers = logging.getLogger('uvicorn.error').handlers
 logger.setLevel(int(os.environ.get('LOG_LEVEL', logging.INFO)))
 
@@ -21,17 +42,55 @@ HOST_URL = os.environ.get('HOST_URL', 'http://testbuild:8000')
 GH_AUTH_CLIENT_ID = os.getenv('GH_AUTH_CLIENT_ID')
 GH_AUTH_CLIENT_SECRET = os.getenv('GH_AUTH_CLIENT_SECRET')
 ALLOW_GH_ORGS = (os.getenv('ALLOW_GH_ORGS') or 'Ansible').split(',')
+JANITOR = Janitor(busy=DOWNLOADS.downloading)
+
+
+class Compression(str, Enum):
+    gzip = 'gzip'
+    # gzip members compressed in parallel, still a regular .tar.gz
+    pigz = 'pigz'
+    # gzip without compression, for local testing
+    store = 'store'
+
+
+class TableFormat(str, Enum):
+    csv = 'csv'
+    # a NumPy .npy file per column, e.g. events_table/created.npy
+    npy = 'npy'
+    both = 'both'
+
+
+class Column(str, Enum):
+    # unified jobs, by job id
+    status = 'status'
+    org = 'org'
+    template = 'template'
+    day = 'day'
+    # events, by event id
+    host = 'host'
+    # events, by the position of the event in its job
+    task = 'task'
+    failed = 'failed'
+    changed = 'changed'
+
+
+class Distribution(BaseModel):
+    # P(value k) ~ 1 / (k + 1) ** zipf, for numeric columns
+    zipf: Optional[float] = None
+    # relative weights: a list for the values 0, 1, ... of numeric columns,
+    # by value (e.g. {"successful": 9, "failed": 1}) for the others
+    weights: Optional[Union[Dict[str, float], List[float]]] = None
 
 
 class BundleConfig(BaseModel):
-    unified_jobs: int = 1
-    job_events: int = 1
-    tasks_count: int = 100
-    orgs_count: int = 1
-    templates_count: int = 1
-    spread_days_back: int = 100
+    unified_jobs: conint(ge=0) = 1
+    job_events: conint(ge=0) = 1
+    tasks_count: conint(ge=0) = 100
+    orgs_count: conint(ge=0) = 1
+    templates_count: conint(ge=0) = 1
+    spread_days_back: conint(ge=0) = 100
     starting_day: int = 1
-    hosts_count: int = 1
+    hosts_count: conint(ge=0) = 1
     failed_job_modulo: int = 1
     bundle_uuid: str = ''
     tenant_id: int = 1
@@ -43,11 +102,103 @@ class BundleConfig(BaseModel):
     pending_job_threshold: int = -1
     error_job_threshold: int = -1
     starting_event_id: int = 0
+    starting_job_id: int = 0
+    # continue the bundle series of `install_uuid`, see `/series`
+    series: bool = False
+    workers: conint(ge=0) = 1
+    compression: Compression = Compression.gzip
+    compression_level: conint(ge=0, le=9) = 6
+    compression_threads: conint(ge=0) = 0
+    # the generated tables as CSV, as typed columns or both
+    table_format: TableFormat = TableFormat.csv
+    # timestamps are relative to this instead of the current time, which
+    # makes identical configs generate byte-identical bundles
+    reference_time: Optional[datetime.datetime] = None
+    # the hour and minute of the timestamps, 01:21 by default
+    time_of_day: Optional[datetime.time] = None
+    # seeds the distributions and the install and instance uuids of fleet
+    # bundles
+    seed: Optional[int] = None
+    # skewed columns instead of the modulo patterns, see `Column`
+    distributions: Dict[Column, Distribution] = {}
+
+    @validator('distributions')
+    def check_distributions(cls, distributions, values):
+        for column, distribution in distributions.items():
+            count = values.get(NUMERIC.get(column.value))
+            check_distribution(column.value, distribution, count)
+        return distributions
 
 
 class BundleState(BaseModel):
     uuid: str
     processed: bool
+    size: Optional[int] = None
+    created: Optional[float] = None
+    config_hash: Optional[str] = None
+
+
+class BundleStatus(BaseModel):
+    uuid: str
+    state: str
+    rows_written: int = 0
+    total_rows: int = 0
+    bytes_written: int = 0
+    eta_seconds: Optional[float] = None
+    error: Optional[str] = None
+
+
+class FleetTenant(BaseModel):
+    tenant_id: int
+    account_id: str = ''
+
+
+class FleetConfig(BaseModel):
+    template: BundleConfig = BundleConfig()
+    tenants: List[FleetTenant] = [FleetTenant(tenant_id=1)]
+    installs_per_tenant: conint(ge=0) = 1
+    # bundles generated in parallel, 0 for one per core
+    workers: conint(ge=0) = 0
+
+
+class ShardedConfig(BaseModel):
+    config: BundleConfig = BundleConfig()
+    # base URLs of the service instances generating the shards, some of
+    # BUNDLE_SHARD_NODES, all of them by default
+    nodes: List[str] = []
+
+
+class ShardTask(str, Enum):
+    # CSV rows, see `compress_segment`
+    segment = 'segment'
+    # columns, see `compress_columns`
+    columns = 'columns'
+
+
+class ShardRequest(BaseModel):
+    task: ShardTask = ShardTask.segment
+    config: BundleConfig
+    filename: str
+    # the jobs of the shard
+    start: int
+    stop: int
+    compresslevel: conint(ge=0, le=9) = 6
+
+
+class SeriesCursor(BaseModel):
+    install_uuid: str
+    last_job_id: int
+    last_event_id: int
+    last_collected: float
+    # the timestamps of the next bundle come after this
+    last_timestamp: Optional[float] = None
+    bundles: int
+
+
+class ProcessRequest(BaseModel):
+    bundle_ids: List[str]
+    tenant_id: int = 1
+    account_id: str = '123456'
 
 
 app = FastAPI()
@@ -57,15 +208,22 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"]
 )
+app.add_middleware(metrics.MetricsMiddleware)
 
 
+IGNORE_PATHS = [('GET', '/bundles/?*'), ('HEAD', '/bundles/?*'),
+                ('GET', '/metrics'), ('GET', '/health/*')]
+if BUNDLE_SHARD_TOKEN:
+    # nodes check the shard token instead
+    IGNORE_PATHS.append(('POST', '/shards'))
+
 if GH_AUTH_CLIENT_ID and GH_AUTH_CLIENT_SECRET:
     app.add_middleware(
         GitHubAuth,
         client_id=GH_AUTH_CLIENT_ID,
         client_secret=GH_AUTH_CLIENT_SECRET,
         require_auth=True,
-        ignore_paths=[('GET', '/bundles/?*')],
+        ignore_paths=IGNORE_PATHS,
         allow_orgs=ALLOW_GH_ORGS,
     )
     logger.info('Github Authentication enabled')
@@ -75,56 +233,377 @@ else:
         'no authentication is enabled')
 
 
+@app.on_event("startup")
+def load_static_members():
+    static_members()
+
+
+@app.on_event("startup")
+def rebuild_registry():
+    tars, _, purge = bundles_by_state()
+    count = BUNDLE_REGISTRY.rebuild(BUNDLE_DIR, tars, purge)
+    logger.info('Registered %d bundles from %s', count, BUNDLE_DIR)
+
+
+@app.on_event("startup")
+def start_janitor():
+    JANITOR.start()
+
+
+@app.on_event("shutdown")
+def stop_janitor():
+    JANITOR.stop()
+
+
+@app.on_event("startup")
+def start_metrics():
+    metrics.METRICS.start()
+
+
+@app.on_event("shutdown")
+def stop_metrics():
+    metrics.METRICS.stop()
+
+
+@app.on_event("startup")
+def connect_kafka():
+    KAFKA.start()
+
+
+@app.on_event("shutdown")
+def flush_notifications():
+    NOTIFICATIONS.flush()
+    KAFKA.close()
+
+
 @app.get("/")
 async def root():
     return {"message": "Hello World"}
 
 
+@app.get("/health/live")
+def liveness():
+    """The app is up, whatever the state of Kafka."""
+    return {'status': 'ok', 'kafka': KAFKA.state()}
+
+
+@app.get("/health/ready")
+def readiness(response: Response):
+    """
+    Ready once the bundles can be announced: 503 until Kafka is connected.
+
+    Bundles created with `process=false` don't need Kafka and work anyway.
+    """
+    kafka = KAFKA.state()
+    ready = kafka['state'] == 'connected'
+    if not ready:
+        response.status_code = 503
+    return {'status': 'ok' if ready else 'unavailable', 'kafka': kafka,
+            'pending_notifications': NOTIFICATIONS.pending()}
+
+
 def remove_processed_bundles(to_del):
     logger.info('Removing processed %d bundles', len(to_del))
-    for id in to_del:
-        f = get_bundle_path(id)
-        logger.info('Removing %s', f)
-        os.remove(f)
+    remove_bundles([BUNDLE_REGISTRY.get(id) or {'uuid': id, 'size': 0}
+                    for id in to_del], 'deleted')
 
 
 def bundles_by_state():
+    """Scan BUNDLE_DIR, only used to rebuild the registry."""
     all = [f for f in listdir(BUNDLE_DIR)]
     # Processed bundles has a corresponing '.done' file
     done = [f[:32] for f in all if f.endswith('.done')]
+    done_set = set(done)
     # Bundles that is not yet processed
-    tars = [f[:32] for f in all if f.endswith('.gz') and not f[:32] in done]
+    tars = [f[:32] for f in all
+            if f.endswith('.gz') and f[:32] not in done_set]
     # Bundles that are processed and so can be purged
-    purge = [f[:32] for f in all if f.endswith('.gz') and f[:32] in done]
+    purge = [f[:32] for f in all if f.endswith('.gz') and f[:32] in done_set]
     return tars, done, purge
 
 
+@app.get("/cache")
+def cache_stats():
+    """Hit/miss counters and size of the bundle cache."""
+    return BUNDLE_CACHE.stats()
+
+
+@app.get("/admission")
+def admission_stats():
+    """Budget, running and waiting builds and rejections per lane."""
+    return ADMISSION.stats()
+
+
+def admit(cost):
+    """
+    The ticket of a build once it fits the budget, 429/503 if not
+
+    422 if it exceeds the whole budget.
+    """
+    try:
+        return ADMISSION.acquire(cost)
+    except TooLarge as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except Rejected as e:
+        raise HTTPException(
+            status_code=503 if isinstance(e, Overloaded) else 429,
+            detail=str(e), headers={'Retry-After': str(e.retry_after)})
+
+
+@contextmanager
+def admitted(cost):
+    """Run a build once it fits the budget, 429/503 when saturated."""
+    ticket = admit(cost)
+    try:
+        yield
+    finally:
+        ADMISSION.release(ticket)
+
+
+@app.get("/metrics")
+def get_metrics():
+    """
+    Prometheus metrics of the bundle generation and the API.
+
+    Add `debug=true` to any request for its `Server-Timing` breakdown.
+    """
+    for processed, (count, size) in BUNDLE_REGISTRY.usage().items():
+        processed = str(processed).lower()
+        metrics.BUNDLE_DIR_BUNDLES.set(count, processed=processed)
+        metrics.BUNDLE_DIR_BYTES.set(size, processed=processed)
+    metrics.BUNDLE_DIR_FREE.set(shutil.disk_usage(BUNDLE_DIR).free)
+    return Response(metrics.METRICS.render(),
+                    media_type='text/plain; version=0.0.4')
+
+
+class ListState(str, Enum):
+    processed = 'processed'
+    unprocessed = 'unprocessed'
+
+
 @app.get("/bundles/")
-def list_bundles():
-    """Listing bundles and status."""
-    tars, done, _ = bundles_by_state()
-    out = []
-    for id in tars:
-        out.append(BundleState(uuid=id, processed=False))
-    for id in done:
-        out.append(BundleState(uuid=id, processed=True))
-    return out
+def list_bundles(
+    state: ListState = None,
+    offset: int = 0,
+    limit: int = None,
+):
+    """Listing bundles and status, oldest first, all unless paged."""
+    processed = None if state is None else state == ListState.processed
+    return [
+        BundleState(**bundle) for bundle in BUNDLE_REGISTRY.list(
+            processed=processed, offset=offset, limit=limit)
+    ]
+
+
+def notify_bundle(config):
+    notify_upload(
+        HOST_URL,
+        config.account_id,
+        config.tenant_id,
+        config.bundle_uuid)
 
 
 @app.post("/bundles/")
-def create_bundle(config: BundleConfig, process: bool = True):
-    """Create a bundle and return an ID for later reference."""
+def create_bundle(
+    config: BundleConfig,
+    response: Response,
+    process: bool = True,
+    run_async: bool = Query(False, alias='async'),
+):
+    """
+    Create a bundle and return an ID for later reference.
+
+    With `async=true` the bundle is generated in the background and its
+    progress is reported by `/bundles/{bundle_id}/status`.
+    """
     config.bundle_uuid = str(uuid.uuid4()).replace('-', '')
-    TestDataGenerator().generate_bundle(config)
+    if not process:
+        logger.info("Process=False, not sending message")
+    if run_async:
+        try:
+            job = BUNDLE_JOBS.submit(
+                config, notify_bundle if process else None,
+                # accepted first, a rejected bundle must not advance its
+                # series
+                prepare=next_in_series)
+        except TooLarge as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        except QueueFull as e:
+            raise HTTPException(
+                status_code=503, detail=str(e),
+                headers={'Retry-After': str(e.retry_after)})
+        response.status_code = 202
+        return job.bundle_config
+    # admitted first, a rejected bundle must not advance its series
+    with admitted(bundle_cost(config)):
+        config = next_in_series(config)
+        TestDataGenerator().generate_bundle(config)
+    if process:
+        notify_bundle(config)
+    return config
+
+
+@app.get("/bundles/stream")
+def stream_bundle_get(request: Request):
+    """
+    `POST /bundles/stream` with the BundleConfig as query parameters.
+
+    Distributions can't be given as query parameters.
+    """
+    try:
+        config = BundleConfig(**request.query_params)
+    except ValidationError as e:
+        raise RequestValidationError(e.raw_errors)
+    return stream_bundle(config)
+
+
+@app.post("/bundles/stream")
+def stream_bundle(config: BundleConfig):
+    """
+    Generate a bundle and stream it while it is generated.
+
+    Nothing is kept: the bundle isn't written to BUNDLE_DIR, registered or
+    announced, and the generation runs only as fast as the client reads.
+    Only CSV tables can be streamed, and not as part of a series: a stream
+    the client abandons would still advance it.
+    """
+    if config.table_format != TableFormat.csv:
+        raise HTTPException(
+            status_code=422, detail='Only CSV tables can be streamed')
+    if config.series:
+        raise HTTPException(
+            status_code=422, detail='Series bundles can not be streamed')
+    config.bundle_uuid = str(uuid.uuid4()).replace('-', '')
+    ticket = admit(bundle_cost(config))
+    try:
+        chunks = TestDataGenerator().stream_bundle(
+            config, on_done=lambda generator: ADMISSION.release(ticket))
+    except Exception:
+        ADMISSION.release(ticket)
+        raise
+    return BundleStreamResponse(
+        chunks, '{}_data_bundle.tar.gz'.format(config.bundle_uuid))
+
+
+def next_in_series(config):
+    if not config.series:
+        return config
+    try:
+        return TestDataGenerator().next_in_series(config)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+@app.post("/bundles/fleet")
+def create_fleet(fleet: FleetConfig, process: bool = True):
+    """
+    Create a bundle per install of every tenant from one template.
+
+    The bundles are generated on a shared worker pool and get
+    non-overlapping event ids; returns their configs and the aggregate
+    throughput.
+    """
+    generator = TestDataGenerator()
+    configs = generator.fan_out(
+        fleet.template, fleet.tenants, fleet.installs_per_tenant)
+    workers = fleet.workers or os.cpu_count() or 1
+    with admitted(fleet_cost(configs, workers)):
+        stats = generator.generate_fleet(configs, workers)
     if process:
-        notify_upload(
-            HOST_URL,
-            config.account_id,
-            config.tenant_id,
-            config.bundle_uuid)
+        for config in configs:
+            notify_bundle(config)
     else:
         logger.info("Process=False, not sending message")
-    return config
+    stats['configs'] = configs
+    return stats
+
+
+@app.post("/bundles/sharded")
+def create_sharded_bundle(sharded: ShardedConfig, process: bool = True):
+    """
+    Create a bundle generated by several instances of this service.
+
+    The jobs are split into shards that the `nodes` generate and compress
+    (`POST /shards`) within their budgets. This instance only writes them
+    into the bundle in order, with the rollups of the jobs, within its own.
+    """
+    nodes = sharded.nodes or BUNDLE_SHARD_NODES
+    if not nodes:
+        raise HTTPException(
+            status_code=422, detail='No nodes, set BUNDLE_SHARD_NODES')
+    # the shard token is sent to the nodes, they can't be just any URL
+    known = {node.rstrip('/') for node in BUNDLE_SHARD_NODES}
+    unknown = [node for node in nodes if node.rstrip('/') not in known]
+    if unknown:
+        raise HTTPException(
+            status_code=422, detail='Nodes not in BUNDLE_SHARD_NODES: {}'
+            .format(', '.join(unknown)))
+    config = sharded.config
+    config.bundle_uuid = str(uuid.uuid4()).replace('-', '')
+    with admitted(coordinator_cost(config)):
+        config = next_in_series(config)
+        executor = ShardExecutor(nodes)
+        start = time.time()
+        try:
+            TestDataGenerator().generate_bundle(config, executor)
+        except ShardError as e:
+            raise HTTPException(status_code=502, detail=str(e))
+        finally:
+            executor.shutdown()
+    if process:
+        notify_bundle(config)
+    else:
+        logger.info("Process=False, not sending message")
+    return {'config': config, 'seconds': time.time() - start,
+            'nodes': executor.stats}
+
+
+@app.post("/shards")
+def generate_shard(shard: ShardRequest, request: Request):
+    """
+    Generate a shard of a table for `/bundles/sharded` on another node.
+
+    Returns the gzip compressed rows (or columns) of the jobs `start` to
+    `stop`, with their row count and rollup, see `shards.encode_result`.
+    """
+    if BUNDLE_SHARD_TOKEN and \
+            request.headers.get('x-shard-token') != BUNDLE_SHARD_TOKEN:
+        raise HTTPException(status_code=403, detail='Invalid shard token')
+    if shard.filename not in TABLES or shard.start > shard.stop:
+        raise HTTPException(status_code=422, detail='Invalid shard')
+    cost = bundle_cost(shard.config.copy(update={
+        'unified_jobs': shard.stop - shard.start, 'workers': 1}))
+    with admitted(cost):
+        result = TASKS[shard.task](
+            shard.config, shard.filename, shard.start, shard.stop,
+            shard.compresslevel)
+    return Response(encode_result(shard.task, result),
+                    media_type='application/octet-stream')
+
+
+@app.get("/series/{install_uuid}", response_model=SeriesCursor)
+def get_series(install_uuid: str):
+    """The cursor of the bundle series of an install."""
+    cursor = BUNDLE_REGISTRY.series(install_uuid)
+    if not cursor:
+        raise HTTPException(status_code=404, detail="Series not found")
+    return cursor
+
+
+@app.get("/bundles/{bundle_id}/status", response_model=BundleStatus)
+def bundle_status(bundle_id: str):
+    """Report the state and progress of a bundle."""
+    status = BUNDLE_JOBS.status(bundle_id)
+    if status:
+        return BundleStatus(**status)
+    data_bundle = get_bundle_path(bundle_id)
+    if not os.path.isfile(data_bundle):
+        raise HTTPException(
+            status_code=404,
+            detail="Bundle ID={} not found".format(bundle_id))
+    return BundleStatus(
+        uuid=bundle_id, state=DONE,
+        bytes_written=os.stat(data_bundle).st_size)
 
 
 @app.delete("/bundles/{bundle_id}")
@@ -136,7 +615,8 @@ def delete_bundles(
     logger.info("Deleting bundle: %s", bundle_id)
     purge = [bundle_id]
     if bundle_id == 'processed':
-        _, _, purge = bundles_by_state()
+        purge = [bundle['uuid']
+                 for bundle in BUNDLE_REGISTRY.list(processed=True)]
     else:
         data_bundle = get_bundle_path(bundle_id)
         if not os.path.isfile(data_bundle):
@@ -148,23 +628,128 @@ def delete_bundles(
     return "Deleting {} bundles: {}".format(len(purge), purge)
 
 
-@app.get("/bundles/{bundle_id}")
-def get_bundle(bundle_id: str, done: bool=False):
+@app.api_route("/bundles/{bundle_id}", methods=["GET", "HEAD"])
+def get_bundle(request: Request, bundle_id: str, done: bool = False):
     """Return a bundle."""
+    return download_bundle(request, bundle_id, done)
+
+
+@app.api_route("/bundles/{bundle_id}/download", methods=["GET", "HEAD"])
+def download_bundle(request: Request, bundle_id: str, done: bool = False):
+    """
+    Download a bundle.
+
+    Supports HEAD, Range/If-Range for resuming and ETag/Last-Modified
+    validation. Parallel downloads per bundle are limited.
+    """
     data_bundle = get_bundle_path(bundle_id)
     if not os.path.isfile(data_bundle):
         logger.error("Bundle {} not found".format(data_bundle))
         raise HTTPException(
             status_code=404,
             detail="Bundle ID={} not found".format(bundle_id))
-    if done:
-        # mark it as done, to be deleted
-        bundle_done = '{}.done'.format(data_bundle)
-        Path(bundle_done).touch()
-    return FileResponse(data_bundle, media_type="application/gzip")
+    if not DOWNLOADS.acquire(bundle_id):
+        raise HTTPException(
+            status_code=503,
+            detail="Too many downloads of bundle ID={}".format(bundle_id),
+            headers={'Retry-After': '1'})
+    try:
+        response = BundleFileResponse(
+            data_bundle, request, lambda: DOWNLOADS.release(bundle_id))
+        if done and request.method == 'GET':
+            # mark it as done, to be deleted
+            bundle_done = '{}.done'.format(data_bundle)
+            Path(bundle_done).touch()
+            BUNDLE_REGISTRY.mark_processed(bundle_id)
+    except Exception:
+        DOWNLOADS.release(bundle_id)
+        raise
+    return response
+
+
+def bundle_index(bundle_id):
+    data_bundle = get_bundle_path(bundle_id)
+    if not os.path.isfile(data_bundle):
+        raise HTTPException(
+            status_code=404,
+            detail="Bundle ID={} not found".format(bundle_id))
+    return load_index(data_bundle)
+
+
+@app.get("/bundles/{bundle_id}/members")
+def list_members(bundle_id: str):
+    """
+    Names and sizes of the files in a bundle.
+
+    The bundle is indexed on first access, which takes about as long as
+    decompressing it; reading its members is fast after that.
+    """
+    return [{'name': member['name'], 'size': member['size']}
+            for member in bundle_index(bundle_id).members.values()]
+
+
+class ReadUnit(str, Enum):
+    lines = 'lines'
+    bytes = 'bytes'
+
+
+@app.get("/bundles/{bundle_id}/members/{name:path}")
+def read_member(
+    bundle_id: str,
+    name: str,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, ge=0, le=100000),
+    unit: ReadUnit = ReadUnit.lines,
+):
+    """
+    Read `limit` lines (or bytes) of a file in a bundle after `offset`.
+
+    Only the part of the bundle around them is decompressed, e.g.
+    `offset=1000&limit=10` of `events_table.csv` skips its header and
+    999 rows.
+    """
+    index = bundle_index(bundle_id)
+    if name not in index.members:
+        raise HTTPException(
+            status_code=404,
+            detail="No {} in bundle ID={}".format(name, bundle_id))
+    if unit == ReadUnit.lines:
+        data = index.read_lines(name, offset, limit)
+    else:
+        data = index.read_bytes(name, offset, limit)
+    media_type = 'text/csv' if name.endswith('.csv') else \
+        'application/json' if name.endswith('.json') else \
+        'application/octet-stream'
+    return Response(data, media_type=media_type, headers={
+        'x-member-size': str(index.members[name]['size'])})
+
+
+@app.get("/bundles/{bundle_id}/notification")
+def notification_status(bundle_id: str):
+    """Delivery state of the Kafka notification of a bundle."""
+    delivery = NOTIFICATIONS.status(bundle_id)
+    if not delivery:
+        raise HTTPException(
+            status_code=404,
+            detail="No notification for bundle ID={}".format(bundle_id))
+    return delivery
 
 
 @app.get("/process/{bundle_id}")
 def process_bundle(bundle_id: str, tenant_id: int, account_id: str = '123456'):
     """Push bundle to processor."""
     return notify_upload(HOST_URL, account_id, tenant_id, bundle_id)
+
+
+@app.post("/process")
+def process_bundles(request: ProcessRequest):
+    """Push many bundles to the processor, without waiting for Kafka."""
+    out = {}
+    for bundle_id in request.bundle_ids:
+        if not os.path.isfile(get_bundle_path(bundle_id)):
+            out[bundle_id] = {'bundle_id': bundle_id, 'state': 'failed',
+                              'error': 'Bundle not found'}
+            continue
+        out[bundle_id] = notify_upload(
+            HOST_URL, request.account_id, request.tenant_id, bundle_id)
+    return out
@@ -0,0 +1,25 @@
+import os
+import platform
+import resource
+import subprocess
+
+
+def run_info():
+    """What a benchmark result was measured on, to compare it later."""
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB (Linux reports KB)."""
+    return round(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
@@ -0,0 +1,95 @@
+"""
+Load test of the bundle endpoints through the app, in-process.
+
+    python -m benchmarks.api --requests 50 --concurrency 1 4
+
+Creates bundles with `POST /bundles/?process=false` and downloads them with
+`GET /bundles/{id}` from `--concurrency` client threads, on a temporary
+BUNDLE_DIR. Prints one JSON object per endpoint and concurrency.
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import peak_rss_mb, run_info
+
+
+def percentile(latencies, fraction):
+    latencies = sorted(latencies)
+    return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)]
+
+
+def load(name, call, count, concurrency):
+    """Make `count` calls from `concurrency` threads and time each one."""
+    def timed(i):
+        start = time.time()
+        size = call(i)
+        return time.time() - start, size
+
+    start = time.time()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(timed, range(count)))
+    elapsed = time.time() - start
+    latencies = [latency for latency, _ in results]
+    return {
+        'endpoint': name,
+        'requests': count,
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 3),
+        'requests_per_s': round(count / elapsed, 1),
+        'mb_per_s': round(sum(size for _, size in results) / elapsed / 1e6, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--jobs', type=int, default=100)
+    parser.add_argument('--events', type=int, default=100)
+    args = parser.parse_args()
+
+    bundle_dir = tempfile.mkdtemp()
+    os.environ['BUNDLE_DIR'] = bundle_dir
+    # BUNDLE_DIR is read on import
+    from fastapi.testclient import TestClient
+    from api.main import app
+
+    info = run_info()
+    config = {'unified_jobs': args.jobs, 'job_events': args.events}
+    try:
+        with TestClient(app) as client:
+            for concurrency in args.concurrency:
+                uuids = []
+
+                def create(i):
+                    response = client.post(
+                        '/bundles/?process=false', json=config)
+                    response.raise_for_status()
+                    uuids.append(response.json()['bundle_uuid'])
+                    return 0
+
+                def download(i):
+                    response = client.get(
+                        '/bundles/{}'.format(uuids[i % len(uuids)]))
+                    response.raise_for_status()
+                    return len(response.content)
+
+                for name, call in [('POST /bundles/', create),
+                                   ('GET /bundles/{id}', download)]:
+                    result = load(name, call, args.requests, concurrency)
+                    print(json.dumps(dict(info, **config, **result)),
+                          flush=True)
+    finally:
+        shutil.rmtree(bundle_dir)
+
+
+if __name__ == '__main__':
+    main()
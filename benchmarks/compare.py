@@ -0,0 +1,58 @@
+"""
+Compare two runs of a benchmark, e.g. of two commits.
+
+    python -m benchmarks.compare before.jsonl after.jsonl
+
+Results are matched on their parameters (every field that isn't a
+measurement) and the change of each measurement is printed as JSON.
+"""
+import argparse
+import json
+
+# fields that are measured rather than parameters of the run
+METRICS = {'seconds', 'rows_per_s', 'mb_per_s', 'ratio', 'written_bytes',
+           'peak_rss_mb', 'requests_per_s', 'p50_ms', 'p99_ms', 'rows'}
+# fields that differ between the runs being compared
+IGNORED = {'commit', 'python', 'cpus'}
+
+
+def read_results(path):
+    results = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                result = json.loads(line)
+                key = tuple(sorted(
+                    (name, value) for name, value in result.items()
+                    if name not in METRICS | IGNORED))
+                results[key] = result
+    return results
+
+
+def compare(before, after):
+    for key, result in after.items():
+        if key not in before:
+            continue
+        change = dict(key)
+        for name in sorted(METRICS & result.keys()):
+            old, new = before[key].get(name), result[name]
+            change[name] = {
+                'before': old,
+                'after': new,
+                'change': round(new / old - 1, 3) if old else None,
+            }
+        yield change
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args()
+    for change in compare(
+            read_results(args.before), read_results(args.after)):
+        print(json.dumps(change))
+
+
+if __name__ == '__main__':
+    main()
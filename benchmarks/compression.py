@@ -0,0 +1,70 @@
+"""
+Throughput and ratio of the bundle compression modes.
+
+    python -m benchmarks.compression --jobs 1000 --events 200
+
+Prints one JSON object per mode.
+"""
+import argparse
+import json
+import tempfile
+import time
+
+from api.core.generate_data import (TestDataGenerator, compression_settings,
+                                    encode_chunks)
+from api.core.tarstream import TarGzWriter
+from api.main import BundleConfig
+
+from . import run_info
+
+MODES = [
+    {'compression': 'gzip', 'compression_level': 9},
+    {'compression': 'gzip', 'compression_level': 6},
+    {'compression': 'gzip', 'compression_level': 1},
+    {'compression': 'pigz', 'compression_level': 6},
+    {'compression': 'pigz', 'compression_level': 9},
+    {'compression': 'store'},
+]
+
+
+def events_table(jobs, events):
+    generator = TestDataGenerator()
+    generator.configure(BundleConfig(unified_jobs=jobs, job_events=events))
+    return list(encode_chunks(generator.iter_table(
+        'events_table.csv', range(jobs))))
+
+
+def run(chunks, mode, threads):
+    config = BundleConfig(compression_threads=threads, **mode)
+    compresslevel, threads = compression_settings(config)
+    size = sum(len(chunk) for chunk in chunks)
+    with tempfile.TemporaryFile() as f:
+        start = time.time()
+        with TarGzWriter(f, compresslevel, threads=threads) as tar:
+            tar.add_stream('events_table.csv', chunks)
+        elapsed = time.time() - start
+        compressed = f.tell()
+    return dict(
+        mode,
+        threads=threads,
+        seconds=round(elapsed, 3),
+        mb_per_s=round(size / elapsed / 1e6, 1),
+        ratio=round(size / compressed, 2),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--jobs', type=int, default=1000)
+    parser.add_argument('--events', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=0,
+                        help='pigz threads, default: all cores')
+    args = parser.parse_args()
+    info = run_info()
+    chunks = events_table(args.jobs, args.events)
+    for mode in MODES:
+        print(json.dumps(dict(info, **run(chunks, mode, args.threads))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Bundle download throughput under parallel clients.
+
+    python -m benchmarks.download --size-mb 256 --clients 1 4 16
+
+Starts the API with uvicorn on a temporary BUNDLE_DIR, downloads a random
+bundle with each number of clients (whole file and 4 ranges per client)
+and prints one JSON object per run.
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from . import run_info
+
+BUNDLE_ID = 'b' * 32
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(url, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url)
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('{} did not come up'.format(url))
+
+
+def download(url, headers=None):
+    request = urllib.request.Request(url, headers=headers or {})
+    size = 0
+    with urllib.request.urlopen(request) as response:
+        while True:
+            chunk = response.read(1 << 20)
+            if not chunk:
+                return size
+            size += len(chunk)
+
+
+def run(url, clients, size, ranged):
+    if ranged:
+        part = size // 4
+        requests = [
+            {'Range': 'bytes={}-{}'.format(i * part, (i + 1) * part - 1)}
+            for i in range(4)
+        ] * clients
+    else:
+        requests = [None] * clients
+    start = time.time()
+    with ThreadPoolExecutor(len(requests)) as executor:
+        total = sum(executor.map(lambda h: download(url, h), requests))
+    elapsed = time.time() - start
+    return {
+        'clients': clients,
+        'ranged': ranged,
+        'seconds': round(elapsed, 3),
+        'mb_per_s': round(total / elapsed / 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16])
+    args = parser.parse_args()
+    size = args.size_mb << 20
+    bundle_dir = tempfile.mkdtemp()
+    bundle = os.path.join(
+        bundle_dir, '{}_data_bundle.tar.gz'.format(BUNDLE_ID))
+    with open(bundle, 'wb') as f:
+        for _ in range(args.size_mb):
+            f.write(os.urandom(1 << 20))
+
+    port = free_port()
+    env = dict(os.environ, BUNDLE_DIR=bundle_dir,
+               BUNDLE_DOWNLOAD_LIMIT=str(max(args.clients) * 4))
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', '--port', str(port),
+         '--log-level', 'warning', 'api.main:app'], env=env)
+    try:
+        base = 'http://127.0.0.1:{}'.format(port)
+        wait_until_up(base + '/')
+        url = '{}/bundles/{}/download'.format(base, BUNDLE_ID)
+        info = run_info()
+        for clients in args.clients:
+            for ranged in (False, True):
+                print(json.dumps(
+                    dict(info, **run(url, clients, size, ranged))))
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(bundle_dir)
+
+
+if __name__ == '__main__':
+    main()
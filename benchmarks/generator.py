@@ -0,0 +1,129 @@
+"""
+Bundle generation throughput per stage over a sweep of BundleConfigs.
+
+    python -m benchmarks.generator --jobs 100 1000 --events 10 100 \
+        --hosts 1 100 > generator.jsonl
+
+Every combination of `--jobs` x `--events` x `--hosts` is run through
+each stage in a fresh process, so its peak RSS is its own:
+
+- rows: generating the rows of the tables, nothing is kept or written
+- write: encoding the rows and writing them uncompressed to a file
+- bundle: the whole bundle as `TestDataGenerator.write_bundle` writes it
+
+Prints one JSON object per combination and stage.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+from api.core.generate_data import (TABLES, TestDataGenerator, encode_chunks,
+                                    get_bundle_path)
+from api.main import BundleConfig
+
+from . import peak_rss_mb, run_info
+
+STAGES = ['rows', 'write', 'bundle']
+
+
+def stage_rows(generator, bundle_config, path):
+    size = 0
+    for filename in TABLES:
+        for block in generator._count_rows(generator.iter_table(
+                filename, generator.job_ids())):
+            size += len(block)
+    return size, 0
+
+
+def stage_write(generator, bundle_config, path):
+    size = 0
+    with open(path, 'wb') as f:
+        for filename in TABLES:
+            for chunk in encode_chunks(generator._count_rows(
+                    generator.iter_table(filename, generator.job_ids()))):
+                size += len(chunk)
+                f.write(chunk)
+    return size, size
+
+
+def stage_bundle(generator, bundle_config, path):
+    generator.write_bundle(bundle_config, path, bundle_config.workers)
+    return None, os.stat(path).st_size
+
+
+def tables_size(generator):
+    return sum(
+        len(chunk) for filename in TABLES for chunk in encode_chunks(
+            generator.iter_table(filename, generator.job_ids())))
+
+
+def run(stage, config, results):
+    """Run one stage on `config` (a BundleConfig dict) and send the result."""
+    bundle_config = BundleConfig(**config)
+    generator = TestDataGenerator()
+    generator.configure(bundle_config)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bundle')
+        start = time.time()
+        size, written = globals()['stage_' + stage](
+            generator, bundle_config, path)
+        elapsed = time.time() - start
+    if size is None:
+        size = tables_size(generator)
+    results.send({
+        'stage': stage,
+        'unified_jobs': bundle_config.unified_jobs,
+        'job_events': bundle_config.job_events,
+        'hosts_count': bundle_config.hosts_count,
+        'compression': bundle_config.compression,
+        'workers': bundle_config.workers,
+        'rows': generator.rows_written,
+        'seconds': round(elapsed, 3),
+        'rows_per_s': round(generator.rows_written / elapsed),
+        'mb_per_s': round(size / elapsed / 1e6, 1),
+        'written_bytes': written,
+        'peak_rss_mb': peak_rss_mb(),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--jobs', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--events', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--hosts', type=int, nargs='+', default=[1, 100])
+    parser.add_argument('--stages', nargs='+', default=STAGES,
+                        choices=STAGES)
+    parser.add_argument('--compression', default='gzip')
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+    info = run_info()
+    # `write_bundle` writes the partial bundle into BUNDLE_DIR
+    os.makedirs(os.path.dirname(get_bundle_path('')), exist_ok=True)
+    for jobs, events, hosts in itertools.product(
+            args.jobs, args.events, args.hosts):
+        config = {
+            'unified_jobs': jobs,
+            'job_events': events,
+            'hosts_count': hosts,
+            'compression': args.compression,
+            'workers': args.workers,
+            'bundle_uuid': 'benchmark{}'.format(os.getpid()),
+        }
+        for stage in args.stages:
+            # not a Pool, its daemonic workers can't start `workers`
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(
+                target=run, args=(stage, config, sender))
+            process.start()
+            result = receiver.recv()
+            process.join()
+            print(json.dumps(dict(info, **result)), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,15 @@
+import pytest
+
+from api.core.registry import BUNDLE_REGISTRY
+
+
+@pytest.fixture(autouse=True)
+def bundle_registry(tmp_path_factory, monkeypatch):
+    """Keep the bundle registry of every test in its own database."""
+    registry_dir = tmp_path_factory.mktemp('registry')
+    monkeypatch.setattr(
+        BUNDLE_REGISTRY, 'path', str(registry_dir / 'registry.sqlite3'))
+    monkeypatch.setattr(BUNDLE_REGISTRY, 'db', None)
+    yield BUNDLE_REGISTRY
+    if BUNDLE_REGISTRY.db:
+        BUNDLE_REGISTRY.db.close()
@@ -0,0 +1,99 @@
+import threading
+import time
+
+import pytest
+
+from api.core.admission import Admission, Overloaded, Rejected, TooLarge
+from api.core.generate_data import bundle_cost, coordinator_cost
+from api.main import BundleConfig
+
+
+def cost(rows, cpus=1, memory=0):
+    return {'rows': rows, 'cpus': cpus, 'memory': memory}
+
+
+def test_too_large():
+    admission = Admission(rows=10, small_rows=0)
+    with pytest.raises(TooLarge):
+        admission.acquire(cost(100))
+    with pytest.raises(TooLarge):
+        admission.check(cost(5, cpus=1000))
+    admission.check(cost(10))
+    assert admission.stats()['large']['running'] == 0
+    assert admission.stats()['large']['rejected'] == {'too_large': 2}
+
+
+def test_waits_for_budget():
+    admission = Admission(rows=10, small_rows=0, timeout=5)
+    ticket = admission.acquire(cost(8))
+    admitted = []
+    waiter = threading.Thread(
+        target=lambda: admitted.append(admission.acquire(cost(5))))
+    waiter.start()
+    time.sleep(0.05)
+    assert not admitted
+    assert admission.stats()['large']['waiting'] == 1
+    admission.release(ticket)
+    waiter.join(1)
+    assert admitted
+    assert admission.stats()['large']['used']['rows'] == 5
+
+
+def test_rejections():
+    admission = Admission(rows=10, small_rows=0, max_waiting=1,
+                          timeout=0.1)
+    admission.acquire(cost(10))
+    with pytest.raises(Rejected) as rejected:
+        admission.acquire(cost(10))
+    assert not isinstance(rejected.value, Overloaded)
+    assert rejected.value.retry_after >= 1
+    waiter = threading.Thread(target=admission.acquire,
+                              args=(cost(10), True))
+    waiter.daemon = True
+    waiter.start()
+    time.sleep(0.05)
+    with pytest.raises(Overloaded):
+        admission.acquire(cost(10))
+    assert admission.stats()['large']['rejected'] == {
+        'timeout': 1, 'queue_full': 1}
+
+
+def test_small_builds_skip_large_ones():
+    admission = Admission(rows=10, cpus=2, small_rows=5, small_slots=1,
+                          timeout=0.1)
+    admission.acquire(cost(10, cpus=2))
+    with admission.admit(cost(5)):
+        with pytest.raises(Rejected):
+            admission.acquire(cost(5))
+    # more than one cpu is never small
+    with pytest.raises(Rejected):
+        admission.acquire(cost(5, cpus=2))
+
+
+def test_bundle_cost():
+    small = bundle_cost(BundleConfig(unified_jobs=10, job_events=9))
+    large = bundle_cost(BundleConfig(
+        unified_jobs=10, job_events=9, hosts_count=1000, workers=2))
+    assert small['rows'] == large['rows'] == 100 + 1 + 1
+    assert large['memory'] > small['memory']
+    # the templates and orgs rolled up from the jobs
+    rolled_up = bundle_cost(BundleConfig(
+        unified_jobs=10, job_events=9, templates_count=10 ** 6,
+        orgs_count=5))
+    assert rolled_up['rows'] == 100 + 10 + 5
+    assert rolled_up['memory'] > small['memory']
+    # the nodes generate the tables of a sharded bundle
+    coordinator = coordinator_cost(BundleConfig(
+        unified_jobs=10, job_events=9, templates_count=10 ** 6,
+        orgs_count=5, workers=2))
+    assert coordinator['rows'] == 10 + 5
+    assert coordinator['cpus'] == 1
+
+
+def test_budget_shared_by_workers():
+    admission = Admission(rows=10, cpus=4, memory_mb=1, small_slots=3,
+                          workers=2)
+    stats = admission.stats()
+    assert stats['large']['capacity'] == {
+        'rows': 5, 'cpus': 2, 'memory': 1 << 19}
+    assert stats['small']['capacity'] == {'builds': 1}
@@ -0,0 +1,80 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+from api.core import archive
+from api.core.archive import build_index, index_path, load_index
+from api.core.tarstream import TarGzWriter
+
+TABLE = b''.join(b'%d,row %d\n' % (i, i) for i in range(1000))
+
+
+@pytest.fixture
+def bundle(mocker, tmp_path):
+    mocker.patch('api.core.tarstream.INDEX_SPAN', 1000)
+    mocker.patch('api.core.archive.READ_SIZE', 256)
+    path = str(tmp_path / 'a_data_bundle.tar.gz')
+    with open(path, 'wb') as f, TarGzWriter(f) as tar:
+        tar.add_bytes('config.json', b'{}')
+        tar.add_stream('table.csv', [TABLE[i:i + 300]
+                                     for i in range(0, len(TABLE), 300)])
+    return path
+
+
+def test_build_index(bundle):
+    index = build_index(bundle)
+    assert [(m['name'], m['size']) for m in index['members']] == [
+        ('config.json', 2), ('table.csv', len(TABLE))]
+    # a gzip member per 1000 bytes of the table
+    assert len(index['checkpoints']) > len(TABLE) // 1000
+    with tarfile.open(bundle) as tar:
+        assert tar.getmember('table.csv').offset_data == \
+            index['members'][1]['offset']
+
+
+def test_load_index_is_cached(mocker, bundle):
+    index = load_index(bundle)
+    assert os.path.exists(index_path(bundle))
+    build = mocker.patch('api.core.archive.build_index')
+    assert load_index(bundle).members == index.members
+    build.assert_not_called()
+
+
+@pytest.mark.parametrize('offset,limit', [
+    (0, 1), (0, 0), (1, 3), (499, 2), (998, 5), (1000, 1), (2000, 1),
+    (3, None)])
+def test_read_lines(bundle, offset, limit):
+    lines = TABLE.splitlines(keepends=True)
+    expected = lines[offset:] if limit is None else \
+        lines[offset:offset + limit]
+    assert load_index(bundle).read_lines('table.csv', offset, limit) == \
+        b''.join(expected)
+
+
+def test_read_bytes(bundle):
+    index = load_index(bundle)
+    assert index.read_bytes('table.csv', 4321, 77) == TABLE[4321:4398]
+    assert index.read_bytes('table.csv') == TABLE
+    assert index.read_bytes('config.json', 5) == b''
+
+
+def test_read_other_tar_gz(tmp_path):
+    path = str(tmp_path / 'other.tar.gz')
+    with tarfile.open(path, 'w:gz') as tar:
+        info = tarfile.TarInfo('table.csv')
+        info.size = len(TABLE)
+        tar.addfile(info, io.BytesIO(TABLE))
+    index = load_index(path)
+    assert len(index.checkpoints) == 1
+    assert index.read_lines('table.csv', 10, 1) == b'10,row 10\n'
+
+
+def test_stale_index_is_rebuilt(bundle):
+    load_index(bundle)
+    with open(bundle, 'ab') as f:
+        f.write(b'\0' * 10)
+    os.utime(bundle, ns=(1, 1))
+    assert load_index(bundle).read_lines('table.csv', 0, 1) == b'0,row 0\n'
+    assert archive._load(bundle, os.path.getsize(bundle), 1) is not None
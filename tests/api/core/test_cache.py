@@ -0,0 +1,84 @@
+import datetime
+import os
+from collections import OrderedDict
+
+from api.core.cache import BundleCache
+from api.main import BundleConfig
+
+
+def make_bundle(path, size):
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    return path
+
+
+def test_key_ignores_non_data_fields():
+    cache = BundleCache(max_bytes=1)
+    day = datetime.date(2020, 3, 1)
+    key = cache.key(BundleConfig(unified_jobs=2), day)
+    assert cache.key(
+        BundleConfig(unified_jobs=2, bundle_uuid='a', workers=4), day) == key
+    assert cache.key(BundleConfig(unified_jobs=3), day) != key
+    assert cache.key(
+        BundleConfig(unified_jobs=2), datetime.date(2020, 3, 2)) != key
+
+
+def test_disabled_cache(tmp_path):
+    cache = BundleCache(str(tmp_path / 'cache'), max_bytes=0)
+    bundle = make_bundle(str(tmp_path / 'a.tar.gz'), 10)
+    cache.store(BundleConfig(), bundle)
+    assert not cache.fetch(BundleConfig(), str(tmp_path / 'b.tar.gz'))
+    assert not os.path.exists(str(tmp_path / 'cache'))
+
+
+def test_fetch_and_store(tmp_path):
+    cache = BundleCache(str(tmp_path / 'cache'), max_bytes=100)
+    config = BundleConfig(unified_jobs=5)
+    first = str(tmp_path / 'first.tar.gz')
+    assert not cache.fetch(config, first)
+    cache.store(config, make_bundle(first, 10))
+    second = str(tmp_path / 'second.tar.gz')
+    assert cache.fetch(config, second)
+    assert os.path.samefile(first, second)
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (1, 1)
+    assert (stats['entries'], stats['bytes']) == (1, 10)
+
+
+def test_lru_eviction(tmp_path):
+    cache = BundleCache(str(tmp_path / 'cache'), max_bytes=25)
+    configs = [BundleConfig(unified_jobs=i) for i in range(3)]
+    for i, config in enumerate(configs[:2]):
+        cache.store(config, make_bundle(str(tmp_path / str(i)), 10))
+    assert cache.fetch(configs[0], str(tmp_path / 'hit'))
+    cache.store(configs[2], make_bundle(str(tmp_path / '2'), 10))
+    assert cache.stats()['evictions'] == 1
+    assert not cache.fetch(configs[1], str(tmp_path / 'miss'))
+    assert cache.fetch(configs[0], str(tmp_path / 'hit0'))
+    assert cache.fetch(configs[2], str(tmp_path / 'hit2'))
+
+
+def test_key_of_reference_time():
+    cache = BundleCache(max_bytes=1)
+    config = BundleConfig(reference_time='2020-03-01T12:00:00')
+    assert cache.key(config) == cache.key(config, datetime.date(2020, 3, 1))
+
+
+def test_store_existing_entry(mocker, tmp_path):
+    config = BundleConfig(unified_jobs=5)
+    first = make_bundle(str(tmp_path / 'first.tar.gz'), 10)
+    BundleCache(str(tmp_path / 'cache'), max_bytes=100).store(config, first)
+    # another worker with its own index stores the same bundle
+    cache = BundleCache(str(tmp_path / 'cache'), max_bytes=100)
+    cache.entries = OrderedDict()
+    cache.store(config, make_bundle(str(tmp_path / 'other.tar.gz'), 10))
+    assert os.path.samefile(first, cache.path(cache.key(config)))
+
+    mocker.patch('os.link', side_effect=OSError('cross-device link'))
+    second = str(tmp_path / 'second.tar.gz')
+    assert cache.fetch(config, second)
+    assert not os.path.samefile(first, second)
+    with open(second, 'rb') as f:
+        assert f.read() == b'x' * 10
+    assert not [name for name in os.listdir(str(tmp_path))
+                if name.endswith('.part')]
@@ -0,0 +1,44 @@
+import gzip
+import json
+
+from api.core.columns import (ColumnSpool, Labels, compress_blocks,
+                              join_blocks, manifest, npy_header)
+
+
+def test_npy_header():
+    header = npy_header('<i8', 3)
+    assert header.startswith(b'\x93NUMPY\x01\x00')
+    assert len(header) % 64 == 0
+    assert header.endswith(b'\n')
+    assert b"'shape': (3,)" in header
+
+
+def test_labels():
+    labels = Labels('host_', 100)
+    assert labels.width == 7
+    assert labels[5] == b'host_5\0'
+
+
+def test_join_blocks():
+    blocks = [(1, {'a': b'%d' % i}) for i in range(5)]
+    assert list(join_blocks(blocks, rows=2)) == [
+        (2, {'a': b'01'}), (2, {'a': b'23'}), (1, {'a': b'4'})]
+
+
+def test_manifest():
+    data = json.dumps({'events_table.csv': '1.0', 'config.json': '1.0'})
+    versions = json.loads(manifest(data, ['events_table.csv'], csv=False))
+    assert 'events_table.csv' not in versions
+    assert versions['events_table/id.npy'] == '1.0'
+    assert versions['config.json'] == '1.0'
+
+
+def test_column_spool(tmp_path):
+    with ColumnSpool({'a': '|S1'}, dir=str(tmp_path)) as spool:
+        spool.write([(2, {'a': b'xy'})])
+        spool.add_segment(compress_blocks([(1, {'a': b'z'})]))
+        segments = list(spool.segments('a'))
+    header = npy_header('|S1', 3)
+    assert segments[0][1] == len(header) + 3
+    assert gzip.decompress(b''.join(
+        segment for segment, _ in segments)) == header + b'xyz'
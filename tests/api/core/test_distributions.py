@@ -0,0 +1,52 @@
+from collections import Counter
+
+import pytest
+from pydantic import ValidationError
+
+from api.core.distributions import SAMPLES, samplers
+from api.main import BundleConfig
+
+
+def test_zipf_is_skewed():
+    config = BundleConfig(hosts_count=1000,
+                          distributions={'host': {'zipf': 1.5}})
+    hosts = Counter(samplers(config)['host'])
+    assert max(hosts) < 1000
+    assert hosts[0] > hosts[1] > hosts[10]
+    assert hosts[0] > SAMPLES * 0.3
+
+
+def test_weights():
+    config = BundleConfig(spread_days_back=5, distributions={
+        'day': {'weights': [0, 3, 1, 0, 0, 7]},
+        'status': {'weights': {'successful': 3, 'failed': 1}},
+    })
+    sequences = samplers(config)
+    assert set(sequences['day']) == {1, 2}
+    statuses = Counter(sequences['status'])
+    assert set(statuses) == {'successful', 'failed'}
+    assert 2.5 < statuses['successful'] / statuses['failed'] < 3.5
+
+
+def test_seed():
+    def hosts(seed):
+        return samplers(BundleConfig(
+            hosts_count=10, seed=seed,
+            distributions={'host': {'zipf': 1}}))['host']
+    assert hosts(1) == hosts(1)
+    assert hosts(1) != hosts(2)
+
+
+@pytest.mark.parametrize('distributions', [
+    {'host': {}},
+    {'host': {'zipf': 1, 'weights': [1]}},
+    {'host': {'zipf': -1}},
+    {'host': {'weights': {'a': 1}}},
+    {'template': {'weights': [0, 0, 1]}},
+    {'status': {'weights': [1, 2]}},
+    {'status': {'weights': {'running': 1}}},
+    {'unknown': {'zipf': 1}},
+])
+def test_invalid_distributions(distributions):
+    with pytest.raises(ValidationError):
+        BundleConfig(templates_count=2, distributions=distributions)
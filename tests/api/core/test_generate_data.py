@@ -1,9 +1,24 @@
+import ast
+import csv
+import io
+import json
 import os
-from datetime import datetime
+import tarfile
+from array import array
+from collections import Counter
+from datetime import datetime, timedelta
+from unittest import mock
 from pathlib import Path
 
 import pytest
-from api.core.generate_data import notify_upload
+from api.core.cache import BundleCache
+from api.core.columns import COLUMNS, column_path
+from api.core.generate_data import (
+    EVENT_LINE, FILES, STATIC_FILES, TABLES, TestDataGenerator,
+    encode_chunks, get_bundle_path, notify_upload, sample_data)
+from api.core.metrics import BUNDLES, IN_PROGRESS, ROWS, trace
+from api.core.rollup import ROLLUP_FILES
+from api.main import BundleConfig
 
 def test_notify_upload(mocker):
     url = 'a_url'
@@ -32,3 +47,423 @@ def test_notify_upload(mocker):
         'url': '{}/bundles/{}?done=True'.format(url, bundle_id)
     }
     produce_upload_message.assert_called_once_with(payload)
+
+
+def test_encode_chunks():
+    lines = ['{}\n'.format(i) for i in range(100)]
+    chunks = list(encode_chunks(lines, header=b'id\n', chunk_size=50))
+    assert all(len(chunk) < 60 for chunk in chunks)
+    assert b''.join(chunks).decode() == 'id\n' + ''.join(lines)
+
+
+def read_tables(bundle):
+    with tarfile.open(bundle) as tar:
+        assert sorted(tar.getnames()) == FILES
+        return {name: tar.extractfile(name).read() for name in TABLES}
+
+
+def test_generate_bundle_streams_tables(mocker, tmp_path):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    config = BundleConfig(unified_jobs=3, job_events=4, bundle_uuid='2' * 32)
+    bundle = TestDataGenerator().generate_bundle(config)
+    assert os.listdir(str(tmp_path)) == [os.path.basename(bundle)]
+    tables = read_tables(bundle)
+    events = tables['events_table.csv'].splitlines()
+    jobs = tables['unified_jobs_table.csv'].splitlines()
+    assert len(events) == 1 + 3 * 4
+    assert len(jobs) == 1 + 3
+    assert events[-1].startswith(b'13,')
+    with tarfile.open(bundle) as tar:
+        for filename in STATIC_FILES:
+            content = tar.extractfile(filename).read()
+            assert content == sample_data()[filename]
+
+
+def test_generate_bundle_failed(mocker, tmp_path):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    mocker.patch('api.core.generate_data.TestDataGenerator.iter_table',
+                 side_effect=OSError('disk full'))
+    with pytest.raises(OSError):
+        TestDataGenerator().generate_bundle(
+            BundleConfig(unified_jobs=3, bundle_uuid='5' * 32))
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_generate_bundle_with_workers(mocker, tmp_path):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    mocker.patch('api.core.generate_data.SEGMENT_ROWS', 10)
+    mocker.patch('api.core.generate_data.os.cpu_count', return_value=4)
+    config = BundleConfig(unified_jobs=25, job_events=7, hosts_count=3)
+    config.bundle_uuid = '3' * 32
+    serial = read_tables(TestDataGenerator().generate_bundle(config))
+    config.bundle_uuid = '4' * 32
+    config.workers = 3
+    parallel = read_tables(TestDataGenerator().generate_bundle(config))
+    assert parallel == serial
+
+
+@pytest.mark.parametrize('compression', ['pigz', 'store'])
+def test_generate_bundle_compression(mocker, tmp_path, compression):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    mocker.patch('api.core.generate_data.CHUNK_SIZE', 1000)
+    config = BundleConfig(unified_jobs=10, job_events=20)
+    config.bundle_uuid = '6' * 32
+    gzip_bundle = TestDataGenerator().generate_bundle(config)
+    config.bundle_uuid = '7' * 32
+    config.compression = compression
+    config.compression_threads = 2
+    bundle = TestDataGenerator().generate_bundle(config)
+    assert read_tables(bundle) == read_tables(gzip_bundle)
+    if compression == 'store':
+        assert os.stat(bundle).st_size > os.stat(gzip_bundle).st_size
+
+
+@pytest.mark.parametrize('block_size,cache_size', [(10000, 1 << 20), (3, 0)])
+def test_iter_job_events_matches_event_line(mocker, block_size, cache_size):
+    mocker.patch('api.core.generate_data.EVENT_BLOCK_SIZE', block_size)
+    mocker.patch('api.core.generate_data.EVENT_PREFIX_CACHE_SIZE', cache_size)
+    generator = TestDataGenerator()
+    generator.starting_event_id = 7
+    jobs, events, tasks, spread, day, hosts = 5, 70, 3, 2, 1, 4
+    expected = []
+    for job_id in range(jobs):
+        for event_id in range(events):
+            id = 7 + (events + 1) * job_id + event_id
+            expected.append(EVENT_LINE.format(
+                id=id,
+                created=generator._default_date_time(
+                    job_id % spread + day, event_id % 60),
+                failed=generator._failed_event(event_id),
+                changed=generator._changed_event(event_id),
+                module_id=event_id % tasks,
+                job_id=job_id,
+                host_id=id % hosts))
+    rows = generator.iter_job_events(
+        range(jobs), events, tasks, spread, day, hosts)
+    assert ''.join(rows) == ''.join(expected)
+
+
+def test_fan_out():
+    template = BundleConfig(
+        unified_jobs=3, job_events=4, starting_event_id=100)
+    tenants = [mock.Mock(tenant_id=1, account_id=''),
+               mock.Mock(tenant_id=2, account_id='acct_2')]
+    configs = TestDataGenerator().fan_out(template, tenants, 2)
+    assert [c.tenant_id for c in configs] == [1, 1, 2, 2]
+    assert [c.account_id for c in configs] == ['1', '1', 'acct_2', 'acct_2']
+    assert [c.starting_event_id for c in configs] == [100, 115, 130, 145]
+    assert len({c.bundle_uuid for c in configs}) == 4
+    assert len({c.install_uuid for c in configs}) == 4
+
+
+def test_generate_fleet(mocker, tmp_path, bundle_registry):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    generator = TestDataGenerator()
+    configs = generator.fan_out(
+        BundleConfig(unified_jobs=2, job_events=3),
+        [mock.Mock(tenant_id=1, account_id='')], 3)
+    stats = generator.generate_fleet(configs, workers=2)
+    assert stats['bundles'] == 3
+    assert stats['rows'] == 3 * 2 * 4
+    assert len(bundle_registry.list()) == 3
+    event_ids = set()
+    for config in configs:
+        tables = read_tables(
+            str(tmp_path / '{}_data_bundle.tar.gz'.format(config.bundle_uuid)))
+        rows = tables['events_table.csv'].splitlines()[1:]
+        event_ids.update(row.split(b',')[0] for row in rows)
+    assert len(event_ids) == 3 * 2 * 3
+
+
+def test_series(mocker, tmp_path, bundle_registry):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    generator = TestDataGenerator()
+    day = 24 * 3600
+    collected = datetime(2020, 5, 1, 12).timestamp()
+    events = []
+    for i, (jobs, job_events) in enumerate([(3, 2), (2, 4), (4, 1)]):
+        config = generator.next_in_series(
+            BundleConfig(install_uuid='install', bundle_uuid=str(i),
+                         unified_jobs=jobs, job_events=job_events),
+            now=collected + i * 3 * day)
+        generator.generate_bundle(config)
+        tables = read_tables(str(tmp_path / '{}_data_bundle.tar.gz'.format(i)))
+        job_ids = [int(row.split(b',')[0]) for row in
+                   tables['unified_jobs_table.csv'].splitlines()[1:]]
+        events.append([int(row.split(b',')[0]) for row in
+                       tables['events_table.csv'].splitlines()[1:]])
+        if i:
+            # the first bundle ended yesterday 01:21
+            assert (config.starting_day, config.spread_days_back) == (
+                0, 5 if i == 1 else 3)
+        assert job_ids == list(range(config.starting_job_id,
+                                     config.starting_job_id + jobs))
+    assert [len(ids) for ids in events] == [6, 8, 4]
+    assert events[0][-1] < events[1][0] and events[1][-1] < events[2][0]
+    cursor = bundle_registry.series('install')
+    assert (cursor['last_job_id'], cursor['bundles']) == (8, 3)
+
+
+def test_series_minutes_apart(mocker, tmp_path, bundle_registry):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    generator = TestDataGenerator()
+    collected = datetime(2020, 5, 1, 12, 0, 30).timestamp()
+    timestamps = []
+    for i, minutes in enumerate([0, 10, 10.2, 95]):
+        config = generator.next_in_series(
+            BundleConfig(install_uuid='install', bundle_uuid=str(i),
+                         unified_jobs=3, job_events=2),
+            now=collected + minutes * 60)
+        generator.generate_bundle(config)
+        tables = read_tables(str(tmp_path / '{}_data_bundle.tar.gz'.format(i)))
+        rows = tables['unified_jobs_table.csv'].decode().splitlines()[1:]
+        created = sorted(row.split(',')[5] for row in rows)
+        assert created[-1] < datetime.fromtimestamp(
+            collected + minutes * 60 + 60).astimezone().isoformat()
+        timestamps.append(created)
+    # every bundle is newer than the one before
+    for before, after in zip(timestamps, timestamps[1:]):
+        assert before[-1] < after[0]
+    assert timestamps[1][-1].startswith('2020-05-01T12:10:')
+    assert timestamps[2][-1].startswith('2020-05-01T12:11:')
+    assert timestamps[3][-1].startswith('2020-05-01T13:35:')
+
+
+def test_series_needs_install_uuid():
+    with pytest.raises(ValueError):
+        TestDataGenerator().next_in_series(BundleConfig())
+
+
+def test_generate_bundle_metrics(mocker, tmp_path):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    bundles = BUNDLES.get(cached='false')
+    rows = ROWS.get()
+    config = BundleConfig(unified_jobs=3, job_events=4, bundle_uuid='3' * 32)
+    with trace() as breakdown:
+        TestDataGenerator().generate_bundle(config)
+    assert BUNDLES.get(cached='false') == bundles + 1
+    assert ROWS.get() == rows + 3 * 5
+    assert IN_PROGRESS.get() == 0
+    assert {'rows', 'write', 'compress', 'register'} <= set(breakdown)
+
+
+def test_reference_time_is_reproducible(mocker, tmp_path):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    config = BundleConfig(
+        unified_jobs=4, job_events=3, bundle_uuid='8' * 32,
+        reference_time='2020-05-01T23:59:59+02:00')
+    first = Path(TestDataGenerator().generate_bundle(config)).read_bytes()
+    config.bundle_uuid = '9' * 32
+    second = Path(TestDataGenerator().generate_bundle(config)).read_bytes()
+    assert first == second
+    mocker.patch('api.core.generate_data.os.cpu_count', return_value=2)
+    serial = read_tables(get_bundle_path(config.bundle_uuid))
+    config.bundle_uuid = 'a' * 32
+    config.workers = 2
+    assert read_tables(TestDataGenerator().generate_bundle(config)) == serial
+    jobs = read_tables(get_bundle_path(config.bundle_uuid))[
+        'unified_jobs_table.csv'].splitlines()[1:]
+    assert b',2020-04-30T01:21:00.840210+02:00,' in jobs[0]
+    # day 0 is the default day 1 outside of a series
+    config.bundle_uuid = 'b' * 32
+    config.starting_day = 0
+    assert read_tables(TestDataGenerator().generate_bundle(config)) == serial
+
+
+def test_generate_bundle_cached_past_midnight(mocker, tmp_path):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    cache = BundleCache(str(tmp_path / 'cache'), max_bytes=1 << 30)
+    mocker.patch('api.core.generate_data.BUNDLE_CACHE', cache)
+    generator = TestDataGenerator()
+    write_bundle = generator.write_bundle
+
+    def write_until_midnight(*args):
+        write_bundle(*args)
+        date = mocker.patch('api.core.cache.datetime.date')
+        date.today.return_value = datetime.now().date() + timedelta(days=1)
+
+    mocker.patch.object(generator, 'write_bundle',
+                        side_effect=write_until_midnight)
+    config = BundleConfig(bundle_uuid='1' * 32)
+    generator.generate_bundle(config)
+    # stored under the day of its timestamps
+    assert os.path.exists(
+        cache.path(cache.key(config, generator.reference_time.date())))
+
+
+def test_fan_out_seed():
+    template = BundleConfig(seed=42)
+    tenants = [mock.Mock(tenant_id=1, account_id='')]
+    first = TestDataGenerator().fan_out(template, tenants, 2)
+    second = TestDataGenerator().fan_out(template, tenants, 2)
+    assert [c.install_uuid for c in first] == \
+        [c.install_uuid for c in second]
+    assert first[0].install_uuid != first[1].install_uuid
+    assert first[0].bundle_uuid != second[0].bundle_uuid
+
+
+def test_generate_bundle_distributions(mocker, tmp_path):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    mocker.patch('api.core.generate_data.SEGMENT_ROWS', 10)
+    mocker.patch('api.core.generate_data.os.cpu_count', return_value=2)
+    config = BundleConfig(
+        unified_jobs=20, job_events=5, hosts_count=50, templates_count=10,
+        bundle_uuid='b' * 32, distributions={
+            'host': {'zipf': 2},
+            'template': {'weights': [0, 1]},
+            'status': {'weights': {'error': 1}},
+        })
+    tables = read_tables(TestDataGenerator().generate_bundle(config))
+    jobs = [row.split(b',') for row in
+            tables['unified_jobs_table.csv'].splitlines()[1:]]
+    assert {job[6] for job in jobs} == {b'template_name_1'}
+    assert {job[13] for job in jobs} == {b'error'}
+    hosts = Counter(row.rsplit(b',', 1)[1] for row in
+                    tables['events_table.csv'].splitlines()[1:])
+    assert hosts.most_common(1)[0][0] == b'"host_name_0"'
+    config.bundle_uuid = 'c' * 32
+    config.workers = 2
+    assert read_tables(TestDataGenerator().generate_bundle(config)) == tables
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_generate_bundle_rollups(mocker, tmp_path, workers):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    mocker.patch('api.core.generate_data.SEGMENT_ROWS', 10)
+    mocker.patch('api.core.generate_data.os.cpu_count', return_value=2)
+    config = BundleConfig(
+        unified_jobs=30, job_events=2, templates_count=40, orgs_count=3,
+        hosts_count=100, failed_job_threshold=150, workers=workers,
+        bundle_uuid='d' * 32)
+    bundle = TestDataGenerator().generate_bundle(config)
+    with tarfile.open(bundle) as tar:
+        def read(name):
+            return tar.extractfile(name).read()
+        jobs = [row.split(b',') for row in
+                read('unified_jobs_table.csv').splitlines()[1:]]
+        templates = [row.split(b',') for row in
+                     read('unified_job_template_table.csv').splitlines()[1:]]
+        counts = json.loads(read('counts.json'))
+        job_counts = json.loads(read('job_counts.json'))
+        org_counts = json.loads(read('org_counts.json'))
+        inventory_counts = json.loads(read('inventory_counts.json'))
+    assert len(templates) == 30
+    last_jobs = {}
+    for job in jobs:
+        assert job[6] == b'template_name_' + job[7]
+        last_jobs[int(job[7])] = job
+    for template in templates:
+        job = last_jobs[int(template[0])]
+        assert (template[9], template[11], template[14]) == \
+            (job[0], job[16], job[13])
+    assert job_counts['total_jobs'] == counts['unified_job'] == 30
+    assert job_counts['status'] == {'successful': 30}
+    assert (counts['job_template'], counts['organization']) == (30, 3)
+    assert sorted(org_counts) == ['0', '1', '2']
+    assert counts['active_host_count'] == \
+        inventory_counts['1']['hosts'] == 30 * 2
+
+
+def test_rollups_of_the_generated_jobs(mocker, tmp_path):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    config = BundleConfig(unified_jobs=2, templates_count=10 ** 9,
+                          orgs_count=10 ** 9, bundle_uuid='9' * 32)
+    streamed = tmp_path / 'streamed.tar.gz'
+    streamed.write_bytes(b''.join(TestDataGenerator().stream_bundle(config)))
+    for bundle in [TestDataGenerator().generate_bundle(config), streamed]:
+        with tarfile.open(str(bundle)) as tar:
+            templates = tar.extractfile(
+                'unified_job_template_table.csv').read()
+            org_counts = json.loads(tar.extractfile('org_counts.json').read())
+        assert len(templates.splitlines()) == 3
+        assert sorted(org_counts) == ['0', '1']
+
+
+def read_column(data):
+    """The values of a .npy column, without NumPy."""
+    header_size = int.from_bytes(data[8:10], 'little')
+    header = ast.literal_eval(data[10:10 + header_size].decode())
+    body = data[10 + header_size:]
+    dtype, (rows,) = header['descr'], header['shape']
+    if dtype in ('<i8', '<f8'):
+        values = array('q' if dtype == '<i8' else 'd', body)
+    elif dtype == '|b1':
+        values = ['t' if flag else 'f' for flag in body]
+    else:
+        size = int(dtype[2:])
+        values = [body[i:i + size].rstrip(b'\0').decode()
+                  for i in range(0, len(body), size)]
+    assert len(values) == rows
+    return [str(value) for value in values]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_generate_bundle_columns(mocker, tmp_path, workers):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    mocker.patch('api.core.generate_data.SEGMENT_ROWS', 10)
+    mocker.patch('api.core.generate_data.os.cpu_count', return_value=2)
+    mocker.patch('api.core.generate_data.COLUMN_BLOCK_ROWS', 7)
+    config = BundleConfig(
+        unified_jobs=12, job_events=5, hosts_count=11, orgs_count=2,
+        templates_count=3, failed_job_threshold=150, bundle_uuid='e' * 32,
+        reference_time=datetime(2020, 3, 1), table_format='both',
+        workers=workers)
+    bundle = TestDataGenerator().generate_bundle(config)
+    with tarfile.open(bundle) as tar:
+        def read(name):
+            return tar.extractfile(name).read()
+        manifest = json.loads(read('manifest.json'))
+        for filename in TABLES:
+            rows = list(csv.reader(io.StringIO(read(filename).decode())))
+            for i, (column, _) in enumerate(COLUMNS[filename]):
+                assert column == rows[0][i]
+                path = column_path(filename, column)
+                assert manifest[path] == '1.0'
+                assert read_column(read(path)) == [
+                    row[i] for row in rows[1:]]
+        job_counts = json.loads(read('job_counts.json'))
+    assert job_counts['total_jobs'] == 12
+
+    config.bundle_uuid = 'f' * 32
+    config.table_format = 'npy'
+    with tarfile.open(TestDataGenerator().generate_bundle(config)) as tar:
+        names = tar.getnames()
+        assert json.loads(tar.extractfile('job_counts.json').read()) == \
+            job_counts
+        manifest = json.loads(tar.extractfile('manifest.json').read())
+    assert not set(TABLES) & set(names + list(manifest))
+    assert column_path('events_table.csv', 'host_name') in names
+
+
+def test_stream_bundle(mocker, tmp_path):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    mocker.patch('api.core.generate_data.SEGMENT_ROWS', 10)
+    mocker.patch('api.core.generate_data.CHUNK_SIZE', 100)
+    mocker.patch('api.core.generate_data.os.cpu_count', return_value=2)
+    config = BundleConfig(
+        unified_jobs=30, job_events=7, hosts_count=13, templates_count=3,
+        starting_event_id=-50, bundle_uuid='a' * 32, workers=2,
+        reference_time=datetime(2020, 3, 1),
+        distributions={'host': {'zipf': 2}})
+    done = mocker.Mock()
+    chunks = list(TestDataGenerator().stream_bundle(config, on_done=done))
+    done.assert_called_once()
+    assert os.listdir(str(tmp_path)) == []
+    streamed = tmp_path / 'streamed.tar.gz'
+    streamed.write_bytes(b''.join(chunks))
+    with tarfile.open(str(streamed)) as tar:
+        names = tar.getnames()
+    # the tables follow everything that doesn't depend on them
+    assert names[-len(TABLES) - len(ROLLUP_FILES):-len(ROLLUP_FILES)] == \
+        TABLES
+    config.bundle_uuid = 'b' * 32
+    assert read_tables(str(streamed)) == read_tables(
+        TestDataGenerator().generate_bundle(config))
+
+
+def test_stream_bundle_failed(mocker):
+    mocker.patch.object(TestDataGenerator, 'table_size',
+                        side_effect=RuntimeError('failed'))
+    chunks = TestDataGenerator().stream_bundle(BundleConfig(bundle_uuid='c'))
+    with pytest.raises(RuntimeError):
+        list(chunks)
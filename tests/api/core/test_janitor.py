@@ -0,0 +1,155 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from api.core import metrics
+from api.core import generate_data
+from api.core.generate_data import get_bundle_path, get_partial_bundle_path
+from api.core.janitor import (Janitor, orphaned_markers, remove_bundles,
+                              stale_partials)
+
+NOW = 1000000.0
+HOUR = 3600
+
+
+@pytest.fixture
+def bundle_dir(mocker, tmp_path):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    return tmp_path
+
+
+def add_bundle(registry, uuid, size=10, age=0, processed=False):
+    path = get_bundle_path(uuid)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    registry.add(uuid, size, created=NOW - age)
+    if processed:
+        Path(path + '.done').touch()
+        registry.mark_processed(uuid)
+    return path
+
+
+def bundle(uuid, size=10, age=0, processed=False):
+    return {'uuid': uuid, 'size': size, 'created': NOW - age,
+            'processed': int(processed)}
+
+
+def test_select_by_age():
+    janitor = Janitor(processed_max_age=HOUR, unprocessed_max_age=2 * HOUR)
+    bundles = [bundle('a', age=3 * HOUR, processed=True),
+               bundle('b', age=1.5 * HOUR, processed=True),
+               bundle('c', age=1.5 * HOUR),
+               bundle('d', age=3 * HOUR)]
+    expired, evicted = janitor.select(bundles, NOW)
+    assert [b['uuid'] for b in expired] == ['a', 'b', 'd']
+    assert evicted == []
+
+
+def test_select_evicts_processed_first():
+    janitor = Janitor(processed_max_age=0, max_count=2)
+    bundles = [bundle('a', age=3), bundle('b', age=2, processed=True),
+               bundle('c', age=1, processed=True), bundle('d')]
+    expired, evicted = janitor.select(bundles, NOW)
+    assert expired == []
+    assert [b['uuid'] for b in evicted] == ['b', 'c']
+
+
+def test_select_max_bytes():
+    janitor = Janitor(processed_max_age=0, max_bytes=25)
+    bundles = [bundle('a', 10, age=2), bundle('b', 10, age=1),
+               bundle('c', 10)]
+    _, evicted = janitor.select(bundles, NOW)
+    assert [b['uuid'] for b in evicted] == ['a']
+
+
+def test_select_skips_busy_bundles():
+    janitor = Janitor(processed_max_age=HOUR, max_count=1,
+                      busy=lambda uuid: uuid == 'a')
+    bundles = [bundle('a', age=2 * HOUR, processed=True),
+               bundle('b', age=1), bundle('c')]
+    expired, evicted = janitor.select(bundles, NOW)
+    assert expired == []
+    # `a` still counts, so both others go
+    assert [b['uuid'] for b in evicted] == ['b', 'c']
+
+
+def test_remove_bundles_in_batches(mocker, bundle_dir, bundle_registry):
+    sleep = mocker.patch('api.core.janitor.time.sleep')
+    paths = [add_bundle(bundle_registry, str(i), processed=True)
+             for i in range(5)]
+    removed = metrics.JANITOR_REMOVED.get(reason='test')
+    freed = remove_bundles(bundle_registry.list(), 'test', batch=2, pause=1)
+    assert freed == 50
+    assert sleep.call_count == 2
+    assert not os.listdir(str(bundle_dir))
+    assert not any(os.path.exists(path) for path in paths)
+    assert bundle_registry.list() == []
+    assert metrics.JANITOR_REMOVED.get(reason='test') == removed + 5
+
+
+def test_orphaned_markers(bundle_dir, bundle_registry):
+    kept = add_bundle(bundle_registry, 'kept', processed=True)
+    Path(kept + '.index').touch()
+    orphan = get_bundle_path('gone') + '.done'
+    Path(orphan).touch()
+    Path(get_bundle_path('gone') + '.index').touch()
+    assert sorted(orphaned_markers(str(bundle_dir))) == [
+        orphan, get_bundle_path('gone') + '.index']
+
+
+def test_stale_partials(mocker, bundle_dir):
+    for bundle_id in ('stale', 'fresh', 'building'):
+        Path(get_partial_bundle_path(bundle_id)).touch()
+    stale_index = get_bundle_path('other') + '.index.part'
+    Path(stale_index).touch()
+    for path in (get_partial_bundle_path('stale'),
+                 get_partial_bundle_path('building'), stale_index):
+        os.utime(path, (NOW - 2 * HOUR, NOW - 2 * HOUR))
+    os.utime(get_partial_bundle_path('fresh'), (NOW, NOW))
+    mocker.patch.object(generate_data, 'BUILDING', {'building'})
+    assert sorted(stale_partials(str(bundle_dir), HOUR, NOW)) == [
+        stale_index, get_partial_bundle_path('stale')]
+
+
+def test_run_once(bundle_dir, bundle_registry):
+    old = add_bundle(bundle_registry, 'old', age=2 * HOUR, processed=True)
+    new = add_bundle(bundle_registry, 'new', processed=True)
+    orphan = get_bundle_path('gone') + '.done'
+    Path(orphan).touch()
+    partial = get_partial_bundle_path('failed')
+    Path(partial).touch()
+    os.utime(partial, (NOW - 2 * HOUR, NOW - 2 * HOUR))
+    janitor = Janitor(processed_max_age=HOUR, pause=0,
+                      partial_max_age=HOUR)
+    assert janitor.run_once(NOW) == 10
+    assert not os.path.exists(partial)
+    assert not os.path.exists(old) and not os.path.exists(old + '.done')
+    assert not os.path.exists(orphan)
+    assert os.path.exists(new) and os.path.exists(new + '.done')
+    assert [b['uuid'] for b in bundle_registry.list()] == ['new']
+
+
+def test_start_and_stop(mocker, bundle_dir):
+    janitor = Janitor(interval=0.01)
+    mocker.patch.object(janitor, 'run_once')
+    janitor.start()
+    assert janitor.thread.is_alive()
+    janitor.stop()
+    assert janitor.thread is None
+
+
+def test_elect(bundle_dir):
+    janitor, other = Janitor(), Janitor()
+    assert janitor.elect()
+    assert janitor.elect()
+    assert not other.elect()
+    janitor.stop()
+    assert other.elect()
+    other.stop()
+
+
+def test_disabled():
+    janitor = Janitor(interval=0)
+    janitor.start()
+    assert janitor.thread is None
@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+from api.core.jobs import DONE, FAILED, QUEUED, BundleJobs, QueueFull
+from api.main import BundleConfig
+
+
+def wait_for(job, timeout=10):
+    deadline = time.time() + timeout
+    while job.state not in (DONE, FAILED) and time.time() < deadline:
+        time.sleep(0.01)
+    return job.status()
+
+
+def test_bundle_job_status(mocker, tmp_path):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    on_done = mocker.MagicMock()
+    config = BundleConfig(unified_jobs=4, job_events=5, bundle_uuid='5' * 32)
+    job = BundleJobs(workers=1).submit(config, on_done)
+    status = wait_for(job)
+    assert status['state'] == DONE
+    assert status['rows_written'] == status['total_rows'] == 4 * 6
+    assert status['bytes_written'] > 0
+    assert status['eta_seconds'] is None
+    on_done.assert_called_once_with(config)
+
+
+def test_bundle_job_failed(mocker):
+    mocker.patch('api.core.jobs.TestDataGenerator').return_value \
+        .generate_bundle.side_effect = OSError('disk full')
+    on_done = mocker.MagicMock()
+    job = BundleJobs(workers=1).submit(BundleConfig(bundle_uuid='x'), on_done)
+    status = wait_for(job)
+    assert status['state'] == FAILED
+    assert status['error'] == 'disk full'
+    on_done.assert_not_called()
+
+
+def test_bundle_jobs_queue_full(mocker):
+    mocker.patch('api.core.jobs.BundleJob.run')
+    jobs = BundleJobs(workers=1, max_queued=1)
+    jobs.submit(BundleConfig(bundle_uuid='a'))
+    jobs.submit(BundleConfig(bundle_uuid='b'))
+    prepare = mocker.Mock()
+    with pytest.raises(QueueFull) as e:
+        jobs.submit(BundleConfig(bundle_uuid='c'), prepare=prepare)
+    assert e.value.retry_after >= 1
+    prepare.assert_not_called()
+    assert jobs.get('a').state == QUEUED
+
+
+def test_bundle_job_of_another_process(mocker):
+    mocker.patch('api.core.jobs.BundleJob.run')
+    BundleJobs(workers=1).submit(
+        BundleConfig(unified_jobs=2, bundle_uuid='elsewhere'))
+    # another gunicorn worker only knows the job from the registry
+    jobs = BundleJobs(workers=1)
+    status = jobs.status('elsewhere')
+    assert (status['state'], status['total_rows']) == (QUEUED, 4)
+    mocker.patch('api.core.jobs.process_alive', return_value=False)
+    assert jobs.status('elsewhere')['state'] == FAILED
+    assert jobs.status('unknown') is None
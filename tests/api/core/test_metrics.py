@@ -0,0 +1,114 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from api.core.metrics import (MetricsRegistry, Stages, record_stage,
+                              server_timing, trace)
+
+
+def test_render_counter_and_gauge():
+    registry = MetricsRegistry()
+    counter = registry.counter('rows_total', 'Rows', ['table'])
+    counter.inc(3, table='events')
+    counter.inc(table='events')
+    gauge = registry.gauge('in_progress', 'Running')
+    with gauge.track():
+        assert gauge.get() == 1
+    assert gauge.get() == 0
+    lines = registry.render().splitlines()
+    assert '# TYPE rows_total counter' in lines
+    assert 'rows_total{table="events"} 4' in lines
+    assert 'in_progress 0' in lines
+    with pytest.raises(ValueError):
+        counter.inc(table='events', extra='x')
+
+
+def test_render_histogram():
+    registry = MetricsRegistry()
+    histogram = registry.histogram('seconds', 'Time', ['stage'],
+                                   buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, stage='rows')
+    assert histogram.get(stage='rows') == (3, 5.55)
+    lines = registry.render().splitlines()
+    assert 'seconds_bucket{stage="rows",le="0.1"} 1' in lines
+    assert 'seconds_bucket{stage="rows",le="1"} 2' in lines
+    assert 'seconds_bucket{stage="rows",le="+Inf"} 3' in lines
+    assert 'seconds_count{stage="rows"} 3' in lines
+
+
+def test_stages():
+    stages = Stages()
+    chunks = []
+
+    def slow_chunks():
+        for i in range(2):
+            time.sleep(0.01)
+            yield i
+
+    class File:
+        def write(self, data):
+            time.sleep(0.01)
+            chunks.append(data)
+
+    with stages.remainder('compress'):
+        writer = stages.writer(File())
+        for chunk in stages.iter('rows', slow_chunks()):
+            writer.write(chunk)
+        time.sleep(0.01)
+    assert chunks == [0, 1]
+    assert stages.seconds['rows'] >= 0.02
+    assert stages.seconds['write'] >= 0.02
+    assert 0.01 <= stages.seconds['compress'] < 0.02
+
+
+def test_trace():
+    with trace() as breakdown:
+        record_stage('rows', 0.5)
+        record_stage('rows', 0.25)
+    record_stage('rows', 1)
+    assert breakdown == {'rows': 0.75}
+    assert server_timing(breakdown) == 'rows;dur=750.0'
+
+
+def test_trace_per_task():
+    async def handle(stage):
+        with trace() as breakdown:
+            await asyncio.sleep(0.01)
+            record_stage(stage, 1)
+        return breakdown
+
+    async def handle_both():
+        return await asyncio.gather(handle('rows'), handle('write'))
+
+    breakdowns = asyncio.get_event_loop().run_until_complete(handle_both())
+    assert breakdowns == [{'rows': 1}, {'write': 1}]
+
+
+def test_render_workers(tmp_path):
+    workers = []
+    for rows, connected in ((3, 1), (4, 0)):
+        registry = MetricsRegistry(str(tmp_path))
+        registry.counter('rows_total', 'Rows', ['table']).inc(
+            rows, table='events')
+        registry.gauge('in_progress', 'Running').inc()
+        registry.gauge('connected', 'Connected', mode='min').set(connected)
+        registry.gauge('free_bytes', 'Free', mode='local').set(rows)
+        registry.histogram('seconds', 'Time', buckets=(1,)).observe(rows)
+        workers.append(registry)
+    workers[1].flush()
+    lines = workers[0].render().splitlines()
+    assert 'rows_total{table="events"} 7' in lines
+    assert 'in_progress 2' in lines
+    assert 'connected 0' in lines
+    assert 'free_bytes 3' in lines
+    assert 'seconds_count 2' in lines
+    assert 'seconds_sum 7' in lines
+    # the second worker is gone, its counters still count
+    os.utime(os.path.join(str(tmp_path), workers[1].filename), (0, 0))
+    lines = workers[0].render().splitlines()
+    assert 'rows_total{table="events"} 7' in lines
+    assert 'in_progress 1' in lines
+    assert 'connected 1' in lines
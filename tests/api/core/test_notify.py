@@ -0,0 +1,137 @@
+import time
+from collections import namedtuple
+
+from api.core.notify import (
+    DELIVERED, FAILED, KafkaConnection, NotificationQueue)
+from api.core.registry import BundleRegistry
+
+RecordMetadata = namedtuple('RecordMetadata', 'topic partition offset')
+
+
+class FakeFuture:
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+
+    def add_callback(self, fn, *args):
+        if self.error is None:
+            fn(*args, self.result)
+        return self
+
+    def add_errback(self, fn, *args):
+        if self.error is not None:
+            fn(*args, self.error)
+        return self
+
+
+class FakeProducer:
+    """Acks every message in-process, failing the first `failures`."""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.sent = []
+        self.closed = False
+
+    def close(self, timeout=None):
+        self.closed = True
+
+    def send(self, topic, value):
+        self.sent.append((topic, value))
+        if self.failures:
+            self.failures -= 1
+            return FakeFuture(error=Exception('broker unavailable'))
+        return FakeFuture(RecordMetadata(topic, 0, len(self.sent) - 1))
+
+
+def test_notifications_delivered():
+    producer = FakeProducer()
+    notifications = NotificationQueue(lambda: producer, 'topic')
+    for i in range(5):
+        assert notifications.submit(str(i), {'n': i})['state'] == 'queued'
+    assert notifications.flush(timeout=5)
+    assert producer.sent == [('topic', {'n': i}) for i in range(5)]
+    status = notifications.status('4')
+    assert status['state'] == DELIVERED
+    assert (status['attempts'], status['offset']) == (1, 4)
+
+
+def test_notifications_retried():
+    producer = FakeProducer(failures=2)
+    notifications = NotificationQueue(
+        lambda: producer, 'topic', retries=2, backoff=0.01)
+    notifications.submit('a', {})
+    assert notifications.flush(timeout=5)
+    status = notifications.status('a')
+    assert status['state'] == DELIVERED
+    assert status['attempts'] == 3
+
+
+def test_notifications_failed():
+    notifications = NotificationQueue(
+        lambda: None, 'topic', retries=1, backoff=0.01)
+    notifications.submit('a', {})
+    assert notifications.flush(timeout=5)
+    status = notifications.status('a')
+    assert status['state'] == FAILED
+    assert status['attempts'] == 2
+    assert status['error'] == 'Kafka not available'
+    assert notifications.status('b') is None
+
+
+def test_notifications_retried_out_of_history():
+    attempts = []
+
+    def producer():
+        attempts.append(1)
+
+    notifications = NotificationQueue(
+        producer, 'topic', retries=1, backoff=0.01, history=1)
+    notifications.submit('a', {})
+    notifications.submit('b', {})
+    assert notifications.flush(timeout=5)
+    time.sleep(0.2)
+    # 'a' is gone from the history, its retries still stop
+    assert len(attempts) == 4
+
+
+def test_notifications_of_other_processes(tmp_path):
+    registry = BundleRegistry(str(tmp_path / 'registry.sqlite3'))
+    notifications = NotificationQueue(
+        lambda: FakeProducer(), 'topic', registry=registry)
+    notifications.submit('a', {})
+    assert notifications.flush(timeout=5)
+    other = NotificationQueue(lambda: None, 'topic', registry=registry)
+    assert other.status('a') == notifications.status('a')
+    assert other.status('b') is None
+
+
+def test_kafka_connection_retried():
+    producer = FakeProducer()
+    attempts = []
+
+    def connect():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise Exception('no brokers')
+        return producer
+
+    connection = KafkaConnection(connect, retry_interval=0.01)
+    assert connection.state()['state'] == 'idle'
+    assert connection.get(timeout=5) is producer
+    state = connection.state()
+    assert (state['state'], state['attempts'], state['error']) == \
+        ('connected', 3, None)
+    connection.close()
+    assert producer.closed
+    assert connection.state()['state'] == 'closed'
+    assert connection.get() is None
+
+
+def test_kafka_connection_does_not_block():
+    connection = KafkaConnection(lambda: time.sleep(10), retry_interval=0)
+    start = time.time()
+    assert connection.get() is None
+    assert connection.get(timeout=0.05) is None
+    assert time.time() - start < 1
+    assert connection.state()['state'] == 'connecting'
+    connection.stopped.set()
@@ -0,0 +1,109 @@
+import os
+import sqlite3
+import threading
+import time
+
+from api.core.registry import BundleRegistry
+
+
+def test_add_list_and_remove(tmp_path):
+    registry = BundleRegistry(str(tmp_path / 'registry.sqlite3'))
+    registry.add('a', 10, 'hash_a', created=2)
+    registry.add('b', 20, created=1)
+    registry.add('c', 30, created=3)
+    registry.mark_processed('c')
+    assert [b['uuid'] for b in registry.list()] == ['b', 'a', 'c']
+    assert [b['uuid'] for b in registry.list(processed=False)] == ['b', 'a']
+    assert [b['uuid'] for b in registry.list(offset=1, limit=1)] == ['a']
+    assert registry.get('a') == {
+        'uuid': 'a', 'size': 10, 'config_hash': 'hash_a', 'created': 2,
+        'processed': 0}
+    registry.remove(['a', 'b'])
+    assert [b['uuid'] for b in registry.list()] == ['c']
+
+
+def test_rebuild(tmp_path):
+    registry = BundleRegistry(str(tmp_path / 'registry.sqlite3'))
+    for uuid in ('a', 'b'):
+        with open(str(tmp_path / '{}_data_bundle.tar.gz'.format(uuid)),
+                  'wb') as f:
+            f.write(b'x' * 5)
+    registry.add('a', 1, 'hash_a')
+    registry.add('stale', 1)
+    assert registry.rebuild(str(tmp_path), ['a', 'missing'], ['b']) == 2
+    bundles = {b['uuid']: b for b in registry.list()}
+    assert sorted(bundles) == ['a', 'b']
+    assert bundles['a']['config_hash'] == 'hash_a'
+    assert bundles['a']['size'] == 5
+    assert bundles['b']['processed'] == 1
+    assert bundles['b']['created'] == os.stat(
+        str(tmp_path / 'b_data_bundle.tar.gz')).st_mtime
+
+
+def test_advance_series(tmp_path):
+    registry = BundleRegistry(str(tmp_path / 'registry.sqlite3'))
+    assert registry.series('install') is None
+    cursors = []
+
+    def next_window(cursor):
+        cursors.append(cursor)
+        last_job_id = cursor['last_job_id'] + 10 if cursor else 9
+        return 'result', {'last_job_id': last_job_id,
+                          'last_event_id': last_job_id * 2,
+                          'last_collected': 5.0, 'last_timestamp': 4.0}
+
+    assert registry.advance_series('install', next_window) == 'result'
+    registry.advance_series('install', next_window)
+    assert cursors[0] is None
+    assert cursors[1]['last_job_id'] == 9
+    assert registry.series('install') == {
+        'install_uuid': 'install', 'last_job_id': 19, 'last_event_id': 38,
+        'last_collected': 5.0, 'last_timestamp': 4.0, 'bundles': 2}
+
+
+def test_advance_series_concurrently(tmp_path):
+    path = str(tmp_path / 'registry.sqlite3')
+    starts = []
+
+    def next_window(cursor):
+        start = cursor['last_job_id'] + 1 if cursor else 0
+        starts.append(start)
+        # the other registry reads its cursor meanwhile
+        time.sleep(0.1)
+        return start, {'last_job_id': start + 9, 'last_event_id': 0,
+                       'last_collected': 0.0, 'last_timestamp': None}
+
+    # separate connections, like the gunicorn workers
+    threads = [threading.Thread(
+        target=BundleRegistry(path).advance_series,
+        args=('install', next_window)) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(starts) == [0, 10]
+    assert BundleRegistry(path).series('install')['bundles'] == 2
+
+
+def test_series_without_timestamps(tmp_path):
+    path = str(tmp_path / 'registry.sqlite3')
+    with sqlite3.connect(path) as db:
+        db.execute(
+            'CREATE TABLE series (install_uuid TEXT PRIMARY KEY, '
+            'last_job_id INTEGER NOT NULL, last_event_id INTEGER NOT NULL, '
+            'last_collected REAL NOT NULL, bundles INTEGER NOT NULL)')
+        db.execute("INSERT INTO series VALUES ('install', 9, 19, 5.0, 1)")
+    db.close()
+    cursor = BundleRegistry(path).series('install')
+    assert (cursor['last_job_id'], cursor['last_timestamp']) == (9, None)
+
+
+def test_jobs(tmp_path):
+    registry = BundleRegistry(str(tmp_path / 'registry.sqlite3'))
+    registry.set_job('a', 'running', 10)
+    registry.set_job('a', 'failed', 10, 'disk full')
+    assert registry.job('a') == {
+        'uuid': 'a', 'state': 'failed', 'total_rows': 10,
+        'pid': os.getpid(), 'error': 'disk full'}
+    registry.forget_jobs(['a'])
+    assert registry.job('a') is None
@@ -0,0 +1,33 @@
+import json
+
+from api.core.rollup import Rollup
+
+
+def test_merge():
+    first, second = Rollup(), Rollup()
+    first.add_job(1, 0, 0, 'successful', 'day2', 'day2-end')
+    first.add_job(2, 0, 0, 'failed', 'day1', 'day1-end')
+    first.add_hosts([0, 1], 3)
+    second.add_job(3, 2, 0, 'error', 'day3', 'day3-end')
+    second.add_job(4, 2, 1, 'successful', 'day1', 'day1-end')
+    second.add_hosts([1, 2], 3)
+    first.merge(second)
+    assert first.jobs() == 4
+    assert first.templates[0] == ['day1', 3, 'error', 'day3-end']
+    assert first.orgs == {0, 2}
+    assert first.hosts == {0, 1, 2}
+    assert Rollup.from_state(first.state()).state() == first.state()
+    job_counts = json.loads(first.render('job_counts.json', b'', None))
+    assert job_counts['status'] == {
+        'successful': 2, 'failed': 1, 'error': 1}
+
+
+def test_iter_templates():
+    rollup = Rollup()
+    rollup.add_job(7, 0, 3, 'failed', 'created', 'finished')
+    rollup.add_job(8, 0, 1, 'successful', 'created', 'finished')
+    rows = list(rollup.iter_templates())
+    # only the templates that ran
+    assert [row.split(',')[0] for row in rows] == ['1', '3']
+    assert rows[1] == ('3,35,jobtemplate,created,finished,1,1,'
+                       'template_name_3,"",7,t,finished,"","",failed\n')
@@ -0,0 +1,100 @@
+import io
+import tarfile
+import urllib.error
+from datetime import datetime
+
+import pytest
+from starlette.testclient import TestClient
+
+from api.core.generate_data import (
+    TABLES, TestDataGenerator, compress_columns, compress_segment)
+from api.core.shards import (
+    ShardError, ShardExecutor, decode_result, encode_result)
+from api.main import BundleConfig, app
+
+client = TestClient(app)
+
+
+def node_post(url, body, timeout):
+    """POST to the app as if it were the node in `url`."""
+    response = client.post(url.split('/', 3)[3], data=body)
+    if response.status_code != 200:
+        raise urllib.error.HTTPError(
+            url, response.status_code, response.reason, {},
+            io.BytesIO(response.content))
+    return response.content
+
+
+def read_members(bundle):
+    with tarfile.open(bundle) as tar:
+        return {member.name: tar.extractfile(member).read()
+                for member in tar.getmembers()}
+
+
+@pytest.mark.parametrize('task', [compress_segment, compress_columns])
+def test_encode_result(task):
+    config = BundleConfig(unified_jobs=5, job_events=3)
+    result = task(config, 'events_table.csv', 1, 4)
+    name = 'segment' if task is compress_segment else 'columns'
+    decoded = decode_result(name, encode_result(name, result))
+    assert decoded[:-1] == result[:-1]
+    assert decoded[-1].state() == result[-1].state()
+    with pytest.raises(ShardError):
+        decode_result(name, encode_result(name, result) + b'x')
+
+
+@pytest.mark.parametrize('table_format', ['csv', 'both'])
+def test_sharded_bundle(mocker, tmp_path, table_format):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    config = BundleConfig(
+        unified_jobs=40, job_events=6, hosts_count=9, templates_count=3,
+        reference_time=datetime(2020, 3, 1), table_format=table_format,
+        bundle_uuid='a' * 32, distributions={'host': {'zipf': 2}})
+    local = read_members(TestDataGenerator().generate_bundle(config))
+    executor = ShardExecutor(
+        ['http://node1', 'http://node2/'], post=node_post)
+    config.bundle_uuid = 'b' * 32
+    sharded = read_members(
+        TestDataGenerator().generate_bundle(config, executor))
+    executor.shutdown()
+    assert sharded == local
+    assert all(stats['shards'] for stats in executor.stats.values())
+
+
+def test_shard_retried_on_next_node(mocker):
+    def post(url, body, timeout):
+        if url.startswith('http://down'):
+            raise urllib.error.URLError('refused')
+        return node_post(url, body, timeout)
+
+    executor = ShardExecutor(['http://down', 'http://up'], post=post)
+    config = BundleConfig(unified_jobs=5)
+    segment, size, rows, _ = executor.submit(
+        compress_segment, config, TABLES[1], 0, 5).result()
+    assert (size, rows) == (
+        compress_segment(config, TABLES[1], 0, 5)[1], 5)
+    assert executor.stats['http://down']['failed'] == 1
+    executor.shutdown()
+
+
+def test_shard_failed(mocker):
+    sleep = mocker.patch('api.core.shards.time.sleep')
+    post = mocker.Mock(side_effect=urllib.error.URLError('refused'))
+    executor = ShardExecutor(['http://a', 'http://b'], attempts=3, post=post)
+    with pytest.raises(ShardError):
+        executor.submit(
+            compress_segment, BundleConfig(), TABLES[0], 0, 1).result()
+    assert post.call_count == 3
+    sleep.assert_called_once_with(1)
+    executor = ShardExecutor(['http://a'], post=node_post)
+    with pytest.raises(ShardError):
+        # rejected as invalid, not retried
+        executor.submit(
+            compress_segment, BundleConfig(), 'nothing.csv', 0, 1).result()
+    post = mocker.Mock(side_effect=urllib.error.HTTPError(
+        'http://a/shards', 403, 'Forbidden', {}, None))
+    executor = ShardExecutor(['http://a'], post=post)
+    with pytest.raises(ShardError, match='Forbidden'):
+        executor.submit(
+            compress_segment, BundleConfig(), TABLES[0], 0, 1).result()
+    assert post.call_count == 1
@@ -0,0 +1,147 @@
+import gzip
+import io
+import tarfile
+import threading
+import zlib
+
+import pytest
+
+from api.core.tarstream import (
+    HEADER_SLOT, ChunkPipe, SpanCompressor, TarGzWriter, compress_member,
+    gzip_compressor, gzip_stored)
+
+
+class Unseekable(io.RawIOBase):
+    def __init__(self):
+        self.data = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.data.write(data)
+
+
+def test_gzip_stored():
+    data = b'x' * tarfile.BLOCKSIZE
+    member = gzip_stored(data)
+    assert len(member) == HEADER_SLOT
+    assert gzip.decompress(member) == data
+
+
+def test_tar_gz_writer():
+    buf = io.BytesIO()
+    with TarGzWriter(buf) as tar:
+        tar.add_bytes('static.json', b'{}')
+        size = tar.add_stream('table.csv', (b'%d\n' % i for i in range(1000)))
+        tar.add_bytes('empty.csv', b'')
+        tar.add_compressed(compress_member('cached.json', b'[]', 0))
+    buf.seek(0)
+    with tarfile.open(fileobj=buf, mode='r:gz') as tar:
+        assert tar.getnames() == [
+            'static.json', 'table.csv', 'empty.csv', 'cached.json']
+        assert tar.extractfile('cached.json').read() == b'[]'
+        table = tar.extractfile('table.csv').read()
+        assert len(table) == size
+        assert table.splitlines()[-1] == b'999'
+        assert tar.extractfile('static.json').read() == b'{}'
+
+
+def test_tar_gz_writer_segments():
+    segments = []
+    for part in (b'a,b\n', b'1,2\n' * 100, b'3,4\n'):
+        compressor = gzip_compressor()
+        segments.append(
+            (compressor.compress(part) + compressor.flush(), len(part)))
+    buf = io.BytesIO()
+    with TarGzWriter(buf) as tar:
+        assert tar.add_segments('table.csv', segments) == 408
+    buf.seek(0)
+    with tarfile.open(fileobj=buf, mode='r:gz') as tar:
+        table = tar.extractfile('table.csv').read()
+    assert table == b'a,b\n' + b'1,2\n' * 100 + b'3,4\n'
+
+
+def test_tar_gz_writer_threads():
+    chunks = [b'%d\n' % i * 1000 for i in range(20)]
+    buf = io.BytesIO()
+    with TarGzWriter(buf, threads=3) as tar:
+        tar.add_stream('table.csv', chunks)
+    buf.seek(0)
+    with tarfile.open(fileobj=buf, mode='r:gz') as tar:
+        assert tar.extractfile('table.csv').read() == b''.join(chunks)
+
+
+def test_tar_gz_writer_sized():
+    out = Unseekable()
+    with TarGzWriter(out) as tar:
+        tar.add_stream('table.csv', [b'a,b\n', b'1,2\n'], size=8)
+        tar.add_segments('empty.csv', [], size=0)
+    with tarfile.open(fileobj=io.BytesIO(out.data.getvalue())) as tar:
+        assert tar.extractfile('table.csv').read() == b'a,b\n1,2\n'
+        assert tar.getnames() == ['table.csv', 'empty.csv']
+    with pytest.raises(ValueError):
+        with TarGzWriter(Unseekable()) as tar:
+            tar.add_stream('table.csv', [b'a,b\n'], size=8)
+
+
+def test_chunk_pipe():
+    pipe = ChunkPipe(max_chunks=2, chunk_size=4)
+
+    def write():
+        for i in range(100):
+            pipe.write(b'%02d' % i)
+        pipe.close()
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    chunks = list(pipe)
+    thread.join()
+    assert set(map(len, chunks)) == {4}
+    assert b''.join(chunks) == b''.join(b'%02d' % i for i in range(100))
+    assert pipe.written == 200
+
+
+def test_chunk_pipe_error():
+    pipe = ChunkPipe()
+    pipe.write(b'x')
+    pipe.close(IOError('failed'))
+    with pytest.raises(IOError):
+        next(pipe)
+
+
+def test_chunk_pipe_reader_gone():
+    pipe = ChunkPipe(max_chunks=1, chunk_size=1, timeout=0.2)
+    pipe.write(b'x')
+    with pytest.raises(BrokenPipeError):
+        pipe.write(b'y')
+    pipe.cancel()
+    with pytest.raises(BrokenPipeError):
+        pipe.write(b'z')
+    assert list(pipe) == []
+
+
+def test_chunk_pipe_reader_stalled():
+    pipe = ChunkPipe(max_chunks=1, chunk_size=1, timeout=0.2)
+    pipe.write(b'x')
+    with pytest.raises(BrokenPipeError):
+        pipe.write(b'y')
+    assert next(pipe) == b'x'
+    with pytest.raises(BrokenPipeError):
+        next(pipe)
+
+
+def test_span_compressor():
+    compressor = SpanCompressor(span=100)
+    data = bytes(range(256)) * 2
+    compressed = b''.join(
+        [compressor.compress(data[:30]), compressor.compress(data[30:]),
+         compressor.flush()])
+    assert gzip.decompress(compressed) == data
+    members = 0
+    while compressed:
+        decompressor = zlib.decompressobj(31)
+        decompressor.decompress(compressed)
+        compressed = decompressor.unused_data
+        members += 1
+    assert members == 6
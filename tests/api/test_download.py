@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+from api.download import BundleStreamResponse, DownloadLimiter, parse_range
+
+
+@pytest.mark.parametrize('header,expected', [
+    (None, None),
+    ('bytes=0-9', (0, 9)),
+    ('bytes=10-', (10, 99)),
+    ('bytes=-10', (90, 99)),
+    ('bytes=-200', (0, 99)),
+    ('bytes=90-500', (90, 99)),
+    ('bytes=0-1,5-6', None),
+    ('items=0-1', None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 100) == expected
+
+
+@pytest.mark.parametrize('header', ['bytes=100-', 'bytes=5-4'])
+def test_parse_range_not_satisfiable(header):
+    with pytest.raises(ValueError):
+        parse_range(header, 100)
+
+
+def test_download_limiter():
+    limiter = DownloadLimiter(limit=2)
+    assert limiter.acquire('a')
+    assert limiter.acquire('a')
+    assert not limiter.acquire('a')
+    assert limiter.acquire('b')
+    limiter.release('a')
+    assert limiter.acquire('a')
+    limiter.release('b')
+    assert limiter.downloading('a')
+    assert not limiter.downloading('b')
+
+
+def test_download_limiter_of_other_processes(mocker, bundle_registry):
+    limiter, other = DownloadLimiter(limit=2), DownloadLimiter(limit=2)
+    assert other.acquire('a')
+    assert limiter.downloading('a')
+    assert limiter.acquire('a')
+    assert not limiter.acquire('a')
+    other.release('a')
+    assert limiter.acquire('a')
+    # the other process died while downloading
+    mocker.patch('api.download.process_alive', return_value=False)
+    assert not limiter.downloading('a')
+    assert limiter.acquire('a')
+
+
+class Chunks:
+    def __init__(self):
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+        return b'x'
+
+    def close(self):
+        self.closed = True
+
+
+def test_bundle_stream_response_client_gone():
+    chunks = Chunks()
+    sent = []
+    disconnected = asyncio.Event()
+
+    async def receive():
+        await disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+        if len(sent) == 3:
+            disconnected.set()
+        await asyncio.sleep(0)
+
+    response = BundleStreamResponse(chunks, 'foo.tar.gz')
+    asyncio.get_event_loop().run_until_complete(response({}, receive, send))
+    assert chunks.closed
+    assert sent[0]['type'] == 'http.response.start'
+    assert sent[-1] == {'type': 'http.response.body', 'body': b''}
+
+
+def test_bundle_stream_response_writer_failed():
+    class Stalled(Chunks):
+        def __next__(self):
+            # the writer gave up after the first chunk
+            if self.closed:
+                raise BrokenPipeError('No chunk read for 60s')
+            self.closed = True
+            return b'x'
+
+    sent = []
+
+    async def receive():
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    response = BundleStreamResponse(Stalled(), 'foo.tar.gz')
+    with pytest.raises(BrokenPipeError):
+        asyncio.get_event_loop().run_until_complete(
+            response({}, receive, send))
+    # the body never ends, the client sees the download fail
+    assert sent[-1]['more_body']
@@ -1,3 +1,4 @@
+import io
 import json
 import os
 import tarfile
@@ -10,9 +11,13 @@ from fastapi import HTTPException
 import api.main
 from api.main import (
     app, bundles_by_state, list_bundles, BundleConfig, BundleState,
-    delete_bundles, create_bundle,
+    delete_bundles, rebuild_registry,
+    remove_processed_bundles,
 )
+from api.core.admission import Overloaded, Rejected
 from api.core.generate_data import get_bundle_path
+from api.core.jobs import BUNDLE_JOBS, QueueFull
+from api.download import DOWNLOADS
 from starlette.testclient import TestClient
 
 
@@ -28,6 +33,16 @@ def create_bundle_fix():
         os.remove(f+'.done')
 
 
+@pytest.fixture()
+def bundle_content():
+    f = get_bundle_path('bar')
+    content = bytes(range(256)) * 4
+    with open(f, 'wb') as bundle:
+        bundle.write(content)
+    yield content
+    os.remove(f)
+
+
 def test_get_bundle_not_exist():
     response = client.get("/bundles/foo")
     assert response.status_code == 404
@@ -39,10 +54,71 @@ def test_get_bundle(create_bundle_fix):
     assert not os.path.exists(get_bundle_path('foo')+'.done')
 
 
-def test_get_bundle_done(create_bundle_fix):
+def test_get_bundle_done(create_bundle_fix, bundle_registry):
+    bundle_registry.add('foo', 0)
     response = client.get("/bundles/foo?done=True")
     assert response.status_code == 200
     assert os.path.exists(get_bundle_path('foo')+'.done')
+    assert bundle_registry.get('foo')['processed']
+
+
+def test_download_bundle_range(bundle_content):
+    response = client.get(
+        "/bundles/bar/download", headers={'Range': 'bytes=10-19'})
+    assert response.status_code == 206
+    assert response.content == bundle_content[10:20]
+    assert response.headers['content-range'] == 'bytes 10-19/1024'
+    assert not DOWNLOADS.active
+
+
+def test_download_bundle_if_range(bundle_content):
+    etag = client.head("/bundles/bar/download").headers['etag']
+    response = client.get("/bundles/bar/download", headers={
+        'Range': 'bytes=1000-', 'If-Range': etag})
+    assert response.status_code == 206
+    assert response.content == bundle_content[1000:]
+    response = client.get("/bundles/bar/download", headers={
+        'Range': 'bytes=1000-', 'If-Range': '"stale"'})
+    assert response.status_code == 200
+    assert response.content == bundle_content
+
+
+def test_download_bundle_head(bundle_content):
+    response = client.head("/bundles/bar?done=True")
+    assert response.status_code == 200
+    assert response.headers['content-length'] == '1024'
+    assert response.headers['accept-ranges'] == 'bytes'
+    assert not response.content
+    assert not os.path.exists(get_bundle_path('bar') + '.done')
+
+
+def test_download_bundle_not_modified(bundle_content):
+    etag = client.get("/bundles/bar").headers['etag']
+    response = client.get("/bundles/bar", headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+
+def test_download_bundle_range_not_satisfiable(bundle_content):
+    response = client.get("/bundles/bar", headers={'Range': 'bytes=2000-'})
+    assert response.status_code == 416
+    assert response.headers['content-range'] == 'bytes */1024'
+
+
+def test_download_bundle_limit(mocker, bundle_content):
+    mocker.patch('api.main.DOWNLOADS.acquire', return_value=False)
+    response = client.get("/bundles/bar")
+    assert response.status_code == 503
+    assert response.headers['retry-after'] == '1'
+
+
+def test_download_bundle_mark_failed(mocker, bundle_content):
+    mocker.patch('api.main.BUNDLE_REGISTRY.mark_processed',
+                 side_effect=OSError('disk I/O error'))
+    release = mocker.patch('api.main.DOWNLOADS.release')
+    with pytest.raises(OSError):
+        client.get("/bundles/bar?done=true")
+    release.assert_called_once_with('bar')
+    os.remove(get_bundle_path('bar') + '.done')
 
 
 UUIDs = [
@@ -66,31 +142,35 @@ def test_bundles_by_state(mocker):
     assert tars == [UUIDs[2]] 
 
 
-def test_list_bundles(mocker):
-    tars = [UUIDs[2]]
-    done = [UUIDs[0], UUIDs[1]]
-    purge = [UUIDs[1]]
-    mocker.patch('api.main.bundles_by_state', return_value=[tars, done, purge])
-    out = list_bundles().sort(key=lambda x: x.uuid)
-    expected = [
-        BundleState(uuid=UUIDs[0], processed=True),
-        BundleState(uuid=UUIDs[1], processed=True),
-        BundleState(uuid=UUIDs[2], processed=False),
-    ].sort(key=lambda x: x.uuid)
-    assert out == expected
+def test_list_bundles(bundle_registry):
+    bundle_registry.add(UUIDs[0], 10, created=1)
+    bundle_registry.add(UUIDs[1], 20, created=2)
+    bundle_registry.add(UUIDs[2], 30, created=3)
+    bundle_registry.mark_processed(UUIDs[0])
+    bundle_registry.mark_processed(UUIDs[1])
+    out = list_bundles()
+    assert [bundle.uuid for bundle in out] == UUIDs
+    assert out[2] == BundleState(
+        uuid=UUIDs[2], processed=False, size=30, created=3)
+    processed = list_bundles(state='processed', offset=1, limit=5)
+    assert [bundle.uuid for bundle in processed] == [UUIDs[1]]
+    unprocessed = client.get('/bundles/?state=unprocessed').json()
+    assert [bundle['uuid'] for bundle in unprocessed] == [UUIDs[2]]
+    page = client.get('/bundles/?offset=1&limit=1').json()
+    assert [bundle['uuid'] for bundle in page] == [UUIDs[1]]
 
 
 def test_create_bundle_and_process(mocker):
     notify_upload = mocker.patch('api.main.notify_upload')
     mocker.patch('api.main.TestDataGenerator')
-    create_bundle(BundleConfig())
+    client.post('/bundles/', json={})
     notify_upload.assert_called_once()
 
 
 def test_create_bundle_no_processing(mocker):
     notify_upload = mocker.patch('api.main.notify_upload')
     mocker.patch('api.main.TestDataGenerator')
-    create_bundle(BundleConfig(), process=False)
+    client.post('/bundles/?process=false', json={})
     notify_upload.assert_not_called()
 
 
@@ -100,9 +180,10 @@ def test_create_bundle(mocker):
         tower_url_base = 'base_url_is_this',
         instance_uuid = 'instance_12345',
     )
-    config = create_bundle(bundle_config, process=False)
+    config = client.post(
+        '/bundles/?process=false', data=bundle_config.json()).json()
     temp_dir = tempfile.mkdtemp()
-    bundle_file = get_bundle_path(config.bundle_uuid)
+    bundle_file = get_bundle_path(config['bundle_uuid'])
     tar = tarfile.open(bundle_file)
     tar.extractall(path=temp_dir)
     tar.close()
@@ -114,18 +195,38 @@ def test_create_bundle(mocker):
     os.remove(bundle_file)
 
 
-def test_delete_processed_bundles(mocker):
-    tars = [UUIDs[2]]
-    done = [UUIDs[0], UUIDs[1]]
-    purge = [UUIDs[1]]
-    bundles_by_state = mocker.patch(
-        'api.main.bundles_by_state',
-        return_value=[tars, done, purge])
+def test_delete_processed_bundles(mocker, bundle_registry):
+    for uuid in UUIDs:
+        bundle_registry.add(uuid, 10)
+    bundle_registry.mark_processed(UUIDs[1])
     remove_processed_bundles = mocker.patch('api.main.remove_processed_bundles')
     background_tasks = mocker.MagicMock()
     delete_bundles(background_tasks)
-    bundles_by_state.assert_called_once()
-    background_tasks.add_task.assert_called_once_with(remove_processed_bundles, purge)
+    background_tasks.add_task.assert_called_once_with(
+        remove_processed_bundles, [UUIDs[1]])
+
+
+def test_remove_processed_bundles(bundle_registry, create_bundle_fix):
+    bundle_registry.add('foo', 0)
+    Path(get_bundle_path('foo') + '.done').touch()
+    remove_processed_bundles(['foo'])
+    assert not os.path.exists(get_bundle_path('foo'))
+    assert not os.path.exists(get_bundle_path('foo') + '.done')
+    assert bundle_registry.get('foo') is None
+    Path(get_bundle_path('foo')).touch()
+
+
+def test_rebuild_registry(mocker, bundle_registry):
+    bundle = get_bundle_path(UUIDs[2])
+    Path(bundle).touch()
+    mocker.patch('api.main.listdir', return_value=[
+        os.path.basename(bundle),
+        UUIDs[0] + '_data_bundle.tar.gz.done',
+    ])
+    bundle_registry.add('gone', 10)
+    rebuild_registry()
+    os.remove(bundle)
+    assert [b['uuid'] for b in bundle_registry.list()] == [UUIDs[2]]
 
 
 def test_delete_a_non_existing_bundle(mocker):
@@ -144,4 +245,249 @@ def test_delete_a_bundle(mocker):
     delete_bundles(background_tasks, UUIDs[0])
     background_tasks.add_task.assert_called_once_with(
         remove_processed_bundles,
-        [UUIDs[0]])
\ No newline at end of file
+        [UUIDs[0]])
+
+
+def test_create_bundle_async(mocker):
+    run = mocker.patch('api.core.jobs.BundleJob.run')
+    response = client.post('/bundles/?async=true&process=false', json={})
+    assert response.status_code == 202
+    run.assert_called_once()
+    assert BUNDLE_JOBS.get(response.json()['bundle_uuid'])
+
+
+def test_create_bundle_async_queue_full(mocker):
+    mocker.patch('api.main.BUNDLE_JOBS.submit',
+                 side_effect=QueueFull('full', retry_after=3))
+    response = client.post('/bundles/?async=true', json={})
+    assert response.status_code == 503
+    assert response.headers['retry-after'] == '3'
+
+
+def test_create_bundle_async_series_queue_full(mocker):
+    # a rejected bundle doesn't advance its series
+    mocker.patch('api.main.BUNDLE_JOBS.max_pending', 0)
+    response = client.post('/bundles/?async=true', json={
+        'series': True, 'install_uuid': 'queue-full'})
+    assert response.status_code == 503
+    assert client.get('/series/queue-full').status_code == 404
+
+
+def test_bundle_status(mocker, create_bundle_fix):
+    mocker.patch('api.main.BUNDLE_JOBS.get', return_value=None)
+    response = client.get('/bundles/foo/status')
+    assert response.status_code == 200
+    assert response.json()['state'] == 'done'
+    assert client.get('/bundles/bar/status').status_code == 404
+
+
+def test_create_bundle_unknown_compression(mocker):
+    generator = mocker.patch('api.main.TestDataGenerator')
+    response = client.post(
+        '/bundles/?process=false', json={'compression': 'lzma'})
+    assert response.status_code == 422
+    generator.assert_not_called()
+
+
+def test_process_bundles(mocker, create_bundle_fix):
+    notify_upload = mocker.patch(
+        'api.main.notify_upload', return_value={'state': 'queued'})
+    response = client.post(
+        '/process', json={'bundle_ids': ['foo', 'bar'], 'tenant_id': 2})
+    assert response.status_code == 200
+    assert response.json()['foo'] == {'state': 'queued'}
+    assert response.json()['bar']['state'] == 'failed'
+    notify_upload.assert_called_once_with(
+        api.main.HOST_URL, '123456', 2, 'foo')
+
+
+def test_notification_status(mocker):
+    mocker.patch('api.main.NOTIFICATIONS.status', return_value=None)
+    assert client.get('/bundles/foo/notification').status_code == 404
+    mocker.patch(
+        'api.main.NOTIFICATIONS.status', return_value={'state': 'delivered'})
+    response = client.get('/bundles/foo/notification')
+    assert response.json() == {'state': 'delivered'}
+
+
+def test_create_fleet(mocker):
+    generator = mocker.patch('api.main.TestDataGenerator').return_value
+    configs = [BundleConfig(bundle_uuid=str(i)) for i in range(2)]
+    generator.fan_out.return_value = configs
+    generator.generate_fleet.return_value = {'bundles': 2}
+    notify_upload = mocker.patch('api.main.notify_upload')
+    response = client.post('/bundles/fleet', json={
+        'template': {'unified_jobs': 5},
+        'tenants': [{'tenant_id': 7}],
+        'installs_per_tenant': 2,
+        'workers': 3,
+    })
+    assert response.status_code == 200
+    assert response.json()['bundles'] == 2
+    template, tenants, installs = generator.fan_out.call_args[0]
+    assert (template.unified_jobs, tenants[0].tenant_id, installs) == (5, 7, 2)
+    generator.generate_fleet.assert_called_once_with(configs, 3)
+    assert notify_upload.call_count == 2
+
+
+def test_create_bundle_series(mocker):
+    mocker.patch('api.main.TestDataGenerator.generate_bundle')
+    series = {'install_uuid': 'install', 'unified_jobs': 5, 'series': True}
+    first = client.post('/bundles/?process=false', json=series).json()
+    second = client.post('/bundles/?process=false', json=series).json()
+    assert (first['starting_job_id'], second['starting_job_id']) == (0, 5)
+    cursor = client.get('/series/install').json()
+    assert (cursor['last_job_id'], cursor['bundles']) == (9, 2)
+    assert client.get('/series/unknown').status_code == 404
+    response = client.post('/bundles/?process=false', json={'series': True})
+    assert response.status_code == 422
+
+
+def test_metrics(mocker, bundle_registry):
+    bundle_registry.add('foo', 10)
+    mocker.patch('api.main.TestDataGenerator.generate_bundle')
+    client.post('/bundles/?process=false', json={})
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert 'bundle_dir_bundles{processed="false"} 1' in lines
+    assert 'bundle_dir_bundle_bytes{processed="false"} 10' in lines
+    assert any(line.startswith(
+        'http_request_seconds_count{method="POST",handler="create_bundle",'
+        'status="200"}') for line in lines)
+
+
+def test_debug_server_timing(mocker, tmp_path):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    response = client.post('/bundles/?process=false&debug=true', json={})
+    timing = response.headers['server-timing']
+    assert 'rows;dur=' in timing and 'total;dur=' in timing
+    response = client.post('/bundles/?process=false', json={})
+    assert 'server-timing' not in response.headers
+
+
+def test_create_bundle_rejected(mocker):
+    generate_bundle = mocker.patch(
+        'api.main.TestDataGenerator.generate_bundle')
+    mocker.patch('api.main.ADMISSION.acquire',
+                 side_effect=Rejected('busy', retry_after=7))
+    response = client.post('/bundles/?process=false', json={})
+    assert response.status_code == 429
+    assert response.headers['retry-after'] == '7'
+    mocker.patch('api.main.ADMISSION.acquire',
+                 side_effect=Overloaded('full', retry_after=3))
+    response = client.post('/bundles/?process=false', json={
+        'series': True, 'install_uuid': 'rejected'})
+    assert response.status_code == 503
+    assert client.get('/series/rejected').status_code == 404
+    generate_bundle.assert_not_called()
+
+
+def test_create_bundle_too_large(mocker):
+    generate_bundle = mocker.patch(
+        'api.main.TestDataGenerator.generate_bundle')
+    for query in ['', '&async=true']:
+        response = client.post('/bundles/?process=false' + query, json={
+            'unified_jobs': 10 ** 9, 'job_events': 10 ** 3})
+        assert response.status_code == 422
+        assert 'budget' in response.json()['detail']
+    response = client.post('/bundles/?process=false', json={'workers': -1})
+    assert response.status_code == 422
+    generate_bundle.assert_not_called()
+
+
+def test_stream_bundle(mocker, tmp_path):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    notify_upload = mocker.patch('api.main.notify_upload')
+    release = mocker.spy(api.main.ADMISSION, 'release')
+    response = client.post('/bundles/stream', json={'unified_jobs': 5})
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/gzip'
+    assert 'content-length' not in response.headers
+    assert response.headers['content-disposition'].endswith(
+        '_data_bundle.tar.gz"')
+    with tarfile.open(fileobj=io.BytesIO(response.content)) as tar:
+        jobs = tar.extractfile('unified_jobs_table.csv').read()
+    assert len(jobs.splitlines()) == 6
+    assert os.listdir(str(tmp_path)) == []
+    release.assert_called_once()
+    notify_upload.assert_not_called()
+    response = client.post('/bundles/stream', json={'table_format': 'npy'})
+    assert response.status_code == 422
+    response = client.post('/bundles/stream', json={
+        'series': True, 'install_uuid': 'streamed'})
+    assert response.status_code == 422
+    assert client.get('/series/streamed').status_code == 404
+
+
+def test_stream_bundle_get(mocker, tmp_path):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    response = client.get('/bundles/stream?unified_jobs=3&job_events=2')
+    assert response.status_code == 200
+    with tarfile.open(fileobj=io.BytesIO(response.content)) as tar:
+        events = tar.extractfile('events_table.csv').read()
+    assert len(events.splitlines()) == 7
+    response = client.get('/bundles/stream?unified_jobs=many')
+    assert response.status_code == 422
+    assert response.json()['detail'][0]['loc'][-1] == 'unified_jobs'
+
+
+def test_health(mocker):
+    mocker.patch('api.main.KAFKA.state', return_value={'state': 'connecting'})
+    assert client.get('/health/live').json()['status'] == 'ok'
+    response = client.get('/health/ready')
+    assert response.status_code == 503
+    assert response.json()['kafka'] == {'state': 'connecting'}
+    mocker.patch('api.main.KAFKA.state', return_value={'state': 'connected'})
+    assert client.get('/health/ready').status_code == 200
+
+
+def test_bundle_members(mocker, tmp_path):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    bundle_uuid = client.post('/bundles/?process=false', json={
+        'unified_jobs': 5, 'job_events': 3}).json()['bundle_uuid']
+    url = '/bundles/{}/members'.format(bundle_uuid)
+    members = {m['name']: m['size'] for m in client.get(url).json()}
+    with tarfile.open(get_bundle_path(bundle_uuid)) as tar:
+        table = tar.extractfile('events_table.csv').read()
+    assert members['events_table.csv'] == len(table)
+    response = client.get(url + '/events_table.csv?offset=2&limit=4')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/csv')
+    assert response.content.splitlines() == table.splitlines()[2:6]
+    response = client.get(url + '/events_table.csv?offset=5&unit=bytes')
+    assert response.content == table[5:105]
+    assert client.get(url + '/nothing.csv').status_code == 404
+    assert client.get('/bundles/unknown/members').status_code == 404
+
+
+def test_create_sharded_bundle(mocker, tmp_path):
+    mocker.patch('api.core.generate_data.BUNDLE_DIR', str(tmp_path))
+    notify_upload = mocker.patch('api.main.notify_upload')
+    response = client.post('/bundles/sharded', json={'config': {}})
+    assert response.status_code == 422
+
+    mocker.patch('api.main.BUNDLE_SHARD_NODES',
+                 ['http://node1', 'http://node2/'])
+    response = client.post('/bundles/sharded', json={
+        'config': {}, 'nodes': ['http://node1', 'http://elsewhere']})
+    assert response.status_code == 422
+    assert 'elsewhere' in response.text
+    # the coordinator writes the rollups itself
+    response = client.post('/bundles/sharded', json={
+        'config': {'unified_jobs': 10 ** 9, 'templates_count': 10 ** 9}})
+    assert response.status_code == 422
+    assert 'budget' in response.json()['detail']
+
+    mocker.patch('api.core.shards.post_shard', side_effect=lambda url, body,
+                 timeout: client.post('/shards', data=body).content)
+    response = client.post('/bundles/sharded', json={
+        'config': {'unified_jobs': 7, 'job_events': 2},
+        'nodes': ['http://node1', 'http://node2']})
+    assert response.status_code == 200
+    stats = response.json()
+    with tarfile.open(get_bundle_path(stats['config']['bundle_uuid'])) as tar:
+        jobs = tar.extractfile('unified_jobs_table.csv').read()
+    assert len(jobs.splitlines()) == 8
+    assert sum(node['shards'] for node in stats['nodes'].values()) > 1
+    notify_upload.assert_called_once()